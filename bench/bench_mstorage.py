@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""media storage client benchmarks against the local mock server"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+
+class BenchAuthClient(object):
+    """AuthClient stand-in handing out a fixed token"""
+
+    def session(self, scope):
+        """start a session"""
+        pass
+
+    @staticmethod
+    def get_access_token():
+        """return the token"""
+        return 'bench-token'
+
+def serve(conn, options):
+    """run the mock server until the parent closes the pipe"""
+    server = MockMediaStorageServer(latency=options.latency, bandwidth=options.bandwidth,
+                                    error_rate=options.error_rate, seed=0)
+    with server:
+        conn.send(server.endpoint)
+        conn.recv()
+
+def percentile(values, rate):
+    """return the nearest-rank percentile of sorted values"""
+    index = int(round(rate * (len(values) - 1)))
+    return values[index]
+
+def measure(name, ops, func, trace_memory):
+    """call func(index) ops times and print throughput, latency, cpu and memory"""
+    latencies = []
+    if trace_memory:
+        tracemalloc.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for index in range(ops):
+        start = time.perf_counter()
+        func(index)
+        latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    latencies.sort()
+    print('{0:<14} {1:>6} {2:>10.1f} {3:>9.2f} {4:>9.2f} {5:>8.3f} {6:>10.0f}'.format(
+        name, ops, ops / wall, percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000, cpu, peak / 1024.0))
+
+def run(mstorage, options):
+    """run every benchmark"""
+    payload = b'\xff\xd8\xff\xe0' + os.urandom(options.size - 4)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('{0:<14} {1:>6} {2:>10} {3:>9} {4:>9} {5:>8} {6:>10}'.format(
+            'benchmark', 'ops', 'ops/sec', 'p50 ms', 'p99 ms', 'cpu s',
+            'peak KiB' if options.memory else 'rss KiB'))
+        mids = []
+        measure('upload', options.ops,
+                lambda index: mids.append(mstorage.upload(payload)['id']), options.memory)
+        measure('download_to', options.ops,
+                lambda index: mstorage.download_to(mids[index], os.path.join(tmpdir, 'media')),
+                options.memory)
+        measure('list', max(1, options.ops // 10),
+                lambda index: sum(1 for dummy in mstorage.iter_media(page_size=options.page_size)),
+                options.memory)
+        measure('meta', options.ops, lambda index: mstorage.meta(mids[index], 'exif'), options.memory)
+        meta = {'user.key{0}'.format(num): 'value{0}'.format(num) for num in range(5)}
+        measure('add_meta', options.ops, lambda index: mstorage.add_meta(mids[index], meta),
+                options.memory)
+        print('pool', mstorage.pool.stats())
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ops', type=int, default=200, help='operations per benchmark')
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='media size in bytes')
+    parser.add_argument('--page-size', type=int, default=100, help='list page size')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency in seconds')
+    parser.add_argument('--bandwidth', type=int, default=None, help='server bytes/sec')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--memory', action='store_true',
+                        help='report traced peak allocations instead of process RSS')
+    options = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, options))
+    server.start()
+    try:
+        endpoint = parent.recv()
+        run(MediaStorage(BenchAuthClient(), endpoint=endpoint), options)
+    finally:
+        parent.send(None)
+        server.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+RICOH Media Storage asyncio client
+
+requires aiohttp (pip install ricohapi-mstorage[async])
+"""
+
+import asyncio
+import sys
+from collections import deque
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from .client import (_ENDPOINT, _MEDIA_ROOT_PATH, _SEARCH_PATH, _MEDIA_PATH, _CONTENT_PATH,
+                     _USER_META_PATH, _SCOPE, _parse_json, _user_meta_items, _meta_path,
+                     _remove_meta_path, _search_payload, DEFAULT_CHUNK_SIZE, DEFAULT_PAGE_SIZE)
+from .token import TokenCache
+
+_PY_352 = sys.version_info >= (3, 5, 2)
+
+class _AsyncIterator(object):
+    """base of the async iterators; python < 3.5.2 awaits the result of __aiter__"""
+    if _PY_352:
+        def __aiter__(self):
+            return self
+    else:
+        @asyncio.coroutine
+        def __aiter__(self):
+            return self
+
+class _ChunkIterator(_AsyncIterator):
+    """async iterator over the byte chunks of a response, sent on first use
+
+    a caller that stops before the end must await aclose(), or use the
+    iterator in async with, to release the connection.
+    """
+
+    def __init__(self, send, chunk_size):
+        self.__send = send
+        self.__chunk_size = chunk_size
+        self.__res = None
+        self.__done = False
+
+    async def __anext__(self):
+        if self.__done:
+            raise StopAsyncIteration
+        if self.__res is None:
+            self.__res = await self.__send()
+        try:
+            chunk = await self.__res.content.read(self.__chunk_size)
+        except BaseException:
+            await self.aclose()
+            raise
+        if not chunk:
+            await self.aclose()
+            raise StopAsyncIteration
+        return chunk
+
+    async def aclose(self):
+        """release the response; later iterations stop"""
+        self.__done = True
+        if self.__res is not None:
+            self.__res.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+class _MediaIterator(_AsyncIterator):
+    """async iterator over media ids, fetching pages lazily"""
+
+    def __init__(self, list_page, params, page_size):
+        self.__list_page = list_page
+        self.__params = params
+        self.__page_size = page_size
+        self.__ids = deque()
+        self.__done = False
+
+    async def __anext__(self):
+        while not self.__ids:
+            if self.__done:
+                raise StopAsyncIteration
+            page = await self.__list_page(self.__params)
+            ids = [media['id'] for media in page.get('media', [])]
+            if len(ids) < self.__page_size:
+                self.__done = True
+            else:
+                self.__params['after'] = ids[-1]
+            self.__ids.extend(ids)
+        return self.__ids.popleft()
+
+class AsyncMediaStorage(object):
+    """media storage for asyncio"""
+    DEFAULT_LIMIT = 100
+
+    def __init__(self, aclient, session=None, endpoint=_ENDPOINT,
+                 chunk_size=DEFAULT_CHUNK_SIZE, limit=DEFAULT_LIMIT, tokens=None):
+        if aiohttp is None:
+            raise RuntimeError('aiohttp is required for AsyncMediaStorage.')
+        # the token cache only holds the AuthClient weakly: keep it alive
+        self.__aclient = aclient
+        if tokens is None:
+            tokens = TokenCache.for_client(aclient)
+        self.__tokens = tokens
+        self.__endpoint = endpoint
+        self.__chunk_size = chunk_size
+        self.__limit = limit
+        self.__session = session
+        self.__own_session = session is None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """close the session if this client created it"""
+        if self.__own_session and self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    def __get_session(self):
+        if self.__session is None:
+            connector = aiohttp.TCPConnector(limit=self.__limit)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def __create_headers(self, options=None):
+        token = self.__tokens.peek()
+        if token is None:
+            # refreshing may call the auth server; keep it off the event loop
+            loop = asyncio.get_event_loop()
+            token = await loop.run_in_executor(None, self.__tokens.get)
+        headers = {
+            'Authorization': 'Bearer ' + token
+        }
+        if options is not None:
+            headers.update(options)
+        return headers
+
+    async def __request(self, method, path, **kwargs):
+        """send a request and return the unread response; the caller must release it"""
+        if 'headers' not in kwargs:
+            kwargs['headers'] = await self.__create_headers()
+        res = await self.__get_session().request(method, self.__endpoint + path, **kwargs)
+        try:
+            res.raise_for_status()
+        except aiohttp.ClientResponseError:
+            res.release()
+            raise
+        return res
+
+    async def __read_text(self, method, path, **kwargs):
+        res = await self.__request(method, path, **kwargs)
+        async with res:
+            return await res.text()
+
+    async def __get_json(self, path, **kwargs):
+        return _parse_json(await self.__read_text('get', path, **kwargs))
+
+    async def connect(self):
+        """connect to server"""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.__tokens.connect, _SCOPE)
+
+    async def upload(self, save_path):
+        """upload media"""
+        headers = await self.__create_headers({
+            'Content-Type': 'image/jpeg'
+        })
+        with open(save_path, 'rb') as payload:
+            text = await self.__read_text('post', _MEDIA_ROOT_PATH, headers=headers, data=payload)
+        return _parse_json(text)
+
+    async def download(self, mid):
+        """download media"""
+        res = await self.__request('get', _CONTENT_PATH.format(mid=mid))
+        async with res:
+            return await res.read()
+
+    def iter_download(self, mid, chunk_size=None):
+        """download media as an async iterator of byte chunks
+
+        await aclose() on it, or use it in async with, when the download
+        may stop early.
+        """
+        return _ChunkIterator(lambda: self.__request('get', _CONTENT_PATH.format(mid=mid)),
+                              chunk_size or self.__chunk_size)
+
+    async def download_to(self, mid, path, chunk_size=None):
+        """download and save media"""
+        chunks = self.iter_download(mid, chunk_size)
+        try:
+            with open(path, 'wb') as ofile:
+                async for chunk in chunks:
+                    ofile.write(chunk)
+        finally:
+            await chunks.aclose()
+
+    async def list(self, params=None):
+        """list media"""
+        if params is None:
+            return await self.__get_json(_MEDIA_ROOT_PATH)
+        if 'filter' not in params:
+            return await self.__get_json(_MEDIA_ROOT_PATH, params=params)
+        text = await self.__read_text('post', _SEARCH_PATH, data=_search_payload(params))
+        return _parse_json(text)
+
+    def iter_media(self, query=None, page_size=DEFAULT_PAGE_SIZE):
+        """iterate over media ids, fetching pages lazily"""
+        if page_size < 1:
+            raise ValueError('page_size must be greater than or equal to 1.')
+        params = {'limit': page_size}
+        if query is not None:
+            params['filter'] = query
+        return _MediaIterator(self.list, params, page_size)
+
+    async def delete(self, mid):
+        """delete media"""
+        await self.__read_text('delete', _MEDIA_PATH.format(mid=mid))
+
+    async def info(self, mid):
+        """get media info"""
+        return await self.__get_json(_MEDIA_PATH.format(mid=mid))
+
+    async def meta(self, mid, scope=None):
+        """get media meta"""
+        path, is_json = _meta_path(mid, scope)
+        text = await self.__read_text('get', path)
+        return _parse_json(text) if is_json else text
+
+    async def add_meta(self, mid, meta):
+        """add media meta
+
+        every key and value is validated before any request is sent.
+        """
+        items = _user_meta_items(meta)
+        base_path = _USER_META_PATH.format(mid=mid) + '/'
+        headers = await self.__create_headers({
+            'Content-Type': 'text/plain'
+        })
+        await asyncio.gather(*[
+            self.__read_text('put', base_path + key, headers=headers, data=data)
+            for key, data in items
+        ])
+
+    async def remove_meta(self, mid, scope):
+        """remove media meta"""
+        await self.__read_text('delete', _remove_meta_path(mid, scope))
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Bounded parallel execution for bulk Media Storage operations
+"""
+
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .scheduler import RateLimiter
+
+DEFAULT_MAX_WORKERS = 4
+
+class BulkResult(namedtuple('BulkResult', ['key', 'value', 'error'])):
+    """result of one item of a bulk operation
+
+    key is the input item, value the result of the call (None on failure)
+    and error the exception raised for that item (None on success).
+    """
+    __slots__ = ()
+
+class DownloadStatus(namedtuple('DownloadStatus',
+                                ['path', 'size', 'received', 'elapsed', 'resumed'])):
+    """status of a completed download
+
+    size is the final file size, received the bytes transferred by this
+    call (less than size when a partial file was resumed) and elapsed the
+    transfer time in seconds.
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """transfer rate in bytes/sec"""
+        if self.elapsed <= 0:
+            return float(self.received)
+        return self.received / self.elapsed
+
+class BulkReport(object):
+    """outcome of a bulk delete or meta removal
+
+    succeeded and not_found list media ids, failed maps media ids to the
+    raised exception.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.not_found = []
+        self.failed = {}
+
+    def __repr__(self):
+        return 'BulkReport(succeeded={0}, not_found={1}, failed={2})'.format(
+            len(self.succeeded), len(self.not_found), len(self.failed))
+
+def _limited(func, limiter):
+    def call(item):
+        """call func once a token is available"""
+        limiter.acquire()
+        return func(item)
+    return call
+
+def run_bulk(func, items, max_workers=DEFAULT_MAX_WORKERS, rate=None):
+    """call func(item) for each item in parallel and yield BulkResult in completion order
+
+    items may be any iterable, including a lazy generator; at most
+    2 * max_workers calls are queued at a time so memory stays bounded.
+    An exception raised by func is reported in its result and does not
+    stop the remaining items. rate (calls/sec or a RateLimiter) limits
+    how fast calls are started.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than or equal to 1.')
+    if rate is not None:
+        func = _limited(func, rate if isinstance(rate, RateLimiter) else RateLimiter(rate))
+    items = iter(items)
+    window = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, item)] = item
+            if not pending:
+                break
+            done, dummy = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    yield BulkResult(item, future.result(), None)
+                else:
+                    yield BulkResult(item, None, error)
+
+def run_shared(executor, func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """call func(item) for each item on a shared executor and return when all are done
+
+    at most max_workers calls run at a time, one of them in the calling
+    thread. helpers that have not started when the items run out are
+    cancelled, so a call from a thread of the same executor cannot
+    deadlock. the first exception raised by func stops the remaining
+    items and is raised again.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than or equal to 1.')
+    items = iter(items)
+    lock = threading.Lock()
+    errors = []
+
+    def drain():
+        """call func on items until they run out or a call fails"""
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            try:
+                func(item)
+            except Exception as exc: # pylint: disable=broad-except
+                with lock:
+                    errors.append(exc)
+                return
+
+    helpers = [executor.submit(drain) for dummy in range(max_workers - 1)]
+    drain()
+    for helper in helpers:
+        if not helper.cancel():
+            helper.result()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Client-side cache for Media Storage info and meta responses
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+class SqliteCacheBackend(object):
+    """persistent second-level cache stored in a local sqlite file"""
+
+    def __init__(self, path):
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        with self.__conn:
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'mid TEXT NOT NULL, scope TEXT NOT NULL, value TEXT NOT NULL, '
+                'expires REAL NOT NULL, PRIMARY KEY (mid, scope))')
+
+    def get(self, mid, scope):
+        """return (value, expires) or None"""
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT value, expires FROM cache WHERE mid = ? AND scope = ?',
+                (mid, scope)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, mid, scope, value, expires):
+        """store value until expires"""
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO cache (mid, scope, value, expires) VALUES (?, ?, ?, ?)',
+                (mid, scope, json.dumps(value), expires))
+
+    def discard(self, mid, scope=None):
+        """remove one entry, or every entry of mid when scope is None"""
+        with self.__lock, self.__conn:
+            if scope is None:
+                self.__conn.execute('DELETE FROM cache WHERE mid = ?', (mid,))
+            else:
+                self.__conn.execute('DELETE FROM cache WHERE mid = ? AND scope = ?', (mid, scope))
+
+    def clear(self):
+        """remove every entry"""
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM cache')
+
+    def close(self):
+        """close the database"""
+        with self.__lock:
+            self.__conn.close()
+
+class MetaCache(object):
+    """thread-safe LRU cache with TTL keyed by (mid, scope)
+
+    values returned by get are shared with the cache and must not be
+    modified. an optional backend such as SqliteCacheBackend keeps entries
+    across process restarts.
+
+    invalidate() changes the generation of mid. a value fetched after
+    reading generation(mid) is passed to set() with it, and is dropped if
+    mid was invalidated during the fetch. the generations of the maxsize
+    most recently invalidated mids are kept; older ones fall back to a
+    common floor, which only causes extra misses.
+    """
+    DEFAULT_MAXSIZE = 1024
+    DEFAULT_TTL = 60
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, backend=None):
+        if maxsize < 1:
+            raise ValueError('maxsize must be greater than or equal to 1.')
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__backend = backend
+        self.__lock = threading.Lock()
+        self.__write_lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__scopes = {}
+        self.__epoch = 0
+        self.__floor = 0
+        self.__generations = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def __drop(self, key):
+        del self.__entries[key]
+        scopes = self.__scopes[key[0]]
+        scopes.discard(key[1])
+        if not scopes:
+            del self.__scopes[key[0]]
+
+    def __store(self, key, value, expires):
+        if key in self.__entries:
+            self.__drop(key)
+        self.__entries[key] = (value, expires)
+        self.__scopes.setdefault(key[0], set()).add(key[1])
+        while len(self.__entries) > self.__maxsize:
+            self.__drop(next(iter(self.__entries)))
+            self.__evictions += 1
+
+    def __generation(self, mid):
+        return self.__generations.get(mid, self.__floor)
+
+    def generation(self, mid):
+        """return the generation of mid, to pass to set() after a fetch"""
+        with self.__lock:
+            return self.__generation(mid)
+
+    def get(self, mid, scope):
+        """return the cached value or None"""
+        key = (mid, scope)
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.__entries.move_to_end(key)
+                    self.__hits += 1
+                    return entry[0]
+                self.__drop(key)
+            generation = self.__generation(mid)
+        entry = self.__backend.get(mid, scope) if self.__backend is not None else None
+        with self.__lock:
+            if entry is not None and entry[1] > now:
+                if generation == self.__generation(mid):
+                    self.__store(key, entry[0], entry[1])
+                self.__hits += 1
+                return entry[0]
+            self.__misses += 1
+        return None
+
+    def set(self, mid, scope, value, generation=None):
+        """cache value for ttl seconds
+
+        with generation, value is dropped if mid was invalidated since
+        generation(mid) returned it.
+        """
+        expires = time.time() + self.__ttl
+        with self.__write_lock:
+            with self.__lock:
+                if generation is not None and generation != self.__generation(mid):
+                    return
+                self.__store((mid, scope), value, expires)
+            if self.__backend is not None:
+                self.__backend.set(mid, scope, value, expires)
+
+    def invalidate(self, mid):
+        """remove every entry of mid"""
+        with self.__write_lock:
+            with self.__lock:
+                for scope in list(self.__scopes.get(mid, ())):
+                    self.__drop((mid, scope))
+                self.__epoch += 1
+                self.__generations.pop(mid, None)
+                self.__generations[mid] = self.__epoch
+                while len(self.__generations) > self.__maxsize:
+                    self.__floor = self.__generations.popitem(last=False)[1]
+            if self.__backend is not None:
+                self.__backend.discard(mid)
+
+    def clear(self):
+        """remove every entry"""
+        with self.__write_lock:
+            with self.__lock:
+                self.__entries.clear()
+                self.__scopes.clear()
+                self.__epoch += 1
+                self.__generations.clear()
+                self.__floor = self.__epoch
+            if self.__backend is not None:
+                self.__backend.clear()
+
+    def stats(self):
+        """return hit/miss/eviction counters"""
+        with self.__lock:
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'evictions': self.__evictions,
+                'size': len(self.__entries),
+            }
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""media storage directory sync command"""
+from __future__ import print_function
+import argparse
+import json
+import sys
+from ricohapi.auth.client import AuthClient
+from .client import MediaStorage
+from .bulk import DEFAULT_MAX_WORKERS
+from .sync import DirectorySync
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='mstorage-sync',
+        description='Mirror a local directory to or from RICOH Media Storage.')
+    parser.add_argument('direction', choices=['push', 'pull'],
+                        help='push uploads local changes, pull downloads new media')
+    parser.add_argument('directory', help='local directory')
+    parser.add_argument('--config', default='./config.json',
+                        help='credentials file with CLIENT_ID, CLIENT_SECRET, USER and PASS')
+    parser.add_argument('--manifest', default=None,
+                        help='state file (default: <directory>/.mstorage-sync.db)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help='concurrent transfers')
+    parser.add_argument('--delete', action='store_true',
+                        help='also delete what was removed on the other side')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """main"""
+    args = _parse_args(argv)
+    with open(args.config, 'r') as settings:
+        config = json.load(settings)
+
+    aclient = AuthClient(config['CLIENT_ID'], config['CLIENT_SECRET'])
+    aclient.set_resource_owner_creds(config['USER'], config['PASS'])
+    mstorage = MediaStorage(aclient)
+    mstorage.connect()
+
+    syncer = DirectorySync(mstorage, args.directory, args.manifest, args.workers)
+    if args.direction == 'push':
+        report = syncer.push(delete=args.delete)
+    else:
+        report = syncer.pull(delete=args.delete)
+    for path, error in sorted(report.failed.items()):
+        print('failed: {0}: {1}'.format(path, error), file=sys.stderr)
+    print(report)
+    return 1 if report.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
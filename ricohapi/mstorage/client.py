@@ -6,91 +6,519 @@ RICOH Media Storage
 """
 
 import json
+import logging
+import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import six
 from ricohapi.auth.client import AuthClient
+try:
+    import orjson as _json_impl
+except ImportError:
+    try:
+        import ujson as _json_impl
+    except ImportError:
+        _json_impl = json
+from .pool import SessionPool
+from .token import TokenCache
+from .metrics import RequestEvent
+from .dedup import hash_source, _fspath
+from .bulk import run_bulk, run_shared, BulkReport, DownloadStatus, DEFAULT_MAX_WORKERS
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PAGE_SIZE = 100
+
+_ENDPOINT = 'https://mss.ricohapi.com/v1'
+_MEDIA_ROOT_PATH = '/media'
+_SEARCH_PATH = '/media/search'
+_MEDIA_PATH = '/media/{mid}'
+_CONTENT_PATH = '/media/{mid}/content'
+_META_PATH = '/media/{mid}/meta'
+_USER_META_PATH = '/media/{mid}/meta/user'
+_SCOPE = AuthClient.SCOPES['MStorage']
+_USER_KEY_RE = re.compile(r'^user\.([A-Za-z0-9_\-]{1,256})$')
+_META_SCOPES = frozenset(['exif', 'gpano', 'user'])
+_SEARCH_VERSION = '2016-07-08'
+_DEFAULT_CONTENT_TYPE = 'image/jpeg'
+_SNIFF_SIZE = 12
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+_replace = getattr(os, 'replace', os.rename)
+_timer = getattr(time, 'perf_counter', time.time)
+_logger = logging.getLogger(__name__)
+
+def _parse_json(data):
+    """decode a JSON body given as bytes or text, with orjson or ujson when installed"""
+    try:
+        if _json_impl is json and isinstance(data, (six.binary_type, bytearray)):
+            data = data.decode('utf-8') # json.loads accepts bytes only from Python 3.6
+        ret = _json_impl.loads(data)
+    except (TypeError, ValueError):
+        raise ValueError('An invalid response was received from the server.')
+    return ret
+
+def _id_or_object(pairs):
+    """reduce a JSON object with an id to that id as soon as it is decoded"""
+    for key, value in pairs:
+        if key == 'id':
+            return value
+    return dict(pairs)
+
+_ID_DECODER = json.JSONDecoder(object_pairs_hook=_id_or_object)
+
+def _parse_ids(data):
+    """decode a media listing into {'media': [id, ...], 'paging': {...}}
+
+    each media object is replaced by its id while decoding, so the dict
+    tree of the whole page is never built. the stdlib decoder is used
+    even when orjson or ujson is installed, as they take no object hook.
+    """
+    try:
+        if isinstance(data, (six.binary_type, bytearray)):
+            data = data.decode('utf-8')
+        page = _ID_DECODER.decode(data)
+    except (TypeError, ValueError):
+        raise ValueError('An invalid response was received from the server.')
+    if not isinstance(page, dict):
+        raise ValueError('An invalid response was received from the server.')
+    return page
+
+class MediaPage(object):
+    """one page of a media listing, parsed on first access
+
+    only the media ids and the paging object are decoded; the per-media
+    objects are reduced to their ids while parsing, and the response
+    body is released once parsed.
+    """
+    __slots__ = ('__body', '__ids', '__paging')
+
+    def __init__(self, body):
+        self.__body = body
+        self.__ids = None
+        self.__paging = None
+
+    def __parse(self):
+        if self.__ids is None:
+            page = _parse_ids(self.__body)
+            self.__ids = tuple(page.get('media', []))
+            self.__paging = page.get('paging') or {}
+            self.__body = None
+
+    @property
+    def ids(self):
+        """media ids of the page, in listing order"""
+        self.__parse()
+        return self.__ids
+
+    @property
+    def paging(self):
+        """paging object sent by the server"""
+        self.__parse()
+        return self.__paging
+
+    @property
+    def after(self):
+        """cursor of the next page, or None for an empty page"""
+        ids = self.ids
+        return ids[-1] if ids else None
+
+    @property
+    def before(self):
+        """cursor of the previous page, or None for an empty page"""
+        ids = self.ids
+        return ids[0] if ids else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+def _encode_to_utf8_bytes(text):
+    error = False
+    if isinstance(text, six.text_type): # unicode
+        data = text.encode('utf-8')
+    elif isinstance(text, six.binary_type): # binary
+        data = text
+        try:
+            data.decode('utf-8', 'strict') # only check (utf-8 binary are allowed)
+        except UnicodeError:
+            error = True
+    else:
+        error = True
+    if error:
+        msg = 'Only unicode string or utf-8 binary are allowed.'
+        raise ValueError(msg)
+    return data
+
+def _user_meta_items(meta):
+    """validate user meta and return a list of (key, utf-8 value)"""
+    max_count = 10
+    min_len = 1
+    max_len = 1024
+    if len(meta) > max_count:
+        raise ValueError('Number of meta must be less than or equal to {0}.'.format(max_count))
+
+    items = []
+    for key, value in meta.items():
+        match = _USER_KEY_RE.match(key)
+        if not match:
+            raise ValueError('Key {0} is invalid.'.format(key))
+
+        data = _encode_to_utf8_bytes(value)
+        if len(data) < min_len or len(data) > max_len:
+            raise ValueError('Value bytes length must be {0}-{1}.'.format(min_len, max_len))
+
+        items.append((match.group(1), data))
+    return items
+
+def _sniff_content_type(head):
+    """return the content type of JPEG/PNG/MP4 leading bytes, or None"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[4:8] == b'ftyp':
+        return 'video/mp4'
+    return None
+
+class _BufferReader(object):
+    """read-only file object over a memoryview, sent without copying the whole buffer"""
+
+    def __init__(self, view):
+        self.__view = view
+        self.__position = 0
+
+    def __len__(self):
+        return len(self.__view)
+
+    def read(self, size=-1):
+        """read up to size bytes"""
+        start = self.__position
+        end = len(self.__view) if size is None or size < 0 else min(start + size, len(self.__view))
+        self.__position = end
+        return self.__view[start:end].tobytes()
+
+    def tell(self):
+        """return the current position"""
+        return self.__position
+
+    def seek(self, position, whence=0):
+        """move the current position"""
+        if whence == 1:
+            position += self.__position
+        elif whence == 2:
+            position += len(self.__view)
+        self.__position = max(0, min(position, len(self.__view)))
+        return self.__position
+
+def _chain(head, chunks):
+    yield head
+    for chunk in chunks:
+        yield chunk
+
+def _read_chunks(fileobj):
+    while True:
+        chunk = fileobj.read(_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+def _upload_body(source):
+    """return (request body, leading bytes) of an upload source"""
+    if isinstance(source, six.binary_type):
+        return source, source[:_SNIFF_SIZE]
+    if isinstance(source, (bytearray, memoryview)):
+        view = memoryview(source)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        return _BufferReader(view), view[:_SNIFF_SIZE].tobytes()
+    if hasattr(source, 'read'):
+        try:
+            position = source.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            position = None
+        head = source.read(_SNIFF_SIZE)
+        if position is not None:
+            try:
+                source.seek(position)
+                return source, head
+            except (AttributeError, IOError, OSError, ValueError):
+                pass
+        return _chain(head, _read_chunks(source)), head # not seekable, send chunked
+    chunks = iter(source)
+    head = next(chunks, b'')
+    return _chain(head, chunks), head[:_SNIFF_SIZE]
+
+def _path_template(path):
+    """return the template of a request path, e.g. /media/{mid}/meta/user/{key}"""
+    parts = path.split('/')
+    if len(parts) > 2 and path != _SEARCH_PATH:
+        parts[2] = '{mid}'
+    if len(parts) > 5 and parts[4] == 'user':
+        parts[5] = '{key}'
+    return '/'.join(parts)
+
+def _content_length(headers):
+    try:
+        return int(headers['Content-Length'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _meta_path(mid, scope):
+    """return (path, is_json) of a meta scope"""
+    if scope is None:
+        return _META_PATH.format(mid=mid), True
+    if scope in _META_SCOPES:
+        return _META_PATH.format(mid=mid) + '/' + scope, True
+    match = _USER_KEY_RE.match(scope)
+    if not match:
+        raise ValueError('Argument {0} is invalid.'.format(scope))
+    return _USER_META_PATH.format(mid=mid) + '/' + match.group(1), False
+
+def _remove_meta_path(mid, scope):
+    """return the path removing a user meta scope"""
+    path = _USER_META_PATH.format(mid=mid)
+    if scope != 'user':
+        match = _USER_KEY_RE.match(scope)
+        if match:
+            path += '/' + match.group(1)
+        else:
+            raise ValueError('Argument {0} is invalid.'.format(scope))
+    return path
+
+def _search_payload(params):
+    """return the POST /media/search body of list params"""
+    payload = {
+        'search_version': _SEARCH_VERSION,
+        'query': params['filter']
+    }
+    paging = {}
+    if 'after' in params:
+        paging['after'] = params['after']
+    if 'before' in params:
+        paging['before'] = params['before']
+    if 'limit' in params:
+        paging['limit'] = params['limit']
+    if len(paging) != 0:
+        payload['paging'] = paging
+    return json.dumps(payload)
 
 class MediaStorage(object):
     """media storage"""
-    __ENDPOINT = 'https://mss.ricohapi.com/v1'
-    __MEDIA_ROOT_PATH = '/media'
-    __SEARCH_PATH = '/media/search'
-    __MEDIA_PATH = '/media/{mid}'
-    __CONTENT_PATH = '/media/{mid}/content'
-    __META_PATH = '/media/{mid}/meta'
-    __USER_META_PATH = '/media/{mid}/meta/user'
-    __SCOPE = AuthClient.SCOPES['MStorage']
-    __USER_KEY_RE = re.compile(r'^user\.([A-Za-z0-9_\-]{1,256})$')
-
-    def __init__(self, aclient):
+    __PART_SUFFIX = '.part'
+    __RESUME_ATTEMPTS = 3
+
+    def __init__(self, aclient, pool=None, chunk_size=DEFAULT_CHUNK_SIZE, cache=None, tokens=None,
+                 endpoint=_ENDPOINT, hooks=None, hash_index=None, hash_meta_key=None):
+        if hash_meta_key is not None and not _USER_KEY_RE.match(hash_meta_key):
+            raise ValueError('Key {0} is invalid.'.format(hash_meta_key))
+        # unused otherwise, but the token cache only holds the AuthClient
+        # weakly: this reference keeps it alive as long as the client
         self.__aclient = aclient
+        self.__hash_index = hash_index
+        self.__hash_meta_key = hash_meta_key
+        self.__endpoint = endpoint
+        self.__hooks = list(hooks or [])
+        if tokens is None:
+            tokens = TokenCache.for_client(aclient)
+        self.__tokens = tokens
+        self.__chunk_size = chunk_size
+        self.__cache = cache
+        if pool is None:
+            pool = SessionPool.for_client(aclient)
+        self.__pool = pool
+
+    @property
+    def pool(self):
+        """connection pool used by this client"""
+        return self.__pool
+
+    def add_hook(self, hook):
+        """register a callable receiving a RequestEvent after each request"""
+        self.__hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """unregister a hook"""
+        self.__hooks.remove(hook)
+
+    @property
+    def cache(self):
+        """metadata cache used by this client, or None"""
+        return self.__cache
+
+    def __cached(self, mid, scope, fetch, *args):
+        if self.__cache is None:
+            return fetch(*args)
+        generation = self.__cache.generation(mid)
+        ret = self.__cache.get(mid, scope)
+        if ret is None:
+            ret = fetch(*args)
+            self.__cache.set(mid, scope, ret, generation)
+        return ret
+
+    def __invalidate(self, mid):
+        if self.__cache is not None:
+            self.__cache.invalidate(mid)
 
-    def __create_headers(self, options=None):
+    def __create_headers(self, options=None, fresh=False):
         headers = {
-            'Authorization': 'Bearer ' + self.__aclient.get_access_token()
+            'Authorization': 'Bearer ' + self.__tokens.get(fresh)
         }
         if options is not None:
             headers.update(options)
         return headers
 
+    @staticmethod
+    def __rewind(data):
+        """return a callable restoring data for a resend, or None if it cannot be resent"""
+        if data is None or isinstance(data, (six.binary_type, six.text_type)):
+            return lambda: None
+        if hasattr(data, 'seek') and hasattr(data, 'tell'):
+            try:
+                position = data.tell()
+            except (IOError, OSError):
+                return None
+            return lambda: data.seek(position)
+        return None
+
+    def __emit(self, method, path, kwargs, attempts, res, error, duration):
+        retries = max(len(attempts) - 1, 0)
+        status = None
+        bytes_in = None
+        if res is not None:
+            status = res.status_code
+            bytes_in = _content_length(res.headers)
+            history = getattr(getattr(res.raw, 'retries', None), 'history', None)
+            if isinstance(history, tuple):
+                retries += len(history)
+        data = kwargs.get('data')
+        if isinstance(data, (six.binary_type, six.text_type)) or hasattr(data, '__len__'):
+            bytes_out = len(data)
+        elif res is not None and getattr(res, 'request', None) is not None:
+            bytes_out = _content_length(res.request.headers)
+        else:
+            bytes_out = None
+        event = RequestEvent(method, _path_template(path), status, bytes_in, bytes_out,
+                             duration, retries, error)
+        for hook in self.__hooks:
+            try:
+                hook(event)
+            except Exception: # pylint: disable=broad-except
+                _logger.exception('Request hook %r failed.', hook)
+
     def __request(self, method, path, **kwargs):
-        url = MediaStorage.__ENDPOINT + path
         if 'headers' not in kwargs:
             kwargs['headers'] = self.__create_headers()
+        if not self.__hooks:
+            return self.__send(method, path, kwargs)
+        attempts = []
+        res = None
+        error = None
+        started = _timer()
         try:
-            res = requests.request(method, url, **kwargs)
-            res.raise_for_status()
-        except requests.exceptions.RequestException:
+            res = self.__send(method, path, kwargs, attempts)
+            return res
+        except requests.exceptions.RequestException as exc:
+            error = exc
+            res = exc.response
             raise
-        return res
+        finally:
+            self.__emit(method, path, kwargs, attempts, res, error, _timer() - started)
 
-    @staticmethod
-    def __parse_json(text):
-        try:
-            ret = json.loads(text)
-        except ValueError:
-            raise ValueError('An invalid response was received from the server.')
-        return ret
+    def __send(self, method, path, kwargs, attempts=None):
+        url = self.__endpoint + path
+        rewind = MediaStorage.__rewind(kwargs.get('data'))
+        scheduler = self.__pool.scheduler
+
+        def send():
+            """send once over the pool"""
+            if attempts is not None:
+                attempts.append(None)
+            return self.__pool.request(method, url, **kwargs)
+
+        res = scheduler.call(method, send, rewind)
+        if res.status_code == 401 and rewind is not None:
+            # the token expired or was revoked: open a new session once and resend
+            token = self.__tokens.renew(kwargs['headers']['Authorization'][len('Bearer '):], _SCOPE)
+            res.close()
+            rewind()
+            kwargs['headers'] = dict(kwargs['headers'], Authorization='Bearer ' + token)
+            res = scheduler.call(method, send, rewind)
+        res.raise_for_status()
+        return res
 
     def __get_json(self, path, **kwargs):
         res = self.__request('get', path, **kwargs)
-        return MediaStorage.__parse_json(res.text)
-
-    @staticmethod
-    def __encode_to_utf8_bytes(text):
-        error = False
-        if isinstance(text, six.text_type): # unicode
-            data = text.encode('utf-8')
-        elif isinstance(text, six.binary_type): # binary
-            data = text
-            try:
-                data.decode('utf-8', 'strict') # only check (utf-8 binary are allowed)
-            except UnicodeError:
-                error = True
-        else:
-            error = True
-        if error:
-            msg = 'Only unicode string or utf-8 binary are allowed.'
-            raise ValueError(msg)
-        return data
+        return _parse_json(res.content)
 
     def connect(self):
         """connect to server"""
-        self.__aclient.session(MediaStorage.__SCOPE)
+        self.__tokens.connect(_SCOPE)
 
-    def upload(self, save_path):
-        """upload media"""
-        path = MediaStorage.__MEDIA_ROOT_PATH
+    def __upload(self, source, content_type):
+        data, head = _upload_body(source)
+        # a body that cannot be resent after a 401 gets a token checked by the AuthClient
         headers = self.__create_headers({
-            'Content-Type': 'image/jpeg'
-        })
-        with open(save_path, 'rb') as payload:
-            res = self.__request('post', path, headers=headers, data=payload)
-        return MediaStorage.__parse_json(res.text)
+            'Content-Type': content_type or _sniff_content_type(head) or _DEFAULT_CONTENT_TYPE
+        }, fresh=MediaStorage.__rewind(data) is None)
+        res = self.__request('post', _MEDIA_ROOT_PATH, headers=headers, data=data)
+        return _parse_json(res.content)
+
+    def __upload_source(self, source, content_type):
+        path = _fspath(source)
+        if path is not None:
+            with open(path, 'rb') as payload:
+                return self.__upload(payload, content_type)
+        return self.__upload(source, content_type)
+
+    def __upload_dedup(self, source, content_type):
+        digest, body = hash_source(source, self.__hash_index)
+        mid = self.__hash_index.lookup(digest)
+        if mid is not None:
+            try:
+                # bypass the cache: the media may have been deleted by another client
+                return self.__get_json(_MEDIA_PATH.format(mid=mid))
+            except requests.exceptions.HTTPError as error:
+                if error.response is None or error.response.status_code != 404:
+                    raise
+                self.__hash_index.discard_media(mid) # deleted on the server
+        ret = self.__upload_source(body, content_type)
+        self.__hash_index.add(digest, ret['id'])
+        if self.__hash_meta_key is not None:
+            self.add_meta(ret['id'], {self.__hash_meta_key: digest})
+        return ret
+
+    def upload(self, source, content_type=None):
+        """upload media
+
+        source is a file path, bytes, a bytearray or memoryview, a readable
+        file object or an iterable of byte chunks (sent with chunked
+        transfer encoding). unless content_type is given, it is detected
+        from JPEG/PNG/MP4 signatures and defaults to image/jpeg.
+
+        with a hash_index, content already uploaded is not sent again and
+        the info of the existing media is returned instead.
+        """
+        if self.__hash_index is not None:
+            return self.__upload_dedup(source, content_type)
+        return self.__upload_source(source, content_type)
+
+    def upload_many(self, sources, max_workers=DEFAULT_MAX_WORKERS, content_type=None):
+        """upload media in parallel
+
+        sources are any values accepted by upload.
+        yields BulkResult(source, media_id, error) in completion order
+        """
+        def upload_one(source):
+            """upload a single media and return its media id"""
+            return self.upload(source, content_type)['id']
+        return run_bulk(upload_one, sources, max_workers)
 
     def __download(self, mid, **kwargs):
-        path = MediaStorage.__CONTENT_PATH.format(mid=mid)
+        path = _CONTENT_PATH.format(mid=mid)
         res = self.__request('get', path, **kwargs)
         return res
 
@@ -99,97 +527,323 @@ class MediaStorage(object):
         res = self.__download(mid)
         return res.content
 
-    def download_to(self, mid, path):
+    def __iter_chunks(self, res, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = self.__chunk_size
+        try:
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            res.close()
+
+    def download_to(self, mid, path, chunk_size=None):
         """download and save media"""
         res = self.__download(mid, stream=True)
         with open(path, 'wb') as ofile:
-            for chunk in res.iter_content(chunk_size=1024):
+            for chunk in self.__iter_chunks(res, chunk_size):
                 ofile.write(chunk)
 
-    def list(self, params=None):
-        """list media"""
+    def download_into(self, mid, target, chunk_size=None):
+        """download media into a writable buffer or file object
+
+        target is a bytearray, a writable memoryview or any object with a
+        write method. returns the number of bytes written.
+        """
+        res = self.__download(mid, stream=True)
+        chunks = self.__iter_chunks(res, chunk_size)
+        size = 0
+        if hasattr(target, 'write'):
+            for chunk in chunks:
+                target.write(chunk)
+                size += len(chunk)
+            return size
+        view = memoryview(target)
+        if view.readonly:
+            res.close()
+            raise ValueError('Buffer must be writable.')
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        for chunk in chunks:
+            end = size + len(chunk)
+            if end > len(view):
+                chunks.close()
+                raise ValueError('Buffer is too small for media {0}.'.format(mid))
+            view[size:end] = chunk
+            size = end
+        return size
+
+    def iter_download(self, mid, chunk_size=None):
+        """download media as an iterator of byte chunks"""
+        res = self.__download(mid, stream=True)
+        return self.__iter_chunks(res, chunk_size)
+
+    def __open_part(self, mid, part_path):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset == 0:
+            return self.__download(mid, stream=True), 'wb'
+        headers = self.__create_headers({
+            'Range': 'bytes={0}-'.format(offset)
+        })
+        try:
+            res = self.__download(mid, headers=headers, stream=True)
+        except requests.exceptions.HTTPError as error:
+            if error.response is None or error.response.status_code != 416:
+                raise
+            os.remove(part_path) # stale partial file
+            return self.__download(mid, stream=True), 'wb'
+        content_range = res.headers.get('Content-Range', '')
+        if res.status_code == 206 and content_range.startswith('bytes {0}-'.format(offset)):
+            return res, 'ab'
+        return res, 'wb' # range ignored by the server, start over
+
+    def __download_resumable(self, mid, path, chunk_size):
+        part_path = path + MediaStorage.__PART_SUFFIX
+        started = time.time()
+        received = 0
+        resumed = False
+        attempt = 0
+        while True:
+            res, mode = self.__open_part(mid, part_path)
+            resumed = resumed or mode == 'ab'
+            try:
+                with open(part_path, mode) as ofile:
+                    for chunk in res.iter_content(chunk_size=chunk_size):
+                        ofile.write(chunk)
+                        received += len(chunk)
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout):
+                attempt += 1
+                if attempt >= MediaStorage.__RESUME_ATTEMPTS:
+                    raise
+            finally:
+                res.close()
+        _replace(part_path, path)
+        return DownloadStatus(path, os.path.getsize(path), received, time.time() - started, resumed)
+
+    def download_many(self, mids, dest_dir, max_workers=DEFAULT_MAX_WORKERS, chunk_size=None):
+        """download media in parallel into dest_dir
+
+        each media is written to <dest_dir>/<mid>.part and renamed to
+        <dest_dir>/<mid> once complete. An interrupted transfer is resumed
+        with a Range request, by a retry or by a later call.
+        yields BulkResult(mid, DownloadStatus, error) in completion order
+        """
+        def download_one(mid):
+            """download a single media"""
+            return self.__download_resumable(mid, os.path.join(dest_dir, mid),
+                                             chunk_size or self.__chunk_size)
+        return run_bulk(download_one, mids, max_workers)
+
+    def list(self, params=None, lazy=False):
+        """list media
+
+        with lazy, a MediaPage exposing only the ids and paging cursors
+        is returned instead of the decoded response.
+        """
         if params is None:
-            ret = self.__get_json(MediaStorage.__MEDIA_ROOT_PATH)
+            res = self.__request('get', _MEDIA_ROOT_PATH)
         elif not 'filter' in params:
-            ret = self.__get_json(MediaStorage.__MEDIA_ROOT_PATH, params=params)
+            res = self.__request('get', _MEDIA_ROOT_PATH, params=params)
         else:
-            payload = {
-                'search_version': '2016-07-08',
-                'query': params['filter']
-            }
-            paging = {}
-            if 'after' in params:
-                paging['after'] = params['after']
-            if 'before' in params:
-                paging['before'] = params['before']
-            if 'limit' in params:
-                paging['limit'] = params['limit']
-            if len(paging) != 0:
-                payload['paging'] = paging
-            res = self.__request('post', MediaStorage.__SEARCH_PATH, data=json.dumps(payload))
-            ret = MediaStorage.__parse_json(res.text)
-        return ret
+            res = self.__request('post', _SEARCH_PATH, data=_search_payload(params))
+        if lazy:
+            return MediaPage(res.content)
+        return _parse_json(res.content)
+
+    def __list_ids(self, query, after, limit):
+        params = {'limit': limit}
+        if after is not None:
+            params['after'] = after
+        if query is not None:
+            params['filter'] = query
+        return self.list(params, lazy=True).ids
+
+    def __iter_pages(self, query, page_size):
+        after = None
+        while True:
+            ids = self.__list_ids(query, after, page_size)
+            if ids:
+                yield ids
+            if len(ids) < page_size:
+                return
+            after = ids[-1]
+
+    def __iter_pages_prefetch(self, query, page_size):
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            future = executor.submit(self.__list_ids, query, None, page_size)
+            while True:
+                ids = future.result()
+                if len(ids) == page_size:
+                    future = executor.submit(self.__list_ids, query, ids[-1], page_size)
+                else:
+                    future = None
+                if ids:
+                    yield ids
+                if future is None:
+                    return
+        finally:
+            executor.shutdown(wait=True)
+
+    def iter_media(self, query=None, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+        """iterate over media ids, fetching pages lazily
+
+        query is an optional user metadata filter as accepted by
+        list({'filter': ...}). with prefetch, the next page is fetched in
+        the background while the current one is consumed.
+        """
+        if page_size < 1:
+            raise ValueError('page_size must be greater than or equal to 1.')
+        if prefetch:
+            pages = self.__iter_pages_prefetch(query, page_size)
+        else:
+            pages = self.__iter_pages(query, page_size)
+        for ids in pages:
+            for mid in ids:
+                yield mid
 
     def delete(self, mid):
         """delete media meta"""
-        path = MediaStorage.__MEDIA_PATH.format(mid=mid)
-        self.__request('delete', path)
+        path = _MEDIA_PATH.format(mid=mid)
+        try:
+            self.__request('delete', path)
+        finally:
+            self.__invalidate(mid)
+        if self.__hash_index is not None:
+            self.__hash_index.discard_media(mid)
+
+    @staticmethod
+    def __bulk_report(results):
+        report = BulkReport()
+        for result in results:
+            if result.error is None:
+                report.succeeded.append(result.key)
+            elif getattr(result.error, 'response', None) is not None and \
+                    result.error.response.status_code == 404:
+                report.not_found.append(result.key)
+            else:
+                report.failed[result.key] = result.error
+        return report
+
+    def delete_many(self, mids, max_workers=DEFAULT_MAX_WORKERS, rate=None):
+        """delete many media in parallel
+
+        mids may be a lazy stream such as iter_media(query). rate limits
+        the number of requests started per second.
+        returns a BulkReport once every media was processed
+        """
+        return self.__bulk_report(run_bulk(self.delete, mids, max_workers, rate))
 
     def info(self, mid):
         """get media info"""
-        path = MediaStorage.__MEDIA_PATH.format(mid=mid)
-        return self.__get_json(path)
+        path = _MEDIA_PATH.format(mid=mid)
+        return self.__cached(mid, 'info', self.__get_json, path)
 
     def meta(self, mid, scope=None):
         """get media meta"""
-        if scope is None:
-            path = MediaStorage.__META_PATH.format(mid=mid)
-            ret = self.__get_json(path)
-        elif scope in {'exif', 'gpano', 'user'}:
-            path = MediaStorage.__META_PATH.format(mid=mid) + '/' + scope
-            ret = self.__get_json(path)
-        else:
-            match = MediaStorage.__USER_KEY_RE.match(scope)
-            if match:
-                path = MediaStorage.__USER_META_PATH.format(mid=mid) + '/' + match.group(1)
-                ret = self.__request('get', path).text
-            else:
-                raise ValueError('Argument {0} is invalid.'.format(scope))
-        return ret
+        return self.__cached(mid, scope or 'meta', self.__fetch_meta, mid, scope)
+
+    def meta_many(self, mids, scopes=('exif', 'gpano', 'user'), max_workers=DEFAULT_MAX_WORKERS):
+        """get media meta of many media in parallel
 
-    def add_meta(self, mid, meta):
-        """add media meta"""
-        max_count = 10
-        min_len = 1
-        max_len = 1024
-        if len(meta) > max_count:
-            raise ValueError('Number of meta must be less than or equal to {0}.'.format(max_count))
+        scopes is a subset of exif, gpano and user; when all three are
+        requested each media costs a single GET of its whole meta.
+        repeated ids are fetched once.
+        yields BulkResult(mid, {scope: meta}, error) in completion order
+        """
+        scopes = tuple(scopes)
+        if not scopes or not _META_SCOPES.issuperset(scopes):
+            raise ValueError('Argument {0} is invalid.'.format(scopes))
+        whole = _META_SCOPES.issubset(scopes)
 
-        base_path = MediaStorage.__USER_META_PATH.format(mid=mid) + '/'
+        def unique():
+            """yield each media id once"""
+            seen = set()
+            for mid in mids:
+                if mid not in seen:
+                    seen.add(mid)
+                    yield mid
+
+        def fetch(mid):
+            """fetch the requested scopes of a single media"""
+            if whole:
+                return self.meta(mid)
+            return dict((scope, self.meta(mid, scope)) for scope in scopes)
+
+        return run_bulk(fetch, unique(), max_workers)
+
+    def __fetch_meta(self, mid, scope):
+        path, is_json = _meta_path(mid, scope)
+        if is_json:
+            return self.__get_json(path)
+        return self.__request('get', path).text
+
+    def __put_user_meta(self, mid, items, max_workers):
+        base_path = _USER_META_PATH.format(mid=mid) + '/'
         headers = self.__create_headers({
             'Content-Type': 'text/plain'
         })
 
-        for key, value in meta.items():
-            match = MediaStorage.__USER_KEY_RE.match(key)
-            if match:
-                path = base_path + match.group(1)
+        def put(item):
+            """put a single user meta"""
+            self.__request('put', base_path + item[0], headers=headers, data=item[1])
+
+        try:
+            if max_workers == 1 or len(items) < 2:
+                for item in items:
+                    put(item)
             else:
-                raise ValueError('Key {0} is invalid.'.format(key))
+                run_shared(self.__pool.executor, put, items, min(max_workers, len(items)))
+        finally:
+            self.__invalidate(mid)
+
+    def add_meta(self, mid, meta, max_workers=DEFAULT_MAX_WORKERS):
+        """add media meta
+
+        every key and value is validated before any request is sent;
+        the PUTs are then issued concurrently.
+        """
+        items = _user_meta_items(meta)
+        self.__put_user_meta(mid, items, max_workers)
 
-            data = MediaStorage.__encode_to_utf8_bytes(value)
-            if len(data) < min_len or len(data) > max_len:
-                raise ValueError('Value bytes length must be {0}-{1}.'.format(min_len, max_len))
+    def add_meta_many(self, metas, max_workers=DEFAULT_MAX_WORKERS):
+        """add media meta to many media in parallel
 
-            self.__request('put', path, headers=headers, data=data)
+        metas maps media ids to meta dicts. all of them are validated
+        before any request is sent.
+        yields BulkResult(mid, None, error) in completion order
+        """
+        batches = [(mid, _user_meta_items(meta)) for mid, meta in metas.items()]
+
+        def add_one(batch):
+            """add the user meta of a single media"""
+            self.__put_user_meta(batch[0], batch[1], 1)
+
+        results = run_bulk(add_one, batches, max_workers)
+        return (result._replace(key=result.key[0]) for result in results)
 
     def remove_meta(self, mid, scope):
         """remove media meta"""
-        path = MediaStorage.__USER_META_PATH.format(mid=mid)
-        if scope != 'user':
-            match = MediaStorage.__USER_KEY_RE.match(scope)
-            if match:
-                path += '/' + match.group(1)
-            else:
-                raise ValueError('Argument {0} is invalid.'.format(scope))
-        self.__request('delete', path)
+        path = _remove_meta_path(mid, scope)
+        try:
+            self.__request('delete', path)
+        finally:
+            self.__invalidate(mid)
+
+    def remove_meta_many(self, mids, scope, max_workers=DEFAULT_MAX_WORKERS, rate=None):
+        """remove the same media meta from many media in parallel
+
+        scope is validated before any request is sent. mids may be a lazy
+        stream such as iter_media(query). rate limits the number of
+        requests started per second.
+        returns a BulkReport once every media was processed
+        """
+        _remove_meta_path('', scope)
+
+        def remove_one(mid):
+            """remove the meta of a single media"""
+            self.remove_meta(mid, scope)
+
+        return self.__bulk_report(run_bulk(remove_one, mids, max_workers, rate))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Content-addressed upload deduplication for RICOH Media Storage
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import six
+
+DEFAULT_MAX_BUFFER = 64 * 1024 * 1024
+_READ_SIZE = 1024 * 1024
+
+class HashIndex(object):
+    """persistent sha256 -> media id index in a local sqlite file
+
+    it also remembers the digest of each uploaded path with its size and
+    mtime, so unchanged files are not hashed again.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        with self.__conn:
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS hashes (digest TEXT PRIMARY KEY, mid TEXT NOT NULL)')
+            self.__conn.execute('CREATE INDEX IF NOT EXISTS hashes_mid ON hashes (mid)')
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+                'digest TEXT NOT NULL)')
+
+    def lookup(self, digest):
+        """return the media id of digest, or None"""
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT mid FROM hashes WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, digest, mid):
+        """record that digest was uploaded as mid"""
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO hashes (digest, mid) VALUES (?, ?)', (digest, mid))
+
+    def discard_media(self, mid):
+        """forget mid, e.g. after it was deleted"""
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM hashes WHERE mid = ?', (mid,))
+
+    def file_digest(self, path, size, mtime):
+        """return the remembered digest of an unchanged file, or None"""
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT digest FROM files WHERE path = ? AND size = ? AND mtime = ?',
+                (path, size, mtime)).fetchone()
+        return row[0] if row is not None else None
+
+    def remember_file(self, path, size, mtime, digest):
+        """remember the digest of a file"""
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime, digest) VALUES (?, ?, ?, ?)',
+                (path, size, mtime, digest))
+
+    def __len__(self):
+        with self.__lock:
+            return self.__conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def rebuild(self, mstorage, key):
+        """add the digests recorded as user meta key on the server
+
+        returns the number of media found with that key.
+        """
+        count = 0
+        for mid in mstorage.iter_media():
+            digest = mstorage.meta(mid, 'user').get(key)
+            if digest:
+                self.add(digest, mid)
+                count += 1
+        return count
+
+    def close(self):
+        """close the database"""
+        with self.__lock:
+            self.__conn.close()
+
+def _hash_into(readinto, buf, digest):
+    """fill buf with readinto while a second thread hashes the previous chunk"""
+    view = memoryview(buf)
+    size = 0
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as hasher:
+        while size < len(view):
+            count = readinto(view[size:size + _READ_SIZE])
+            if not count:
+                break
+            if pending is not None:
+                pending.result()
+            pending = hasher.submit(digest.update, view[size:size + count])
+            size += count
+        if pending is not None:
+            pending.result()
+    return view[:size]
+
+def _hash_file(path, size, max_buffer):
+    """return (digest, body) of a file read once when it fits in max_buffer"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as ifile:
+        if size <= max_buffer:
+            body = _hash_into(ifile.readinto, bytearray(size), digest)
+            return digest.hexdigest(), body
+        for chunk in iter(lambda: ifile.read(_READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest(), path
+
+def _fspath(source):
+    """return an upload source as a path string, or None if it is not a path
+
+    objects with __fspath__ such as pathlib.Path are paths too.
+    """
+    if isinstance(source, six.string_types):
+        return source
+    if hasattr(source, '__fspath__'):
+        return source.__fspath__()
+    return None
+
+def hash_source(source, index=None, max_buffer=DEFAULT_MAX_BUFFER):
+    """return (sha256 hex digest, body to upload) of an upload source
+
+    a file up to max_buffer bytes is read once: it is hashed while being
+    read into memory and the buffer is uploaded. larger files are hashed
+    and then uploaded from their path. streams and chunk iterables are
+    read into memory. with index, the digest of an unchanged path is
+    taken from the index without reading the file.
+    """
+    path = _fspath(source)
+    if path is not None:
+        source = path
+        stat = os.stat(source)
+        path = os.path.abspath(source)
+        if index is not None:
+            digest = index.file_digest(path, stat.st_size, stat.st_mtime)
+            if digest is not None:
+                return digest, source
+        digest, body = _hash_file(source, stat.st_size, max_buffer)
+        if index is not None:
+            index.remember_file(path, stat.st_size, stat.st_mtime, digest)
+        return digest, body
+    if isinstance(source, (six.binary_type, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest(), source
+    if hasattr(source, 'read'):
+        chunks = iter(lambda: source.read(_READ_SIZE), b'')
+    else:
+        chunks = iter(source)
+    digest = hashlib.sha256()
+    body = bytearray()
+    for chunk in chunks:
+        digest.update(chunk)
+        body += chunk
+    return digest.hexdigest(), body
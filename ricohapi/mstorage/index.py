@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Local queryable index of RICOH Media Storage metadata
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from .bulk import run_bulk, DEFAULT_MAX_WORKERS
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS media ('
+    'mid TEXT PRIMARY KEY, info TEXT NOT NULL, meta TEXT NOT NULL, fetched_at REAL NOT NULL, '
+    'captured_at TEXT, make TEXT, model TEXT, latitude REAL, longitude REAL)',
+    'CREATE INDEX IF NOT EXISTS media_captured_at ON media (captured_at)',
+    'CREATE INDEX IF NOT EXISTS media_model ON media (model)',
+    'CREATE INDEX IF NOT EXISTS media_location ON media (latitude, longitude)',
+    'CREATE TABLE IF NOT EXISTS user_meta ('
+    'mid TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (mid, key))',
+    'CREATE INDEX IF NOT EXISTS user_meta_value ON user_meta (key, value)',
+)
+
+def _captured_at(exif):
+    """return DateTimeOriginal ('2016:07:08 12:34:56') as '2016-07-08T12:34:56', or None"""
+    value = exif.get('DateTimeOriginal') or exif.get('DateTime')
+    if not value or len(value) < 19:
+        return None
+    return '{0}-{1}-{2}T{3}'.format(value[0:4], value[5:7], value[8:10], value[11:19])
+
+def _gps_coordinate(value, ref):
+    """return a signed decimal degree from a number or [degrees, minutes, seconds]"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (list, tuple)):
+            parts = [float(part) for part in value] + [0.0, 0.0]
+            degrees = parts[0] + parts[1] / 60 + parts[2] / 3600
+        else:
+            degrees = float(value)
+    except (TypeError, ValueError):
+        return None
+    if ref in ('S', 'W'):
+        degrees = -abs(degrees)
+    return degrees
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+class IndexReport(object):
+    """outcome of an index refresh"""
+
+    def __init__(self):
+        self.added = 0
+        self.refreshed = 0
+        self.removed = 0
+        self.failed = {}
+
+    def __repr__(self):
+        return 'IndexReport(added={0}, refreshed={1}, removed={2}, failed={3})'.format(
+            self.added, self.refreshed, self.removed, len(self.failed))
+
+class MetaIndex(object):
+    """sqlite index of media info and meta (exif, gpano, user) for offline queries
+
+    capture date, make, model and GPS position are extracted from exif
+    into indexed columns, and user meta into a (key, value) table.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        with self.__conn:
+            for statement in _SCHEMA:
+                self.__conn.execute(statement)
+
+    def update(self, mid, info, meta):
+        """store the info and full meta of a media"""
+        exif = meta.get('exif') or {}
+        user = meta.get('user') or {}
+        row = (
+            mid, json.dumps(info), json.dumps(meta), time.time(), _captured_at(exif),
+            exif.get('Make'), exif.get('Model'),
+            _gps_coordinate(exif.get('GPSLatitude'), exif.get('GPSLatitudeRef')),
+            _gps_coordinate(exif.get('GPSLongitude'), exif.get('GPSLongitudeRef')),
+        )
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO media (mid, info, meta, fetched_at, captured_at, '
+                'make, model, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.__conn.execute('DELETE FROM user_meta WHERE mid = ?', (mid,))
+            self.__conn.executemany(
+                'INSERT INTO user_meta (mid, key, value) VALUES (?, ?, ?)',
+                [(mid, key, value) for key, value in user.items()])
+
+    def remove(self, mid):
+        """drop a media from the index"""
+        with self.__lock, self.__conn:
+            self.__conn.execute('DELETE FROM media WHERE mid = ?', (mid,))
+            self.__conn.execute('DELETE FROM user_meta WHERE mid = ?', (mid,))
+
+    def get(self, mid):
+        """return (info, meta) of an indexed media, or None"""
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT info, meta FROM media WHERE mid = ?', (mid,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def fetched_at(self):
+        """return {mid: time the media was last fetched}"""
+        with self.__lock:
+            return dict(self.__conn.execute('SELECT mid, fetched_at FROM media'))
+
+    def __len__(self):
+        with self.__lock:
+            return self.__conn.execute('SELECT COUNT(*) FROM media').fetchone()[0]
+
+    def refresh(self, mstorage, max_age=None, max_workers=DEFAULT_MAX_WORKERS, mids=None):
+        """synchronise the index with the account
+
+        media not indexed yet are fetched, media gone from the account are
+        dropped and, with max_age (seconds), entries older than that are
+        fetched again. unchanged entries cost no request besides the
+        listing. with mids, only those media are (re)fetched and no
+        listing is done.
+        """
+        report = IndexReport()
+        known = self.fetched_at()
+        if mids is not None:
+            targets = list(mids)
+        else:
+            remote = set(mstorage.iter_media(prefetch=True))
+            for mid in set(known) - remote:
+                self.remove(mid)
+                report.removed += 1
+            deadline = time.time() - max_age if max_age is not None else None
+            targets = [mid for mid in remote
+                       if mid not in known or (deadline is not None and known[mid] < deadline)]
+
+        def fetch(mid):
+            """fetch the info and full meta of a media"""
+            return mstorage.info(mid), mstorage.meta(mid)
+
+        for result in run_bulk(fetch, targets, max_workers):
+            if result.error is not None:
+                report.failed[result.key] = result.error
+                continue
+            self.update(result.key, *result.value)
+            if result.key in known:
+                report.refreshed += 1
+            else:
+                report.added += 1
+        return report
+
+    def query(self, captured_after=None, captured_before=None, make=None, model=None,
+              model_prefix=None, bbox=None, user=None, user_prefix=None, limit=None):
+        """return the ids of the indexed media matching every given condition
+
+        captured_after/captured_before are ISO 8601 strings or datetimes
+        (inclusive/exclusive), bbox is (min_lat, min_lon, max_lat, max_lon),
+        user maps user meta keys to exact values and user_prefix maps them
+        to value prefixes. results are ordered by capture date.
+        """
+        clauses = []
+        params = []
+        if captured_after is not None:
+            clauses.append('captured_at >= ?')
+            params.append(getattr(captured_after, 'isoformat', lambda: captured_after)())
+        if captured_before is not None:
+            clauses.append('captured_at < ?')
+            params.append(getattr(captured_before, 'isoformat', lambda: captured_before)())
+        if make is not None:
+            clauses.append('make = ?')
+            params.append(make)
+        if model is not None:
+            clauses.append('model = ?')
+            params.append(model)
+        if model_prefix is not None:
+            clauses.append("model LIKE ? ESCAPE '\\'")
+            params.append(_escape_like(model_prefix) + '%')
+        if bbox is not None:
+            clauses.append('latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?')
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        for key, value in (user or {}).items():
+            clauses.append('mid IN (SELECT mid FROM user_meta WHERE key = ? AND value = ?)')
+            params.extend([key, value])
+        for key, prefix in (user_prefix or {}).items():
+            clauses.append("mid IN (SELECT mid FROM user_meta "
+                           "WHERE key = ? AND value LIKE ? ESCAPE '\\')")
+            params.extend([key, _escape_like(prefix) + '%'])
+        sql = 'SELECT mid FROM media'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY captured_at, mid'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self.__lock:
+            return [row[0] for row in self.__conn.execute(sql, params)]
+
+    def close(self):
+        """close the database"""
+        with self.__lock:
+            self.__conn.close()
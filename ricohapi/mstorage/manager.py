@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Multi-account hosting for RICOH Media Storage
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from .client import MediaStorage, _ENDPOINT
+from .pool import SessionPool
+from .token import TokenCache
+from .bulk import DEFAULT_MAX_WORKERS
+
+class AccountManager(object):
+    """host many accounts over one SessionPool and one worker pool
+
+    each account gets its own MediaStorage and TokenCache, while the
+    connections, the request scheduler and the worker threads are
+    shared, so sockets and threads do not grow with the number of
+    accounts. work submitted with submit() is run round-robin across
+    accounts: an account with a long backlog does not delay the others.
+    """
+
+    def __init__(self, pool=None, max_workers=DEFAULT_MAX_WORKERS, endpoint=_ENDPOINT, **kwargs):
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than or equal to 1.')
+        self.__own_pool = pool is None
+        if pool is None:
+            pool = SessionPool()
+        self.__pool = pool
+        self.__endpoint = endpoint
+        self.__options = kwargs
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__lock = threading.Lock()
+        self.__accounts = {}
+        self.__adding = set()
+        self.__queues = {}
+        self.__ready = deque()
+        self.__closed = False
+
+    @property
+    def pool(self):
+        """connection pool shared by every account"""
+        return self.__pool
+
+    def add(self, key, aclient, connect=True):
+        """register an account under key and return its MediaStorage
+
+        with connect, MediaStorage.connect() opens the AuthClient session
+        right away.
+        """
+        with self.__lock:
+            if key in self.__accounts or key in self.__adding:
+                raise ValueError('Account {0} is already registered.'.format(key))
+            self.__adding.add(key)
+        try:
+            mstorage = MediaStorage(aclient, pool=self.__pool, tokens=TokenCache(aclient),
+                                    endpoint=self.__endpoint, **self.__options)
+            if connect:
+                mstorage.connect()
+            with self.__lock:
+                self.__accounts[key] = mstorage
+                self.__queues[key] = deque()
+        finally:
+            with self.__lock:
+                self.__adding.discard(key)
+        return mstorage
+
+    def get(self, key):
+        """return the MediaStorage of an account"""
+        with self.__lock:
+            return self.__accounts[key]
+
+    def remove(self, key):
+        """unregister an account and cancel its work that has not started"""
+        with self.__lock:
+            del self.__accounts[key]
+            queue = self.__queues.pop(key)
+            self.__ready = deque(ready for ready in self.__ready if ready != key)
+        for future, dummy in queue:
+            future.cancel()
+
+    def keys(self):
+        """return the registered account keys"""
+        with self.__lock:
+            return list(self.__accounts)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__accounts
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__accounts)
+
+    def submit(self, key, func, *args, **kwargs):
+        """run func(mstorage, *args, **kwargs) for an account on the shared workers
+
+        returns a concurrent.futures.Future of the result.
+        """
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('The account manager is closed.')
+            queue = self.__queues[key]
+            if not queue:
+                self.__ready.append(key)
+            queue.append((future, lambda mstorage: func(mstorage, *args, **kwargs)))
+        self.__executor.submit(self.__run_next)
+        return future
+
+    def __run_next(self):
+        """run the oldest task of the next account in round-robin order"""
+        with self.__lock:
+            while self.__ready:
+                key = self.__ready.popleft()
+                queue = self.__queues.get(key)
+                if queue:
+                    break
+            else:
+                return
+            future, call = queue.popleft()
+            if queue:
+                self.__ready.append(key)
+            mstorage = self.__accounts[key]
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = call(mstorage)
+        except BaseException as exc: # pylint: disable=broad-except
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def close(self):
+        """wait for submitted work and close the connections if the manager created them"""
+        with self.__lock:
+            self.__closed = True
+        self.__executor.shutdown(wait=True)
+        if self.__own_pool:
+            self.__pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
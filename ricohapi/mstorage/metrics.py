@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Request instrumentation for RICOH Media Storage
+
+a hook is any callable taking a RequestEvent, registered with
+MediaStorage(hooks=[...]) or MediaStorage.add_hook.
+"""
+
+import bisect
+import threading
+from collections import namedtuple
+
+class RequestEvent(namedtuple('RequestEvent', ['method', 'template', 'status', 'bytes_in',
+                                               'bytes_out', 'duration', 'retries', 'error'])):
+    """one finished request
+
+    template is the path template such as /media/{mid}/meta/user/{key},
+    status is None when no response was received, bytes_in/bytes_out are
+    the Content-Length of the response/request body (None when unknown),
+    duration is in seconds, retries counts resends and error is the
+    raised exception or None.
+    """
+    __slots__ = ()
+
+class HistogramCollector(object):
+    """in-memory latency histograms per (method, template)"""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.__buckets = tuple(sorted(buckets))
+        self.__lock = threading.Lock()
+        self.__series = {}
+
+    def __call__(self, event):
+        key = (event.method, event.template)
+        with self.__lock:
+            series = self.__series.get(key)
+            if series is None:
+                series = {
+                    'count': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'sum': 0.0,
+                    'bytes_in': 0,
+                    'bytes_out': 0,
+                    'buckets': [0] * (len(self.__buckets) + 1),
+                }
+                self.__series[key] = series
+            series['count'] += 1
+            series['sum'] += event.duration
+            series['retries'] += event.retries
+            series['bytes_in'] += event.bytes_in or 0
+            series['bytes_out'] += event.bytes_out or 0
+            if event.error is not None:
+                series['errors'] += 1
+            series['buckets'][bisect.bisect_left(self.__buckets, event.duration)] += 1
+
+    @property
+    def buckets(self):
+        """upper bounds of the histogram buckets in seconds"""
+        return self.__buckets
+
+    def snapshot(self):
+        """return {(method, template): series} with per-bucket (non-cumulative) counts"""
+        with self.__lock:
+            return dict((key, dict(series, buckets=list(series['buckets'])))
+                        for key, series in self.__series.items())
+
+    def quantile(self, method, template, rate):
+        """return the bucket upper bound containing the rate quantile, or None
+
+        float('inf') means the quantile is above the largest bucket.
+        """
+        with self.__lock:
+            series = self.__series.get((method, template))
+            if series is None or series['count'] == 0:
+                return None
+            rank = rate * series['count']
+            total = 0
+            for index, count in enumerate(series['buckets']):
+                total += count
+                if total >= rank and count:
+                    return self.__buckets[index] if index < len(self.__buckets) else float('inf')
+        return float('inf')
+
+    def reset(self):
+        """drop every series"""
+        with self.__lock:
+            self.__series.clear()
+
+class MetricsSink(object):
+    """base class of adapters exporting RequestEvent to a metrics system"""
+
+    def __call__(self, event):
+        self.emit(event)
+
+    def emit(self, event):
+        """export one event"""
+        raise NotImplementedError
+
+def _metric_name(template):
+    return template.strip('/').replace('/', '.').replace('{', '').replace('}', '')
+
+class StatsdSink(MetricsSink):
+    """export to a statsd client providing timing(name, ms) and incr(name, count)"""
+
+    def __init__(self, client, prefix='mstorage'):
+        self.__client = client
+        self.__prefix = prefix
+
+    def emit(self, event):
+        name = '{0}.{1}.{2}'.format(self.__prefix, event.method.lower(),
+                                    _metric_name(event.template))
+        self.__client.timing(name, event.duration * 1000)
+        self.__client.incr('{0}.status.{1}'.format(name, event.status or 'error'))
+        if event.retries:
+            self.__client.incr(name + '.retries', event.retries)
+
+class PrometheusSink(MetricsSink):
+    """export to prometheus-style metrics
+
+    histogram must accept labels(method, template, status).observe(seconds),
+    e.g. a prometheus_client.Histogram declared with those label names.
+    """
+
+    def __init__(self, histogram):
+        self.__histogram = histogram
+
+    def emit(self, event):
+        status = str(event.status) if event.status is not None else 'error'
+        labels = self.__histogram.labels(event.method.upper(), event.template, status)
+        labels.observe(event.duration)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Local stand-in for the RICOH Media Storage API, for tests and benchmarks
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+
+_ROOT = '/v1/media'
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+_DEFAULT_LIMIT = 25
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        """do not log requests"""
+        pass
+
+    def __read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def __send(self, status, body=b'', content_type='application/json', headers=None):
+        mock = self.server.mock
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == 'HEAD' or not body:
+            return
+        mock.count_bytes_out(len(body))
+        if mock.bandwidth is None:
+            self.wfile.write(body)
+            return
+        chunk_size = max(1, int(mock.bandwidth / 100))
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / float(mock.bandwidth))
+
+    def __send_json(self, obj, status=200):
+        self.__send(status, json.dumps(obj).encode('utf-8'))
+
+    def __handle(self):
+        mock = self.server.mock
+        body = self.__read_body()
+        mock.count_request(len(body))
+        if mock.latency:
+            time.sleep(mock.latency)
+        error = mock.inject_error()
+        if error is not None:
+            self.__send(error[0], headers=error[1])
+            return
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.__send(401)
+            return
+        url = urlparse(self.path)
+        if not url.path.startswith(_ROOT):
+            self.__send(404)
+            return
+        parts = [part for part in url.path[len(_ROOT):].split('/') if part]
+        route = (self.command, len(parts))
+        if route == ('POST', 0):
+            media = mock.add_media(body, self.headers.get('Content-Type'))
+            self.__send_json(media, 201)
+        elif route == ('GET', 0):
+            query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+            self.__send_json(mock.list_media(query))
+        elif route == ('POST', 1) and parts[0] == 'search':
+            self.__search(body)
+        else:
+            self.__handle_media(parts, body)
+
+    def __search(self, body):
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            query = payload['query']
+        except (ValueError, KeyError):
+            self.__send(400)
+            return
+        self.__send_json(self.server.mock.list_media(payload.get('paging', {}), query))
+
+    def __handle_media(self, parts, body):
+        mock = self.server.mock
+        mid = parts[0]
+        media = mock.get_media(mid)
+        if media is None:
+            self.__send(404)
+            return
+        route = (self.command, '/'.join(parts[1:3]))
+        if route == ('GET', ''):
+            self.__send_json(media['info'])
+        elif route == ('DELETE', ''):
+            mock.delete_media(mid)
+            self.__send(204)
+        elif route == ('GET', 'content'):
+            self.__send_content(media)
+        elif route == ('GET', 'meta'):
+            self.__send_json({'exif': media['exif'], 'gpano': media['gpano'],
+                              'user': media['user']})
+        elif (route[0] == 'GET' and route[1] in ('meta/exif', 'meta/gpano', 'meta/user') and
+              len(parts) == 3):
+            self.__send_json(media[parts[2]])
+        elif route == ('DELETE', 'meta/user') and len(parts) == 3:
+            media['user'].clear()
+            self.__send(204)
+        elif route[1] == 'meta/user' and len(parts) == 4:
+            self.__handle_user_meta(media, 'user.' + parts[3], body)
+        else:
+            self.__send(404)
+
+    def __handle_user_meta(self, media, key, body):
+        if self.command == 'PUT':
+            media['user'][key] = body.decode('utf-8')
+            self.__send(204)
+        elif key not in media['user']:
+            self.__send(404)
+        elif self.command == 'GET':
+            self.__send(200, media['user'][key].encode('utf-8'), 'text/plain; charset=utf-8')
+        elif self.command == 'DELETE':
+            del media['user'][key]
+            self.__send(204)
+        else:
+            self.__send(405)
+
+    def __send_content(self, media):
+        content = media['content']
+        match = _RANGE_RE.match(self.headers.get('Range', ''))
+        if match is None or not self.server.mock.ranges:
+            self.__send(200, content, media['info']['content_type'])
+            return
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(content) - 1
+        if start >= len(content):
+            self.__send(416, headers={'Content-Range': 'bytes */{0}'.format(len(content))})
+            return
+        end = min(end, len(content) - 1)
+        self.__send(206, content[start:end + 1], media['info']['content_type'], {
+            'Content-Range': 'bytes {0}-{1}/{2}'.format(start, end, len(content))
+        })
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = __handle
+
+class MockMediaStorageServer(object):
+    """in-process HTTP server implementing the Media Storage endpoints
+
+    latency is added to every response in seconds, bandwidth limits
+    response bodies to that many bytes/sec and error_rate is the share of
+    requests answered with error_status (and Retry-After if given).
+    use it as MediaStorage(aclient, endpoint=server.endpoint).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=None,
+                 error_rate=0.0, error_status=503, retry_after=None, ranges=True, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.ranges = ranges
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__media = {}
+        self.__next_id = 0
+        self.__stats = {'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self.__server = _Server((host, port), _Handler)
+        self.__server.mock = self
+        self.__thread = None
+
+    @property
+    def endpoint(self):
+        """base url to pass to MediaStorage"""
+        host, port = self.__server.server_address[:2]
+        return 'http://{0}:{1}/v1'.format(host, port)
+
+    def start(self):
+        """serve requests on a background thread"""
+        self.__thread = threading.Thread(target=self.__server.serve_forever, args=(0.05,))
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """stop serving and close the socket"""
+        self.__server.shutdown()
+        self.__server.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """return request/error/byte counters"""
+        with self.__lock:
+            return dict(self.__stats)
+
+    def count_request(self, size):
+        """record an incoming request"""
+        with self.__lock:
+            self.__stats['requests'] += 1
+            self.__stats['bytes_in'] += size
+
+    def count_bytes_out(self, size):
+        """record response bytes"""
+        with self.__lock:
+            self.__stats['bytes_out'] += size
+
+    def inject_error(self):
+        """return (status, headers) of an injected error, or None"""
+        with self.__lock:
+            if not self.error_rate or self.__random.random() >= self.error_rate:
+                return None
+            self.__stats['errors'] += 1
+        headers = {}
+        if self.retry_after is not None:
+            headers['Retry-After'] = str(self.retry_after)
+        return self.error_status, headers
+
+    def add_media(self, content, content_type=None, exif=None, gpano=None, user=None):
+        """store a media and return its info"""
+        with self.__lock:
+            mid = '{0:032x}'.format(self.__next_id)
+            self.__next_id += 1
+            info = {
+                'id': mid,
+                'content_type': content_type or 'image/jpeg',
+                'bytes': len(content),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            }
+            self.__media[mid] = {
+                'info': info,
+                'content': content,
+                'exif': dict(exif or {}),
+                'gpano': dict(gpano or {}),
+                'user': dict(user or {}),
+            }
+        return info
+
+    def get_media(self, mid):
+        """return the stored media record, or None"""
+        with self.__lock:
+            return self.__media.get(mid)
+
+    def delete_media(self, mid):
+        """remove a stored media"""
+        with self.__lock:
+            self.__media.pop(mid, None)
+
+    def list_media(self, paging, query=None):
+        """return a listing page as sent by the server"""
+        limit = int(paging.get('limit', _DEFAULT_LIMIT))
+        with self.__lock:
+            ids = sorted(self.__media)
+            if query:
+                ids = [mid for mid in ids
+                       if all(self.__media[mid]['user'].get(key[len('meta.'):]) == value
+                              for key, value in query.items())]
+        if 'after' in paging:
+            ids = [mid for mid in ids if mid > paging['after']]
+        if 'before' in paging:
+            ids = [mid for mid in ids if mid < paging['before']][-limit:]
+        page = ids[:limit]
+        return {'media': [{'id': mid} for mid in page], 'paging': {}}
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Pooled keep-alive HTTP sessions for RICOH Media Storage
+"""
+
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .scheduler import Scheduler
+
+class SessionPool(object):
+    """thread-safe pool of keep-alive connections shared by MediaStorage instances
+
+    429/503 responses are left to the scheduler, which paces and retries
+    every request sent through the pool; urllib3 only retries connection
+    errors and the other 5xx statuses.
+    """
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_RETRIES = 3
+    DEFAULT_BACKOFF = 0.3
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    RETRY_STATUSES = frozenset([500, 502, 504])
+
+    __shared = weakref.WeakKeyDictionary()
+    __shared_lock = threading.Lock()
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF, pool_block=False, scheduler=None):
+        self.__pool_size = pool_size
+        self.__retries = retries
+        self.__backoff_factor = backoff_factor
+        self.__pool_block = pool_block
+        self.__lock = threading.Lock()
+        self.__session = None
+        self.__executor = None
+        if scheduler is None:
+            scheduler = Scheduler(max_concurrency=max(pool_size, 1))
+        self.__scheduler = scheduler
+
+    @classmethod
+    def for_client(cls, aclient):
+        """return the pool shared by every MediaStorage built on aclient"""
+        with cls.__shared_lock:
+            try:
+                pool = cls.__shared.get(aclient)
+            except TypeError: # aclient cannot be weakly referenced
+                return cls()
+            if pool is None:
+                pool = cls()
+                cls.__shared[aclient] = pool
+        return pool
+
+    def __create_retry(self):
+        kwargs = {
+            'total': self.__retries,
+            'backoff_factor': self.__backoff_factor,
+            'status_forcelist': SessionPool.RETRY_STATUSES,
+            'raise_on_status': False,
+            'respect_retry_after_header': False,
+        }
+        try:
+            return Retry(allowed_methods=SessionPool.IDEMPOTENT_METHODS, **kwargs)
+        except TypeError: # urllib3 < 1.26
+            return Retry(method_whitelist=SessionPool.IDEMPOTENT_METHODS, **kwargs)
+
+    def __create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.__pool_size,
+                              pool_maxsize=self.__pool_size,
+                              max_retries=self.__create_retry(),
+                              pool_block=self.__pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """the underlying requests session, created on first use"""
+        if self.__session is None:
+            with self.__lock:
+                if self.__session is None:
+                    self.__session = self.__create_session()
+        return self.__session
+
+    @property
+    def executor(self):
+        """worker threads shared by the concurrent PUTs of add_meta, created on first use"""
+        if self.__executor is None:
+            with self.__lock:
+                if self.__executor is None:
+                    self.__executor = ThreadPoolExecutor(max_workers=max(self.__pool_size, 1))
+        return self.__executor
+
+    @property
+    def scheduler(self):
+        """Scheduler pacing and retrying the requests of this pool"""
+        return self.__scheduler
+
+    def request(self, method, url, **kwargs):
+        """send a request over a pooled connection"""
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self):
+        """return pool hit/miss counters
+
+        hits are requests served by a reused keep-alive connection,
+        misses are requests that had to open a new connection.
+        """
+        requests_count = 0
+        connections = 0
+        if self.__session is not None:
+            for adapter in set(self.__session.adapters.values()):
+                manager = getattr(adapter, 'poolmanager', None)
+                if manager is None:
+                    continue
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_count += pool.num_requests
+                    connections += pool.num_connections
+        return {
+            'requests': requests_count,
+            'hits': max(requests_count - connections, 0),
+            'misses': connections,
+        }
+
+    def close(self):
+        """close all pooled connections and stop the shared worker threads"""
+        with self.__lock:
+            if self.__session is not None:
+                self.__session.close()
+                self.__session = None
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Client-wide request scheduling for RICOH Media Storage
+"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+_clock = getattr(time, 'monotonic', time.time)
+
+class RateLimiter(object):
+    """token bucket allowing rate calls/sec on average and bursts of burst calls"""
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0.')
+        self.__rate = float(rate)
+        self.__burst = float(burst if burst is not None else max(1.0, rate))
+        self.__tokens = self.__burst
+        self.__updated = _clock()
+        self.__lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """average calls/sec"""
+        return self.__rate
+
+    def acquire(self):
+        """take one token, sleeping until one is available"""
+        with self.__lock:
+            now = _clock()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= 1
+            wait_time = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+        if wait_time:
+            time.sleep(wait_time)
+
+def _retry_after(headers):
+    """return the Retry-After header in seconds, or None"""
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+class Scheduler(object):
+    """admission control and retry policy shared by every request of a SessionPool
+
+    - rate (requests/sec) enables a token bucket with burst capacity.
+    - the number of requests in flight is adjusted AIMD-style: it grows
+      by about one per window of successful requests up to
+      max_concurrency and is halved when the server throttles (429/503),
+      at most once per window of requests sent before the last decrease.
+    - a Retry-After header pauses every new request for that long.
+    - throttled idempotent requests are retried up to retries times with
+      full-jitter exponential backoff (backoff_factor * 2 ** attempt,
+      capped at max_backoff), or after Retry-After when the server sent
+      one. a Retry-After above max_backoff is not waited for.
+
+    the concurrency slot is held until the response headers arrive, so
+    streamed response bodies are not counted.
+    """
+    DEFAULT_MAX_CONCURRENCY = 16
+    DEFAULT_RETRIES = 3
+    DEFAULT_BACKOFF = 0.3
+    DEFAULT_MAX_BACKOFF = 30.0
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    THROTTLE_STATUSES = frozenset([429, 503])
+
+    def __init__(self, rate=None, burst=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 min_concurrency=1, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, seed=None):
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            raise ValueError('concurrency must satisfy 1 <= min_concurrency <= max_concurrency.')
+        self.__limiter = RateLimiter(rate, burst) if rate is not None else None
+        self.__max_concurrency = max_concurrency
+        self.__min_concurrency = min_concurrency
+        self.__retries = retries
+        self.__backoff_factor = backoff_factor
+        self.__max_backoff = max_backoff
+        self.__random = random.Random(seed)
+        self.__cond = threading.Condition()
+        self.__limit = float(max_concurrency)
+        self.__in_flight = 0
+        self.__paused_until = 0.0
+        self.__last_decrease = 0.0
+        self.__stats = {'throttled': 0, 'retries': 0, 'decreases': 0}
+
+    @property
+    def limit(self):
+        """current number of requests allowed in flight"""
+        with self.__cond:
+            return int(self.__limit)
+
+    def stats(self):
+        """return throttled/retries/decreases counters with the current limit and in-flight count"""
+        with self.__cond:
+            return dict(self.__stats, limit=int(self.__limit), in_flight=self.__in_flight)
+
+    def acquire(self):
+        """wait for a pause to end, a concurrency slot and a rate token; return a ticket"""
+        with self.__cond:
+            while True:
+                delay = self.__paused_until - _clock()
+                if delay > 0:
+                    self.__cond.wait(delay)
+                elif self.__in_flight >= int(self.__limit):
+                    self.__cond.wait()
+                else:
+                    break
+            self.__in_flight += 1
+        if self.__limiter is not None:
+            self.__limiter.acquire()
+        return _clock()
+
+    def release(self, ticket, status=None, headers=None):
+        """free the slot of a request started at ticket and adapt to its status"""
+        with self.__cond:
+            self.__in_flight -= 1
+            if status in Scheduler.THROTTLE_STATUSES:
+                self.__stats['throttled'] += 1
+                if ticket >= self.__last_decrease:
+                    self.__limit = max(float(self.__min_concurrency), self.__limit / 2)
+                    self.__last_decrease = _clock()
+                    self.__stats['decreases'] += 1
+                retry_after = _retry_after(headers)
+                if retry_after is not None:
+                    self.__paused_until = max(self.__paused_until,
+                                              _clock() + min(retry_after, self.__max_backoff))
+            elif status is not None:
+                self.__limit = min(float(self.__max_concurrency), self.__limit + 1 / self.__limit)
+            self.__cond.notify_all()
+
+    def backoff(self, attempt, retry_after=None):
+        """return the delay in seconds before retry number attempt (0-based)"""
+        if retry_after is not None:
+            return retry_after + self.__random.uniform(0, self.__backoff_factor)
+        ceiling = min(self.__max_backoff, self.__backoff_factor * (2 ** attempt))
+        return self.__random.uniform(0, ceiling)
+
+    def call(self, method, send, rewind=None):
+        """call send() under the scheduler and return its response
+
+        a throttled response of an idempotent method is closed and sent
+        again after rewind() restores the request body; without rewind
+        it is returned as is.
+        """
+        retriable = method.upper() in Scheduler.IDEMPOTENT_METHODS and rewind is not None
+        attempt = 0
+        while True:
+            ticket = self.acquire()
+            res = None
+            try:
+                res = send()
+            finally:
+                status = res.status_code if res is not None else None
+                headers = res.headers if res is not None else None
+                self.release(ticket, status, headers)
+            if (status not in Scheduler.THROTTLE_STATUSES or not retriable or
+                    attempt >= self.__retries):
+                return res
+            retry_after = _retry_after(headers)
+            if retry_after is not None and retry_after > self.__max_backoff:
+                return res
+            with self.__cond:
+                self.__stats['retries'] += 1
+            res.close()
+            time.sleep(self.backoff(attempt, retry_after))
+            rewind()
+            attempt += 1
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Incremental directory sync for RICOH Media Storage
+"""
+
+import os
+import sqlite3
+from collections import namedtuple
+from .bulk import run_bulk, DEFAULT_MAX_WORKERS
+from .dedup import hash_source
+
+MANIFEST_NAME = '.mstorage-sync.db'
+_PART_SUFFIX = '.part'
+
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'mtime', 'digest', 'mid'])
+
+class Manifest(object):
+    """local sqlite state of a synced directory: path -> (size, mtime, digest, media id)
+
+    mtime is in nanoseconds. paths are relative and '/' separated. every
+    change is committed right away (WAL mode), so a run that is
+    interrupted does not forget the files it already transferred.
+    """
+
+    def __init__(self, path):
+        self.__conn = sqlite3.connect(path)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA synchronous=NORMAL')
+        with self.__conn:
+            self.__conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, '
+                'digest TEXT, mid TEXT)')
+            self.__conn.execute('CREATE INDEX IF NOT EXISTS entries_mid ON entries (mid)')
+
+    def load(self):
+        """return every entry as {path: ManifestEntry}"""
+        rows = self.__conn.execute('SELECT path, size, mtime, digest, mid FROM entries')
+        return dict((row[0], ManifestEntry(*row[1:])) for row in rows)
+
+    def get(self, path):
+        """return the ManifestEntry of path, or None"""
+        row = self.__conn.execute(
+            'SELECT size, mtime, digest, mid FROM entries WHERE path = ?', (path,)).fetchone()
+        return ManifestEntry(*row) if row is not None else None
+
+    def put(self, path, entry):
+        """record path"""
+        with self.__conn:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO entries (path, size, mtime, digest, mid) '
+                'VALUES (?, ?, ?, ?, ?)', (path,) + tuple(entry))
+
+    def remove(self, path):
+        """forget path"""
+        with self.__conn:
+            self.__conn.execute('DELETE FROM entries WHERE path = ?', (path,))
+
+    def close(self):
+        """close the database"""
+        self.__conn.close()
+
+class SyncReport(object):
+    """outcome of a sync run"""
+
+    def __init__(self):
+        self.transferred = []
+        self.unchanged = 0
+        self.deleted = []
+        self.failed = {}
+
+    def __repr__(self):
+        return 'SyncReport(transferred={0}, unchanged={1}, deleted={2}, failed={3})'.format(
+            len(self.transferred), self.unchanged, len(self.deleted), len(self.failed))
+
+def _mtime_ns(stat):
+    return getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1000000000)
+
+def _scan(root, prefix=''):
+    """yield (relative path, size, mtime in ns) of the regular files under root"""
+    for entry in os.scandir(root):
+        relpath = prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            for item in _scan(entry.path, relpath + '/'):
+                yield item
+        elif entry.is_file():
+            if relpath.startswith(MANIFEST_NAME) or relpath.endswith(_PART_SUFFIX):
+                continue
+            stat = entry.stat()
+            yield relpath, stat.st_size, _mtime_ns(stat)
+
+class DirectorySync(object):
+    """mirror a local directory to or from the account
+
+    the manifest (by default <local_dir>/.mstorage-sync.db) remembers the
+    size, mtime, digest and media id of every synced file, so a run only
+    transfers what changed since the previous one.
+    """
+
+    def __init__(self, mstorage, local_dir, manifest_path=None, max_workers=DEFAULT_MAX_WORKERS):
+        self.__mstorage = mstorage
+        self.__local_dir = local_dir
+        if manifest_path is None:
+            manifest_path = os.path.join(local_dir, MANIFEST_NAME)
+        self.__manifest_path = manifest_path
+        self.__max_workers = max_workers
+
+    def __abspath(self, relpath):
+        return os.path.join(self.__local_dir, *relpath.split('/'))
+
+    def __push_one(self, item):
+        relpath, size, mtime, old = item
+        digest, body = hash_source(self.__abspath(relpath))
+        if old is not None and old.digest == digest and old.mid is not None:
+            return ManifestEntry(size, mtime, digest, old.mid), False # touched only
+        mid = self.__mstorage.upload(body)['id']
+        return ManifestEntry(size, mtime, digest, mid), True
+
+    def push(self, delete=False):
+        """upload new and modified files
+
+        with delete, the remote media of local files that were removed or
+        replaced are deleted as well.
+        """
+        manifest = Manifest(self.__manifest_path)
+        report = SyncReport()
+        try:
+            known = manifest.load()
+            changed = []
+            for relpath, size, mtime in _scan(self.__local_dir):
+                old = known.pop(relpath, None)
+                if old is not None and old.size == size and old.mtime == mtime:
+                    report.unchanged += 1
+                else:
+                    changed.append((relpath, size, mtime, old))
+            replaced = []
+            for result in run_bulk(self.__push_one, changed, self.__max_workers):
+                relpath, old = result.key[0], result.key[3]
+                if result.error is not None:
+                    report.failed[relpath] = result.error
+                    continue
+                entry, uploaded = result.value
+                manifest.put(relpath, entry)
+                if not uploaded:
+                    report.unchanged += 1
+                    continue
+                report.transferred.append(relpath)
+                if old is not None and old.mid is not None:
+                    replaced.append((old.mid, None))
+            if delete:
+                removed = [(entry.mid, relpath) for relpath, entry in known.items() if entry.mid]
+                self.__delete_remote(manifest, replaced + removed, report)
+        finally:
+            manifest.close()
+        return report
+
+    def __delete_remote(self, manifest, stale, report):
+        """delete (mid, relpath) pairs; relpath is None for replaced media"""
+        paths = dict(stale)
+        for result in run_bulk(self.__mstorage.delete, list(paths), self.__max_workers):
+            relpath = paths[result.key]
+            if result.error is not None:
+                report.failed[relpath or result.key] = result.error
+                continue
+            if relpath is not None:
+                manifest.remove(relpath)
+            report.deleted.append(relpath or result.key)
+
+    def pull(self, delete=False):
+        """download media that are not in the local directory yet
+
+        new media are saved as <local_dir>/<media id>. listing the account
+        is required to discover them; already synced media are not
+        downloaded again. with delete, local files whose media were
+        deleted on the server are removed.
+        """
+        manifest = Manifest(self.__manifest_path)
+        report = SyncReport()
+        try:
+            known = manifest.load()
+            local_mids = dict((entry.mid, relpath) for relpath, entry in known.items() if entry.mid)
+            remote = set()
+
+            def missing():
+                """yield remote media ids not synced yet"""
+                for mid in self.__mstorage.iter_media(prefetch=True):
+                    remote.add(mid)
+                    if mid in local_mids:
+                        report.unchanged += 1
+                    else:
+                        yield mid
+
+            results = self.__mstorage.download_many(missing(), self.__local_dir, self.__max_workers)
+            for result in results:
+                if result.error is not None:
+                    report.failed[result.key] = result.error
+                    continue
+                # the digest lets a later push tell a touched file from a modified one
+                stat = os.stat(result.value.path)
+                digest = hash_source(result.value.path, max_buffer=0)[0]
+                manifest.put(result.key,
+                             ManifestEntry(stat.st_size, _mtime_ns(stat), digest, result.key))
+                report.transferred.append(result.key)
+            if delete:
+                for mid, relpath in local_mids.items():
+                    if mid not in remote:
+                        path = self.__abspath(relpath)
+                        if os.path.exists(path):
+                            os.remove(path)
+                        manifest.remove(relpath)
+                        report.deleted.append(relpath)
+        finally:
+            manifest.close()
+        return report
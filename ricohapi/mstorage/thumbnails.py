@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Thumbnail and derivative generation for RICOH Media Storage
+
+resizing uses Pillow (pip install ricohapi-mstorage[thumbnails]);
+custom derivative functions work without it.
+"""
+
+import io
+import os
+import re
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from .bulk import run_bulk, DEFAULT_MAX_WORKERS
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+_NAME_RE = re.compile(r'^[A-Za-z0-9_\-]+$')
+_PART_SUFFIX = '.part'
+
+_replace = getattr(os, 'replace', os.rename)
+
+class Variant(namedtuple('Variant', ['size', 'format', 'quality'])):
+    """a resized derivative: bounding box (width, height), Pillow format and quality"""
+    __slots__ = ()
+
+    def __new__(cls, size, format='JPEG', quality=85): # pylint: disable=redefined-builtin
+        return super(Variant, cls).__new__(cls, tuple(size), format, quality)
+
+def resize(data, variant):
+    """return data resized to fit variant.size, encoded as variant.format
+
+    JPEG input is decoded in draft mode, at the smallest DCT scale that
+    still covers the target size, instead of at full resolution.
+    """
+    if Image is None:
+        raise RuntimeError('Pillow is required to resize images.')
+    image = Image.open(io.BytesIO(data))
+    if image.format == 'JPEG':
+        image.draft('RGB', variant.size)
+    image.thumbnail(variant.size)
+    if variant.format.upper() == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, variant.format, quality=variant.quality)
+    return output.getvalue()
+
+def _render(data, spec):
+    """build one derivative; runs in a worker process"""
+    if isinstance(spec, Variant):
+        return resize(data, spec)
+    return spec(data)
+
+class DiskCache(object):
+    """size-bounded LRU cache of derivative files keyed by (mid, variant)
+
+    entries are <path>/<mid>.<variant>. the recency order survives
+    restarts through the file mtimes, which are updated on each hit.
+    a path returned by path() or set() can be evicted by later calls.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        found = []
+        for entry in os.scandir(path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(_PART_SUFFIX): # left over by an interrupted set
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            else:
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for dummy, name, size in sorted(found):
+            self.__entries[name] = size
+            self.__bytes += size
+        with self.__lock:
+            self.__evict()
+
+    @staticmethod
+    def __name(mid, variant):
+        if not _NAME_RE.match(mid) or not _NAME_RE.match(variant):
+            raise ValueError('Key ({0}, {1}) is invalid.'.format(mid, variant))
+        return mid + '.' + variant
+
+    def path(self, mid, variant):
+        """return the file of a cached entry, or None; counts as a use"""
+        name = DiskCache.__name(mid, variant)
+        with self.__lock:
+            if name not in self.__entries:
+                self.__stats['misses'] += 1
+                return None
+            self.__entries.move_to_end(name)
+            self.__stats['hits'] += 1
+        path = os.path.join(self.__path, name)
+        try:
+            os.utime(path, None)
+        except OSError: # removed behind our back
+            self.__forget(name)
+            return None
+        return path
+
+    def get(self, mid, variant):
+        """return the cached bytes, or None"""
+        path = self.path(mid, variant)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as ifile:
+                return ifile.read()
+        except (IOError, OSError):
+            self.__forget(DiskCache.__name(mid, variant))
+            return None
+
+    def set(self, mid, variant, data):
+        """store data and evict least recently used entries over max_bytes
+
+        returns the path of the entry, or None if data is larger than
+        max_bytes and is not cached.
+        """
+        name = DiskCache.__name(mid, variant)
+        if len(data) > self.__max_bytes:
+            self.__forget(name)
+            return None
+        path = os.path.join(self.__path, name)
+        part_path = '{0}.{1}{2}'.format(path, threading.current_thread().ident, _PART_SUFFIX)
+        with open(part_path, 'wb') as ofile:
+            ofile.write(data)
+        _replace(part_path, path)
+        with self.__lock:
+            self.__bytes += len(data) - self.__entries.pop(name, 0)
+            self.__entries[name] = len(data)
+            self.__evict()
+        return path
+
+    def discard(self, mid):
+        """remove every variant of mid"""
+        prefix = mid + '.'
+        with self.__lock:
+            names = [name for name in self.__entries if name.startswith(prefix)]
+        for name in names:
+            self.__forget(name)
+
+    def __forget(self, name):
+        with self.__lock:
+            size = self.__entries.pop(name, None)
+            if size is None:
+                return
+            self.__bytes -= size
+        try:
+            os.remove(os.path.join(self.__path, name))
+        except OSError:
+            pass
+
+    def __evict(self):
+        while self.__bytes > self.__max_bytes and self.__entries:
+            name, size = self.__entries.popitem(last=False)
+            self.__bytes -= size
+            self.__stats['evictions'] += 1
+            try:
+                os.remove(os.path.join(self.__path, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        """return hits/misses/evictions with the entry count and total bytes"""
+        with self.__lock:
+            return dict(self.__stats, size=len(self.__entries), bytes=self.__bytes)
+
+class ThumbnailPipeline(object):
+    """generate derivatives of media and cache them on disk
+
+    variants maps names to a Variant or to a picklable function taking
+    the original bytes and returning the derivative bytes. a media is
+    streamed into memory once for all its missing variants, which are
+    then built in a process pool (or the given executor). cached
+    variants are served without any request.
+    """
+    DEFAULT_VARIANTS = {
+        'small': Variant((160, 160), quality=80),
+        'medium': Variant((640, 640)),
+    }
+
+    def __init__(self, mstorage, cache_dir, variants=None, max_bytes=DEFAULT_MAX_BYTES,
+                 executor=None, max_processes=None):
+        self.__mstorage = mstorage
+        if variants is None:
+            variants = ThumbnailPipeline.DEFAULT_VARIANTS
+        self.__variants = dict(variants)
+        for name in self.__variants:
+            if not _NAME_RE.match(name):
+                raise ValueError('Variant name {0} is invalid.'.format(name))
+        self.__cache = DiskCache(cache_dir, max_bytes)
+        self.__own_executor = executor is None
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=max_processes)
+        self.__executor = executor
+
+    @property
+    def cache(self):
+        """DiskCache holding the derivatives"""
+        return self.__cache
+
+    def __check(self, names):
+        for name in names:
+            if name not in self.__variants:
+                raise ValueError('Variant {0} is not defined.'.format(name))
+
+    def __render(self, mid, names):
+        """download mid once, build the variants and cache them
+
+        returns ({variant: path}, {variant: bytes})
+        """
+        buf = io.BytesIO()
+        self.__mstorage.download_into(mid, buf)
+        data = buf.getvalue()
+        futures = [(name, self.__executor.submit(_render, data, self.__variants[name]))
+                   for name in names]
+        paths = {}
+        rendered = {}
+        for name, future in futures:
+            rendered[name] = future.result()
+            paths[name] = self.__cache.set(mid, name, rendered[name])
+        return paths, rendered
+
+    def generate(self, mid, variants=None):
+        """return {variant: path} of mid, building the variants not cached yet
+
+        the path of a variant larger than the whole cache is None.
+        """
+        names = list(variants) if variants is not None else list(self.__variants)
+        self.__check(names)
+        paths = {}
+        missing = []
+        for name in names:
+            path = self.__cache.path(mid, name)
+            if path is None:
+                missing.append(name)
+            else:
+                paths[name] = path
+        if missing:
+            paths.update(self.__render(mid, missing)[0])
+        return paths
+
+    def get(self, mid, variant):
+        """return the bytes of one variant of mid"""
+        self.__check([variant])
+        data = self.__cache.get(mid, variant)
+        if data is None:
+            data = self.__render(mid, [variant])[1][variant]
+        return data
+
+    def generate_many(self, mids, variants=None, max_workers=DEFAULT_MAX_WORKERS):
+        """generate variants of many media, downloading in parallel
+
+        yields BulkResult(mid, {variant: path}, error) in completion order
+        """
+        return run_bulk(lambda mid: self.generate(mid, variants), mids, max_workers)
+
+    def close(self):
+        """shut down the process pool created by the pipeline"""
+        if self.__own_executor:
+            self.__executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
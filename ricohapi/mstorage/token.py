@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Access token cache for RICOH Media Storage
+"""
+
+import threading
+import time
+import weakref
+
+class TokenCache(object):
+    """thread-safe bearer token cache with single-flight refresh
+
+    a token is reused until margin seconds before lifetime seconds after
+    it was issued: when connect() or renew() opened the session that
+    produced it, or else when get_access_token first returned it. a token
+    the AuthClient returns again is not given a new lifetime, so once it
+    is due the AuthClient is asked on every get() until it hands out a
+    new one. renew() opens a new session after the server rejected a
+    token. only a weak reference to the AuthClient is kept, so the shared
+    cache of for_client does not keep it (and its SessionPool) alive.
+    """
+    DEFAULT_LIFETIME = 3600
+    DEFAULT_MARGIN = 60
+
+    __shared = weakref.WeakKeyDictionary()
+    __shared_lock = threading.Lock()
+
+    def __init__(self, aclient, lifetime=DEFAULT_LIFETIME, margin=DEFAULT_MARGIN):
+        try:
+            self.__aclient = weakref.ref(aclient)
+        except TypeError: # aclient cannot be weakly referenced
+            self.__aclient = lambda: aclient
+        self.__lifetime = lifetime
+        self.__margin = margin
+        self.__lock = threading.Lock()
+        self.__token = None
+        self.__issued = None
+        self.__refresh_at = 0
+
+    @classmethod
+    def for_client(cls, aclient):
+        """return the cache shared by every MediaStorage built on aclient"""
+        with cls.__shared_lock:
+            try:
+                tokens = cls.__shared.get(aclient)
+            except TypeError: # aclient cannot be weakly referenced
+                return cls(aclient)
+            if tokens is None:
+                tokens = cls(aclient)
+                cls.__shared[aclient] = tokens
+        return tokens
+
+    def __client(self):
+        aclient = self.__aclient()
+        if aclient is None:
+            raise ReferenceError('The AuthClient of this token cache was garbage collected.')
+        return aclient
+
+    def __store(self, token, issued_at=None):
+        """cache token; issued_at is None when it may be an already known token"""
+        if issued_at is not None or token != self.__issued:
+            self.__issued = token
+            self.__refresh_at = (issued_at or time.time()) + self.__lifetime - self.__margin
+        self.__token = token
+
+    def peek(self):
+        """return the cached token if it is still valid, or None; never blocks"""
+        token = self.__token
+        if token is not None and time.time() < self.__refresh_at:
+            return token
+        return None
+
+    def get(self, fresh=False):
+        """return a valid access token
+
+        with fresh, the AuthClient is asked even if a token is cached, for
+        requests that could not be resent after a 401.
+        """
+        token = None if fresh else self.peek()
+        if token is not None:
+            return token
+        with self.__lock:
+            if fresh or self.__token is None or time.time() >= self.__refresh_at:
+                self.__store(self.__client().get_access_token())
+            return self.__token
+
+    def connect(self, scope):
+        """open a new AuthClient session for scope and cache its token"""
+        with self.__lock:
+            aclient = self.__client()
+            aclient.session(scope)
+            self.__store(aclient.get_access_token(), time.time())
+
+    def renew(self, token, scope):
+        """return a new token after the server rejected token
+
+        a new session is opened once, by a single thread, however many
+        requests were rejected with the same token.
+        """
+        with self.__lock:
+            if self.__token is not None and self.__token != token:
+                return self.__token
+            aclient = self.__client()
+            aclient.session(scope)
+            self.__store(aclient.get_access_token(), time.time())
+            return self.__token
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+"""
+Durable write-behind upload queue for RICOH Media Storage
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+import requests
+from six.moves import queue
+from .client import _user_meta_items
+from .bulk import DEFAULT_MAX_WORKERS
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, content_type TEXT, meta TEXT, '
+    'state TEXT NOT NULL, mid TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, '
+    'created_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)',
+)
+
+def _retriable(error):
+    """client errors other than timeouts and throttling will fail again"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return not 400 <= response.status_code < 500 or response.status_code in (408, 429)
+
+JobStatus = namedtuple('JobStatus', ['state', 'mid', 'error', 'attempts'])
+
+class UploadFuture(Future):
+    """Future of a queued upload; its result is the media id"""
+
+    def __init__(self, job_id):
+        super(UploadFuture, self).__init__()
+        self.__job_id = job_id
+
+    @property
+    def job_id(self):
+        """id of the job in the journal"""
+        return self.__job_id
+
+class _Job(object):
+    __slots__ = ('job_id', 'path', 'content_type', 'meta', 'state', 'mid', 'attempts')
+
+    def __init__(self, job_id, path, content_type, meta, state, mid, attempts):
+        self.job_id = job_id
+        self.path = path
+        self.content_type = content_type
+        self.meta = meta
+        self.state = state
+        self.mid = mid
+        self.attempts = attempts
+
+class UploadQueue(object):
+    """upload files in the background, from a journal that survives restarts
+
+    enqueue() only records the job in a local sqlite journal (WAL mode)
+    and returns immediately. worker threads then upload the file and
+    add its user meta. a job is done once both steps succeeded. the media
+    id is journaled right after the upload, so a job interrupted by a
+    restart only redoes the meta step. failed requests are retried up to
+    max_attempts times with exponential backoff from retry_delay seconds.
+    """
+    DEFAULT_MAX_ATTEMPTS = 5
+    DEFAULT_RETRY_DELAY = 1.0
+
+    def __init__(self, mstorage, journal_path, max_workers=DEFAULT_MAX_WORKERS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY):
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than or equal to 1.')
+        self.__mstorage = mstorage
+        self.__max_attempts = max_attempts
+        self.__retry_delay = retry_delay
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        self.__conn = sqlite3.connect(journal_path, check_same_thread=False)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA synchronous=NORMAL')
+        with self.__conn:
+            for statement in _SCHEMA:
+                self.__conn.execute(statement)
+        self.__futures = {}
+        self.__timers = set()
+        self.__queue = queue.Queue()
+        self.__closed = False
+        rows = self.__conn.execute(
+            'SELECT id, path, content_type, meta, state, mid, attempts FROM jobs '
+            'WHERE state IN (?, ?) ORDER BY id', (PENDING, UPLOADED)).fetchall()
+        for row in rows:
+            self.__futures[row[0]] = UploadFuture(row[0])
+            self.__queue.put(_Job(*row))
+        self.__workers = [threading.Thread(target=self.__work) for dummy in range(max_workers)]
+        for worker in self.__workers:
+            worker.daemon = True
+            worker.start()
+
+    def enqueue(self, path, meta=None, content_type=None):
+        """journal the upload of a file and return its UploadFuture
+
+        meta is validated here, like add_meta does, so invalid metadata
+        is rejected before anything is recorded.
+        """
+        if meta:
+            _user_meta_items(meta)
+        path = os.path.abspath(path)
+        meta_json = json.dumps(meta) if meta else None
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('The upload queue is closed.')
+            with self.__conn:
+                cursor = self.__conn.execute(
+                    'INSERT INTO jobs (path, content_type, meta, state, created_at) '
+                    'VALUES (?, ?, ?, ?, ?)', (path, content_type, meta_json, PENDING, time.time()))
+            job_id = cursor.lastrowid
+            future = UploadFuture(job_id)
+            self.__futures[job_id] = future
+        self.__queue.put(_Job(job_id, path, content_type, meta_json, PENDING, None, 0))
+        return future
+
+    def future(self, job_id):
+        """return the UploadFuture of a job, including jobs journaled before a restart"""
+        with self.__lock:
+            future = self.__futures.get(job_id)
+        if future is not None:
+            return future
+        status = self.status(job_id)
+        if status is None:
+            raise KeyError(job_id)
+        future = UploadFuture(job_id)
+        future.set_running_or_notify_cancel()
+        if status.state == DONE:
+            future.set_result(status.mid)
+        else:
+            future.set_exception(RuntimeError(status.error))
+        return future
+
+    def status(self, job_id):
+        """return the JobStatus of a job, or None"""
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT state, mid, error, attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return JobStatus(*row) if row is not None else None
+
+    def pending(self):
+        """return the number of jobs not done or failed yet"""
+        with self.__lock:
+            return len(self.__futures)
+
+    def join(self, timeout=None):
+        """wait until every queued job is done or failed; return False on timeout"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.__idle:
+            while self.__futures:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__idle.wait(remaining)
+        return True
+
+    def close(self, wait=True):
+        """stop the workers
+
+        with wait, the queued jobs are drained first; otherwise they stay
+        in the journal and resume when the queue is opened again, and
+        their futures are cancelled.
+        """
+        if wait:
+            self.join()
+        with self.__lock:
+            self.__closed = True
+            timers = list(self.__timers)
+        for timer in timers:
+            timer.cancel()
+        for dummy in self.__workers:
+            self.__queue.put(None)
+        for worker in self.__workers:
+            worker.join()
+        with self.__idle:
+            futures = list(self.__futures.values())
+            self.__futures.clear()
+            self.__idle.notify_all()
+            self.__conn.close()
+        for future in futures:
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __journal(self, job_id, **columns):
+        names = sorted(columns)
+        sql = 'UPDATE jobs SET {0} WHERE id = ?'.format(', '.join(name + ' = ?' for name in names))
+        with self.__lock, self.__conn:
+            self.__conn.execute(sql, [columns[name] for name in names] + [job_id])
+
+    def __work(self):
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                return
+            with self.__lock:
+                if self.__closed:
+                    continue
+            self.__run(job)
+
+    def __run(self, job):
+        try:
+            if job.state == PENDING:
+                job.mid = self.__mstorage.upload(job.path, job.content_type)['id']
+                job.state = UPLOADED
+                self.__journal(job.job_id, state=UPLOADED, mid=job.mid)
+            if job.meta:
+                self.__mstorage.add_meta(job.mid, json.loads(job.meta))
+        except requests.exceptions.RequestException as exc:
+            job.attempts += 1
+            self.__journal(job.job_id, attempts=job.attempts, error=str(exc))
+            if job.attempts < self.__max_attempts and _retriable(exc):
+                self.__retry(job)
+            else:
+                self.__finish(job, FAILED, exc)
+            return
+        except Exception as exc: # pylint: disable=broad-except
+            # missing files, invalid responses, ...: fail the job, keep the worker
+            self.__finish(job, FAILED, exc)
+            return
+        self.__finish(job, DONE)
+
+    def __retry(self, job):
+        delay = self.__retry_delay * (2 ** (job.attempts - 1))
+        timer = threading.Timer(delay, self.__requeue, [job])
+        timer.daemon = True
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__timers.add(timer)
+        timer.start()
+
+    def __requeue(self, job):
+        with self.__lock:
+            self.__timers = set(timer for timer in self.__timers if timer.is_alive() and
+                                timer is not threading.current_thread())
+        self.__queue.put(job)
+
+    def __finish(self, job, state, error=None):
+        try:
+            self.__journal(job.job_id, state=state, error=str(error) if error is not None else None)
+        finally:
+            self.__resolve(job, error)
+
+    def __resolve(self, job, error):
+        with self.__idle:
+            future = self.__futures.pop(job.job_id, None)
+            self.__idle.notify_all()
+        if future is None or not future.set_running_or_notify_cancel():
+            return
+        if error is None:
+            future.set_result(job.mid)
+        else:
+            future.set_exception(error)
@@ -20,7 +20,19 @@ setup(
     install_requires=[
         'requests',
         'six',
+        'urllib3',
+        'futures; python_version < "3"',
     ],
+    entry_points={
+        'console_scripts': [
+            'mstorage-sync = ricohapi.mstorage.cli:main',
+        ],
+    },
+    extras_require={
+        'async': ['aiohttp'],
+        'fastjson': ['orjson'],
+        'thumbnails': ['Pillow'],
+    },
     test_suite='nose.collector',
     tests_require=['nose', 'mock','coverage'],
 )
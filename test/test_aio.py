@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import asyncio
+import gc
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, SkipTest
+from nose.tools import eq_, raises
+import mock
+from mock import Mock
+try:
+    from aiohttp import web, ClientResponseError
+    from ricohapi.mstorage.aio import AsyncMediaStorage
+except ImportError:
+    web = None
+
+class StubServer(object):
+    """minimal in-process Media Storage stand-in"""
+    def __init__(self):
+        self.media = {}
+        self.user_meta = {}
+        self.requests = []
+        app = web.Application()
+        app.router.add_route('*', '/v1/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        self.endpoint = None
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoint = 'http://127.0.0.1:{0}/v1'.format(port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.path, request.headers.get('Authorization')))
+        parts = request.path.split('/')[3:]
+        if request.method == 'POST' and parts == []:
+            mid = 'id{0}'.format(len(self.media))
+            self.media[mid] = await request.read()
+            self.user_meta[mid] = {}
+            return web.json_response({'id': mid})
+        if request.method == 'GET' and parts == []:
+            ids = sorted(self.media)
+            if 'after' in request.query:
+                ids = ids[ids.index(request.query['after']) + 1:]
+            ids = ids[:int(request.query.get('limit', 25))]
+            return web.json_response({'media': [{'id': mid} for mid in ids]})
+        if parts[0] not in self.media:
+            raise web.HTTPNotFound()
+        mid = parts[0]
+        if parts[1:] == [] and request.method == 'GET':
+            return web.json_response({'id': mid, 'bytes': len(self.media[mid])})
+        if parts[1:] == [] and request.method == 'DELETE':
+            del self.media[mid]
+            return web.Response()
+        if parts[1:] == ['content']:
+            return web.Response(body=self.media[mid])
+        if parts[1:] == ['meta', 'user'] and request.method == 'GET':
+            return web.json_response(self.user_meta[mid])
+        if parts[1:3] == ['meta', 'user'] and request.method == 'PUT':
+            self.user_meta[mid]['user.' + parts[3]] = (await request.read()).decode('utf-8')
+            return web.Response()
+        if parts[1:3] == ['meta', 'user'] and request.method == 'GET':
+            return web.Response(text=self.user_meta[mid]['user.' + parts[3]])
+        raise web.HTTPNotFound()
+
+class TestAsyncMediaStorage(TestCase):
+    def setUp(self):
+        if web is None:
+            raise SkipTest('aiohttp is not installed')
+        self.loop = asyncio.new_event_loop()
+        self.server = StubServer()
+        self.loop.run_until_complete(self.server.start())
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = AsyncMediaStorage(self.aclient, endpoint=self.server.endpoint)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.mstorage.close())
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def upload(self, data):
+        path = os.path.join(self.tmpdir, 'upload.jpg')
+        with open(path, 'wb') as ofile:
+            ofile.write(data)
+        return self.run_async(self.mstorage.upload(path))['id']
+
+    def test_upload_download(self):
+        mid = self.upload(b'jpegdata')
+        eq_(self.run_async(self.mstorage.download(mid)), b'jpegdata')
+        eq_(self.run_async(self.mstorage.info(mid)), {'id': mid, 'bytes': 8})
+        eq_(self.server.requests[0][2], 'Bearer atoken')
+
+    def test_download_to(self):
+        mid = self.upload(b'jpegdata' * 1000)
+        path = os.path.join(self.tmpdir, 'download.jpg')
+        self.run_async(self.mstorage.download_to(mid, path, chunk_size=100))
+        with open(path, 'rb') as ifile:
+            eq_(ifile.read(), b'jpegdata' * 1000)
+
+    def test_iter_media(self):
+        mids = [self.upload(b'data') for dummy in range(5)]
+        async def collect():
+            found = []
+            async for mid in self.mstorage.iter_media(page_size=2):
+                found.append(mid)
+            return found
+        eq_(self.run_async(collect()), sorted(mids))
+
+    def test_iter_download_stops_early(self):
+        mid = self.upload(b'jpegdata' * 1000)
+        async def first():
+            async with self.mstorage.iter_download(mid, chunk_size=100) as chunks:
+                async for chunk in chunks:
+                    return chunk
+        eq_(self.run_async(first()), b'jpegdata' * 12 + b'jpeg')
+        eq_(self.run_async(self.mstorage.download(mid)), b'jpegdata' * 1000)
+
+    def test_download_to_write_error(self):
+        mid = self.upload(b'jpegdata' * 1000)
+        ofile = mock.MagicMock()
+        ofile.__enter__.return_value.write.side_effect = IOError
+        release = Mock()
+        with mock.patch('ricohapi.mstorage.aio.open', Mock(return_value=ofile), create=True), \
+             mock.patch('aiohttp.ClientResponse.release', release):
+            try:
+                self.run_async(self.mstorage.download_to(mid, 'download.jpg', chunk_size=100))
+            except IOError:
+                pass
+        eq_(release.called, True)
+
+    def test_client_kept_alive(self):
+        class Client(object):
+            def session(self, scope):
+                pass
+            def get_access_token(self):
+                return 'atoken'
+        def make():
+            return AsyncMediaStorage(Client(), endpoint=self.server.endpoint)
+        mstorage = make()
+        gc.collect()
+        try:
+            self.run_async(mstorage.connect())
+        finally:
+            self.run_async(mstorage.close())
+
+    def test_token_fetched_off_loop(self):
+        threads = []
+        self.aclient.get_access_token = Mock(
+            side_effect=lambda: threads.append(threading.current_thread()) or 'atoken')
+        self.upload(b'data')
+        eq_(len(threads), 1)
+        eq_(threads[0] is threading.current_thread(), False)
+
+    def test_meta(self):
+        mid = self.upload(b'data')
+        self.run_async(self.mstorage.add_meta(mid, {'user.key1': 'value1', 'user.key2': u'value2'}))
+        eq_(self.run_async(self.mstorage.meta(mid, 'user')), {'user.key1': 'value1', 'user.key2': 'value2'})
+        eq_(self.run_async(self.mstorage.meta(mid, 'user.key1')), 'value1')
+
+    def test_delete(self):
+        mid = self.upload(b'data')
+        self.run_async(self.mstorage.delete(mid))
+        eq_(self.server.media, {})
+
+    @raises(ClientResponseError)
+    def test_not_found_error(self):
+        self.run_async(self.mstorage.info('missing'))
+
+    @raises(ValueError)
+    def test_add_meta_key_error(self):
+        self.run_async(self.mstorage.add_meta('id1', {'invalid_key': 'value'}))
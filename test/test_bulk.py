@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import threading
+import time
+from unittest import TestCase
+from nose.tools import eq_, raises
+from concurrent.futures import ThreadPoolExecutor
+from ricohapi.mstorage.bulk import run_bulk, run_shared, RateLimiter
+
+class TestRunBulk(TestCase):
+    def test_results(self):
+        ret = sorted(run_bulk(lambda num: num * 2, range(10), max_workers=3))
+        eq_([result.value for result in ret], [num * 2 for num in range(10)])
+        eq_([result.error for result in ret], [None] * 10)
+
+    def test_error_does_not_abort(self):
+        def func(num):
+            if num == 3:
+                raise IOError('bad file')
+            return num
+        ret = {result.key: result for result in run_bulk(func, range(5))}
+        eq_(len(ret), 5)
+        eq_(isinstance(ret[3].error, IOError), True)
+        eq_(ret[3].value, None)
+        eq_(ret[4].value, 4)
+
+    def test_bounded_parallelism(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+        def func(num):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            with lock:
+                state['running'] -= 1
+            return num
+        eq_(len(list(run_bulk(func, range(50), max_workers=2))), 50)
+        eq_(state['peak'] <= 2, True)
+
+    def test_lazy_items(self):
+        consumed = []
+        def items():
+            for num in range(100):
+                consumed.append(num)
+                yield num
+        results = run_bulk(lambda num: num, items(), max_workers=1)
+        next(results)
+        eq_(len(consumed) <= 3, True)
+        results.close()
+
+    @raises(ValueError)
+    def test_max_workers_error(self):
+        list(run_bulk(lambda num: num, range(3), max_workers=0))
+
+    def test_rate(self):
+        started = time.time()
+        eq_(len(list(run_bulk(lambda num: num, range(6), max_workers=3, rate=RateLimiter(50, burst=1)))), 6)
+        eq_(time.time() - started >= 0.08, True)
+
+class TestRateLimiter(TestCase):
+    def test_burst(self):
+        limiter = RateLimiter(10, burst=3)
+        started = time.time()
+        for dummy in range(3):
+            limiter.acquire()
+        eq_(time.time() - started < 0.05, True)
+        limiter.acquire()
+        eq_(time.time() - started >= 0.09, True)
+
+    @raises(ValueError)
+    def test_rate_error(self):
+        RateLimiter(0)
+
+class TestRunShared(TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    def test_all_called(self):
+        done = []
+        run_shared(self.executor, done.append, range(10), max_workers=3)
+        eq_(sorted(done), list(range(10)))
+
+    def test_bounded_parallelism(self):
+        lock = threading.Lock()
+        active = [0, 0]
+        def func(dummy):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+        run_shared(self.executor, func, range(8), max_workers=2)
+        eq_(active[1], 2)
+
+    def test_nested_does_not_deadlock(self):
+        done = []
+        def outer(num):
+            run_shared(self.executor, done.append, [num * 10, num * 10 + 1], max_workers=2)
+        run_shared(self.executor, outer, range(4), max_workers=3)
+        eq_(sorted(done), [0, 1, 10, 11, 20, 21, 30, 31])
+
+    @raises(IOError)
+    def test_error_raised(self):
+        def func(num):
+            if num == 3:
+                raise IOError('bad meta')
+        run_shared(self.executor, func, range(10), max_workers=2)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from nose.tools import eq_, raises
+import mock
+from ricohapi.mstorage.cache import MetaCache, SqliteCacheBackend
+
+class TestMetaCache(TestCase):
+    def test_get_set(self):
+        cache = MetaCache()
+        eq_(cache.get('id1', 'exif'), None)
+        cache.set('id1', 'exif', {'a': 'b'})
+        eq_(cache.get('id1', 'exif'), {'a': 'b'})
+        eq_(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1})
+
+    def test_lru_eviction(self):
+        cache = MetaCache(maxsize=2)
+        cache.set('id1', 'exif', 1)
+        cache.set('id2', 'exif', 2)
+        cache.get('id1', 'exif')
+        cache.set('id3', 'exif', 3)
+        eq_(cache.get('id2', 'exif'), None)
+        eq_(cache.get('id1', 'exif'), 1)
+        eq_(cache.get('id3', 'exif'), 3)
+        eq_(cache.stats()['evictions'], 1)
+
+    @mock.patch('ricohapi.mstorage.cache.time.time')
+    def test_ttl(self, now):
+        now.return_value = 100.0
+        cache = MetaCache(ttl=10)
+        cache.set('id1', 'exif', 1)
+        now.return_value = 109.0
+        eq_(cache.get('id1', 'exif'), 1)
+        now.return_value = 110.0
+        eq_(cache.get('id1', 'exif'), None)
+        eq_(cache.stats()['size'], 0)
+
+    def test_invalidate(self):
+        cache = MetaCache()
+        cache.set('id1', 'exif', 1)
+        cache.set('id1', 'user', 2)
+        cache.set('id2', 'user', 3)
+        cache.invalidate('id1')
+        eq_(cache.get('id1', 'exif'), None)
+        eq_(cache.get('id1', 'user'), None)
+        eq_(cache.get('id2', 'user'), 3)
+
+    def test_set_after_invalidate_dropped(self):
+        cache = MetaCache()
+        generation = cache.generation('id1')
+        other = cache.generation('id2')
+        cache.invalidate('id1')
+        cache.set('id1', 'exif', 1, generation)
+        cache.set('id2', 'exif', 2, other)
+        eq_(cache.get('id1', 'exif'), None)
+        eq_(cache.get('id2', 'exif'), 2)
+        cache.set('id1', 'exif', 1, cache.generation('id1'))
+        eq_(cache.get('id1', 'exif'), 1)
+
+    def test_generations_bounded(self):
+        cache = MetaCache(maxsize=2)
+        generation = cache.generation('id1')
+        cache.invalidate('id1')
+        cache.invalidate('id2')
+        cache.invalidate('id3')
+        cache.set('id1', 'exif', 1, generation)
+        eq_(cache.get('id1', 'exif'), None)
+
+    def test_set_after_clear_dropped(self):
+        cache = MetaCache()
+        generation = cache.generation('id1')
+        cache.clear()
+        cache.set('id1', 'exif', 1, generation)
+        eq_(cache.get('id1', 'exif'), None)
+
+    @raises(ValueError)
+    def test_maxsize_error(self):
+        MetaCache(maxsize=0)
+
+class TestSqliteCacheBackend(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_survives_restart(self):
+        backend = SqliteCacheBackend(self.path)
+        MetaCache(backend=backend).set('id1', 'exif', {'a': 'b'})
+        backend.close()
+        cache = MetaCache(backend=SqliteCacheBackend(self.path))
+        eq_(cache.get('id1', 'exif'), {'a': 'b'})
+        eq_(cache.stats()['hits'], 1)
+
+    def test_invalidate(self):
+        backend = SqliteCacheBackend(self.path)
+        cache = MetaCache(backend=backend)
+        cache.set('id1', 'exif', 1)
+        cache.set('id2', 'exif', 2)
+        cache.invalidate('id1')
+        eq_(backend.get('id1', 'exif'), None)
+        eq_(backend.get('id2', 'exif')[0], 2)
+        cache.clear()
+        eq_(backend.get('id2', 'exif'), None)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from nose.tools import eq_, raises
+import mock
+from mock import Mock
+from ricohapi.mstorage.cache import MetaCache
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.dedup import HashIndex, hash_source
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+
+JPEG = b'\xff\xd8\xff\xe0' + b'jpegdata' * 1000
+DIGEST = hashlib.sha256(JPEG).hexdigest()
+
+class PathLike(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __fspath__(self):
+        return self.path
+
+class TestHashSource(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'media.jpg')
+        with open(self.path, 'wb') as ofile:
+            ofile.write(JPEG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_buffered(self):
+        digest, body = hash_source(self.path)
+        eq_(digest, DIGEST)
+        eq_(bytes(body), JPEG)
+
+    def test_file_over_max_buffer(self):
+        eq_(hash_source(self.path, max_buffer=10), (DIGEST, self.path))
+
+    def test_path_like(self):
+        eq_(hash_source(PathLike(self.path), max_buffer=10), (DIGEST, self.path))
+
+    def test_file_remembered(self):
+        index = HashIndex()
+        hash_source(self.path, index)
+        with mock.patch('ricohapi.mstorage.dedup._hash_file') as hash_file:
+            eq_(hash_source(self.path, index), (DIGEST, self.path))
+            eq_(hash_file.call_count, 0)
+
+    def test_buffer_and_streams(self):
+        eq_(hash_source(JPEG), (DIGEST, JPEG))
+        eq_(hash_source(io.BytesIO(JPEG))[0], DIGEST)
+        digest, body = hash_source(iter([JPEG[:10], JPEG[10:]]))
+        eq_(digest, DIGEST)
+        eq_(bytes(body), JPEG)
+
+class TestHashIndex(TestCase):
+    def test_lookup(self):
+        index = HashIndex()
+        eq_(index.lookup('digest'), None)
+        index.add('digest', 'id1')
+        eq_(index.lookup('digest'), 'id1')
+        eq_(len(index), 1)
+        index.discard_media('id1')
+        eq_(index.lookup('digest'), None)
+
+    def test_persistent(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'index.db')
+            index = HashIndex(path)
+            index.add('digest', 'id1')
+            index.close()
+            eq_(HashIndex(path).lookup('digest'), 'id1')
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestDedupUpload(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer().start()
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.index = HashIndex()
+        self.mstorage = MediaStorage(self.aclient, endpoint=self.server.endpoint,
+                                     hash_index=self.index, hash_meta_key='user.sha256')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_duplicate_skipped(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        eq_(self.mstorage.upload(io.BytesIO(JPEG))['id'], mid)
+        eq_(len(list(self.mstorage.iter_media())), 1)
+        eq_(self.mstorage.meta(mid, 'user.sha256'), DIGEST)
+
+    def test_deleted_on_server(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        self.server.delete_media(mid)
+        eq_(self.mstorage.upload(JPEG)['id'] != mid, True)
+
+    def test_deleted_on_server_while_cached(self):
+        mstorage = MediaStorage(self.aclient, endpoint=self.server.endpoint, cache=MetaCache(),
+                                hash_index=self.index)
+        mid = mstorage.upload(JPEG)['id']
+        mstorage.info(mid)
+        self.server.delete_media(mid)
+        eq_(mstorage.upload(JPEG)['id'] != mid, True)
+
+    def test_delete_discards(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        self.mstorage.delete(mid)
+        eq_(self.index.lookup(DIGEST), None)
+
+    @raises(ValueError)
+    def test_invalid_meta_key(self):
+        MediaStorage(self.aclient, hash_index=self.index, hash_meta_key='sha256')
+
+    def test_rebuild(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        self.mstorage.upload(b'other')
+        index = HashIndex()
+        eq_(index.rebuild(self.mstorage, 'user.sha256'), 2)
+        eq_(index.lookup(DIGEST), mid)
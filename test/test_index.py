@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import datetime
+from unittest import TestCase
+from nose.tools import eq_
+from mock import Mock
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+from ricohapi.mstorage.index import MetaIndex, _gps_coordinate
+
+class TestMetaIndex(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer().start()
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(aclient, endpoint=self.server.endpoint)
+        self.a = self.server.add_media(b'a', exif={
+            'DateTimeOriginal': '2016:07:08 10:00:00', 'Make': 'RICOH', 'Model': 'RICOH THETA S',
+            'GPSLatitude': 35.6, 'GPSLatitudeRef': 'N', 'GPSLongitude': 139.7, 'GPSLongitudeRef': 'E',
+        }, user={'user.trip': 'tokyo-2016'})['id']
+        self.b = self.server.add_media(b'b', exif={
+            'DateTimeOriginal': '2016:08:01 09:30:00', 'Make': 'RICOH', 'Model': 'RICOH THETA m15',
+            'GPSLatitude': [33, 51, 0], 'GPSLatitudeRef': 'S',
+            'GPSLongitude': [151, 12, 0], 'GPSLongitudeRef': 'E',
+        }, user={'user.trip': 'sydney-2016'})['id']
+        self.c = self.server.add_media(b'c', exif={'Model': 'Other'})['id']
+        self.index = MetaIndex()
+
+    def tearDown(self):
+        self.index.close()
+        self.server.stop()
+
+    def test_refresh_and_query(self):
+        report = self.index.refresh(self.mstorage)
+        eq_((report.added, report.refreshed, report.removed), (3, 0, 0))
+        eq_(len(self.index), 3)
+        eq_(self.index.query(model_prefix='RICOH THETA'), [self.a, self.b])
+        eq_(self.index.query(model='Other'), [self.c])
+        eq_(self.index.query(captured_after='2016-07-15'), [self.b])
+        eq_(self.index.query(captured_before=datetime.datetime(2016, 7, 15)), [self.a])
+        eq_(self.index.query(bbox=(30, 130, 40, 150)), [self.a])
+        eq_(self.index.query(bbox=(-40, 150, -30, 152)), [self.b])
+        eq_(self.index.query(user={'user.trip': 'tokyo-2016'}), [self.a])
+        eq_(self.index.query(user_prefix={'user.trip': 'sydney'}), [self.b])
+        eq_(self.index.query(make='RICOH', limit=1), [self.a])
+        info, meta = self.index.get(self.a)
+        eq_(info['id'], self.a)
+        eq_(meta['user'], {'user.trip': 'tokyo-2016'})
+
+    def test_refresh_incremental(self):
+        self.index.refresh(self.mstorage)
+        requests = self.server.stats()['requests']
+        self.server.delete_media(self.c)
+        d = self.server.add_media(b'd')['id']
+        report = self.index.refresh(self.mstorage)
+        eq_((report.added, report.refreshed, report.removed), (1, 0, 1))
+        # one listing page, info and meta of the new media only
+        eq_(self.server.stats()['requests'] - requests, 3)
+        eq_(self.index.get(self.c), None)
+        eq_(self.index.get(d)[0]['id'], d)
+
+    def test_refresh_max_age_and_mids(self):
+        self.index.refresh(self.mstorage)
+        report = self.index.refresh(self.mstorage, max_age=0)
+        eq_((report.added, report.refreshed), (0, 3))
+        self.server.get_media(self.a)['user']['user.trip'] = 'osaka-2016'
+        report = self.index.refresh(self.mstorage, mids=[self.a])
+        eq_(report.refreshed, 1)
+        eq_(self.index.query(user={'user.trip': 'osaka-2016'}), [self.a])
+
+    def test_refresh_failed(self):
+        self.server.error_rate = 1.0
+        self.server.error_status = 404
+        report = self.index.refresh(self.mstorage, mids=[self.a])
+        eq_(list(report.failed), [self.a])
+        eq_(len(self.index), 0)
+
+    def test_gps_coordinate(self):
+        eq_(_gps_coordinate([10, 30, 0], 'W'), -10.5)
+        eq_(_gps_coordinate('1.5', 'N'), 1.5)
+        eq_(_gps_coordinate('x', 'N'), None)
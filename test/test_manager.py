@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import threading
+from unittest import TestCase
+from nose.tools import eq_, raises
+from mock import Mock
+from ricohapi.mstorage.manager import AccountManager
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+
+def auth_client(token):
+    aclient = Mock()
+    aclient.get_access_token = Mock(return_value=token)
+    return aclient
+
+class TestAccountManager(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer().start()
+        self.manager = AccountManager(max_workers=1, endpoint=self.server.endpoint)
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def test_accounts_share_pool(self):
+        alice = auth_client('alice')
+        bob = auth_client('bob')
+        mstorage = self.manager.add('alice', alice)
+        self.manager.add('bob', bob, connect=False)
+        alice.session.assert_called_once_with('https://ucs.ricoh.com/scope/api/udc2')
+        eq_(bob.session.called, False)
+        eq_(mstorage.pool is self.manager.get('bob').pool, True)
+        eq_(mstorage.pool is self.manager.pool, True)
+        eq_((len(self.manager), 'bob' in self.manager, sorted(self.manager.keys())),
+            (2, True, ['alice', 'bob']))
+
+    def test_submit(self):
+        aclient = auth_client('alice')
+        self.manager.add('alice', aclient)
+        mid = self.manager.submit('alice', lambda mstorage, data: mstorage.upload(data)['id'], b'abc').result()
+        eq_(self.manager.submit('alice', lambda mstorage: mstorage.download(mid)).result(), b'abc')
+        eq_(aclient.get_access_token.call_count, 1)
+
+    def test_submit_error(self):
+        self.manager.add('alice', auth_client('alice'))
+        future = self.manager.submit('alice', lambda mstorage: mstorage.info('missing'))
+        eq_(future.exception().response.status_code, 404)
+
+    def test_round_robin(self):
+        self.manager.add('a', auth_client('a'))
+        self.manager.add('b', auth_client('b'))
+        gate = threading.Event()
+        order = []
+        blocker = self.manager.submit('a', lambda mstorage: gate.wait())
+        futures = [self.manager.submit('a', lambda mstorage, num=num: order.append('a%d' % num))
+                   for num in range(3)]
+        futures += [self.manager.submit('b', lambda mstorage, num=num: order.append('b%d' % num))
+                    for num in range(2)]
+        gate.set()
+        blocker.result()
+        for future in futures:
+            future.result()
+        eq_(order, ['a0', 'b0', 'a1', 'b1', 'a2'])
+
+    def test_remove_cancels_pending(self):
+        self.manager.add('a', auth_client('a'))
+        gate = threading.Event()
+        blocker = self.manager.submit('a', lambda mstorage: gate.wait())
+        pending = self.manager.submit('a', lambda mstorage: None)
+        self.manager.remove('a')
+        gate.set()
+        blocker.result()
+        eq_(pending.cancelled(), True)
+        eq_('a' in self.manager, False)
+
+    @raises(ValueError)
+    def test_duplicate_account(self):
+        self.manager.add('a', auth_client('a'), connect=False)
+        self.manager.add('a', auth_client('a'), connect=False)
+
+    def test_duplicate_account_not_connected(self):
+        self.manager.add('a', auth_client('a'))
+        aclient = auth_client('a')
+        try:
+            self.manager.add('a', aclient)
+        except ValueError:
+            pass
+        eq_(aclient.session.called, False)
+
+    def test_failed_connect_not_registered(self):
+        aclient = auth_client('a')
+        aclient.session.side_effect = IOError
+        try:
+            self.manager.add('a', aclient)
+        except IOError:
+            pass
+        eq_('a' in self.manager, False)
+        self.manager.add('a', auth_client('a'))
+
+    @raises(RuntimeError)
+    def test_submit_after_close(self):
+        self.manager.add('a', auth_client('a'), connect=False)
+        self.manager.close()
+        self.manager.submit('a', lambda mstorage: None)
+
+    def test_shared_pool_left_open(self):
+        pool = Mock()
+        AccountManager(pool=pool).close()
+        eq_(pool.close.called, False)
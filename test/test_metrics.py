@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+from unittest import TestCase
+from nose.tools import eq_
+import mock
+from mock import Mock
+from requests.exceptions import RequestException
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.metrics import RequestEvent, HistogramCollector, StatsdSink, PrometheusSink
+
+def event(duration, status=200, error=None):
+    return RequestEvent('get', '/media/{mid}', status, 10, None, duration, 0, error)
+
+class TestHistogramCollector(TestCase):
+    def test_snapshot(self):
+        collector = HistogramCollector(buckets=(0.1, 1.0))
+        collector(event(0.05))
+        collector(event(0.5))
+        collector(event(5.0, None, RequestException()))
+        series = collector.snapshot()[('get', '/media/{mid}')]
+        eq_(series['count'], 3)
+        eq_(series['errors'], 1)
+        eq_(series['bytes_in'], 30)
+        eq_(series['buckets'], [1, 1, 1])
+
+    def test_quantile(self):
+        collector = HistogramCollector(buckets=(0.1, 1.0))
+        for dummy in range(99):
+            collector(event(0.05))
+        collector(event(0.5))
+        eq_(collector.quantile('get', '/media/{mid}', 0.5), 0.1)
+        eq_(collector.quantile('get', '/media/{mid}', 1.0), 1.0)
+        eq_(collector.quantile('get', '/media', 0.5), None)
+
+class TestSinks(TestCase):
+    def test_statsd(self):
+        client = Mock()
+        StatsdSink(client)(RequestEvent('put', '/media/{mid}/meta/user/{key}', 204, 0, 5, 0.25, 2, None))
+        client.timing.assert_called_once_with('mstorage.put.media.mid.meta.user.key', 250.0)
+        client.incr.assert_has_calls([
+            mock.call('mstorage.put.media.mid.meta.user.key.status.204'),
+            mock.call('mstorage.put.media.mid.meta.user.key.retries', 2),
+        ])
+
+    def test_prometheus(self):
+        histogram = Mock()
+        PrometheusSink(histogram)(event(0.25, None, RequestException()))
+        histogram.labels.assert_called_once_with('GET', '/media/{mid}', 'error')
+        histogram.labels.return_value.observe.assert_called_once_with(0.25)
+
+class TestRequestHooks(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.events = []
+        self.mstorage = MediaStorage(self.aclient, hooks=[self.events.append])
+
+    @mock.patch('requests.Session.request')
+    def test_event(self, req):
+        req.return_value.status_code = 204
+        req.return_value.headers = {'Content-Length': '0'}
+        self.mstorage.add_meta('id1', {'user.key': 'value'})
+        eq_(len(self.events), 1)
+        eq_(self.events[0].method, 'put')
+        eq_(self.events[0].template, '/media/{mid}/meta/user/{key}')
+        eq_(self.events[0].status, 204)
+        eq_(self.events[0].bytes_out, 5)
+        eq_(self.events[0].error, None)
+
+    @mock.patch('requests.Session.request')
+    def test_error_event(self, req):
+        req.side_effect = RequestException()
+        try:
+            self.mstorage.info('id1')
+        except RequestException:
+            pass
+        eq_(self.events[0].template, '/media/{mid}')
+        eq_(self.events[0].status, None)
+        eq_(isinstance(self.events[0].error, RequestException), True)
+
+    @mock.patch('requests.Session.request')
+    def test_hook_failure_ignored(self, req):
+        req.return_value.content = b'{"a": "b"}'
+        hook = Mock(side_effect=RuntimeError)
+        self.mstorage.remove_hook(self.events.append)
+        self.mstorage.add_hook(hook)
+        eq_(self.mstorage.info('id1'), {'a': 'b'})
+        eq_(hook.call_count, 1)
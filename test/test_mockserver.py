@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from nose.tools import eq_, raises
+from mock import Mock
+from requests.exceptions import HTTPError
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+from ricohapi.mstorage.pool import SessionPool
+from ricohapi.mstorage.metrics import HistogramCollector
+
+JPEG = b'\xff\xd8\xff\xe0' + b'jpegdata' * 100
+
+class TestMockServer(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer(seed=0).start()
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(aclient, pool=SessionPool(retries=0), endpoint=self.server.endpoint)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.mstorage.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upload_download(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        eq_(self.mstorage.download(mid), JPEG)
+        eq_(self.mstorage.info(mid)['bytes'], len(JPEG))
+        path = os.path.join(self.tmpdir, 'media.jpg')
+        self.mstorage.download_to(mid, path, chunk_size=64)
+        with open(path, 'rb') as ifile:
+            eq_(ifile.read(), JPEG)
+
+    def test_upload_chunked(self):
+        mid = self.mstorage.upload(iter([b'\x89PNG\r\n\x1a\n', b'pngdata']))['id']
+        eq_(self.mstorage.info(mid)['content_type'], 'image/png')
+        eq_(self.mstorage.download(mid), b'\x89PNG\r\n\x1a\npngdata')
+
+    def test_iter_media(self):
+        mids = [self.mstorage.upload(JPEG)['id'] for dummy in range(7)]
+        eq_(list(self.mstorage.iter_media(page_size=3)), mids)
+        self.mstorage.add_meta(mids[2], {'user.tag': 'a'})
+        self.mstorage.add_meta(mids[5], {'user.tag': 'a'})
+        eq_(list(self.mstorage.iter_media({'meta.user.tag': 'a'}, page_size=1)), [mids[2], mids[5]])
+
+    def test_meta(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        self.mstorage.add_meta(mid, {'user.key1': 'value1', 'user.key2': u'value２'})
+        eq_(self.mstorage.meta(mid, 'user'), {'user.key1': 'value1', 'user.key2': u'value２'})
+        eq_(self.mstorage.meta(mid, 'user.key2'), u'value２')
+        self.mstorage.remove_meta(mid, 'user.key1')
+        eq_(self.mstorage.meta(mid), {'exif': {}, 'gpano': {}, 'user': {'user.key2': u'value２'}})
+
+    def test_download_many_resume(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        with open(os.path.join(self.tmpdir, mid + '.part'), 'wb') as ofile:
+            ofile.write(JPEG[:100])
+        ret = list(self.mstorage.download_many([mid], self.tmpdir))
+        eq_(ret[0].value.received, len(JPEG) - 100)
+        with open(os.path.join(self.tmpdir, mid), 'rb') as ifile:
+            eq_(ifile.read(), JPEG)
+
+    @raises(HTTPError)
+    def test_delete(self):
+        mid = self.mstorage.upload(JPEG)['id']
+        self.mstorage.delete(mid)
+        self.mstorage.info(mid)
+
+    @raises(HTTPError)
+    def test_error_injection(self):
+        self.server.error_rate = 1.0
+        self.mstorage.list()
+
+    def test_hooks(self):
+        collector = HistogramCollector()
+        self.mstorage.add_hook(collector)
+        mid = self.mstorage.upload(JPEG)['id']
+        self.mstorage.meta(mid, 'exif')
+        self.mstorage.download(mid)
+        series = collector.snapshot()
+        eq_(sorted(series), [
+            ('get', '/media/{mid}/content'),
+            ('get', '/media/{mid}/meta/exif'),
+            ('post', '/media'),
+        ])
+        eq_(series[('post', '/media')]['bytes_out'], len(JPEG))
+        eq_(series[('get', '/media/{mid}/content')]['bytes_in'], len(JPEG))
+
+    def test_stats(self):
+        self.mstorage.upload(JPEG)
+        self.mstorage.list()
+        stats = self.server.stats()
+        eq_(stats['requests'], 2)
+        eq_(stats['bytes_in'], len(JPEG))
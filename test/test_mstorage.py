@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
 
+import gc
+import io
 import json
+import os
+import shutil
+import tempfile
+import weakref
 from unittest import TestCase
 from nose.tools import eq_, raises
 import mock
 from mock import Mock
-from requests.exceptions import RequestException
-from ricohapi.mstorage.client import MediaStorage
+from requests.exceptions import RequestException, HTTPError, ConnectionError as RequestsConnectionError
+from ricohapi.mstorage import client
+from ricohapi.mstorage.client import MediaStorage, MediaPage
+from ricohapi.mstorage.pool import SessionPool
+from ricohapi.mstorage.cache import MetaCache
 
 ENDPOINT = 'https://mss.ricohapi.com/v1'
 SCOPE = 'https://ucs.ricoh.com/scope/api/udc2'
@@ -18,6 +27,15 @@ class TestInit(TestCase):
         mstorage = MediaStorage(aclient)
         eq_(mstorage._MediaStorage__aclient, aclient)
 
+    def test_pool_shared_per_aclient(self):
+        aclient = Mock()
+        eq_(MediaStorage(aclient).pool is MediaStorage(aclient).pool, True)
+        eq_(MediaStorage(aclient).pool is MediaStorage(Mock()).pool, False)
+
+    def test_pool_explicit(self):
+        pool = SessionPool()
+        eq_(MediaStorage(Mock(), pool=pool).pool is pool, True)
+
 class TestConnect(TestCase):
     def test_ok(self):
         aclient = Mock()
@@ -32,19 +50,89 @@ class TestMethodOk(TestCase):
         self.mstorage = MediaStorage(self.aclient)
         self.mstorage.connect()
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     @mock.patch('ricohapi.mstorage.client.open')
     def test_upload_ok(self, opn, req):
-        opn.side_effect = mock.mock_open()
-        opn.read_data = b'readdata'
-        req.return_value.text = '{"a": "b"}'
+        opn.side_effect = mock.mock_open(read_data=b'readdata')
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.upload('path.jpg')
         opn.assert_called_once_with('path.jpg', 'rb')
         headers = {'Authorization': 'Bearer atoken', 'Content-Type': 'image/jpeg'}
         req.assert_called_once_with('post', ENDPOINT+'/media', headers=headers, data=opn())
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
+    @mock.patch('ricohapi.mstorage.client.open')
+    def test_upload_path_like_ok(self, opn, req):
+        opn.side_effect = mock.mock_open(read_data=b'readdata')
+        req.return_value.content = b'{"a": "b"}'
+        path = Mock(spec=['__fspath__'])
+        path.__fspath__ = Mock(return_value='path.jpg')
+        eq_(self.mstorage.upload(path), {'a': 'b'})
+        opn.assert_called_once_with('path.jpg', 'rb')
+
+    @mock.patch('requests.Session.request')
+    def test_upload_bytes_ok(self, req):
+        req.return_value.content = b'{"id": "id1"}'
+        data = b'\x89PNG\r\n\x1a\n' + b'pngdata'
+        ret = self.mstorage.upload(data)
+        headers = {'Authorization': 'Bearer atoken', 'Content-Type': 'image/png'}
+        req.assert_called_once_with('post', ENDPOINT+'/media', headers=headers, data=data)
+        eq_(ret, {'id': 'id1'})
+
+    @mock.patch('requests.Session.request')
+    def test_upload_buffer_ok(self, req):
+        req.return_value.content = b'{"id": "id1"}'
+        data = bytearray(b'\x00\x00\x00\x18ftypmp42' + b'mp4data')
+        self.mstorage.upload(memoryview(data))
+        kwargs = req.call_args[1]
+        eq_(kwargs['headers']['Content-Type'], 'video/mp4')
+        eq_(len(kwargs['data']), len(data))
+        eq_(kwargs['data'].read(), bytes(data))
+
+    @mock.patch('requests.Session.request')
+    def test_upload_file_object_ok(self, req):
+        req.return_value.content = b'{"id": "id1"}'
+        payload = io.BytesIO(b'prefix\xff\xd8\xff\xe0jpegdata')
+        payload.seek(6)
+        self.mstorage.upload(payload, content_type='image/x-custom')
+        kwargs = req.call_args[1]
+        eq_(kwargs['headers']['Content-Type'], 'image/x-custom')
+        eq_(kwargs['data'] is payload, True)
+        eq_(payload.tell(), 6)
+
+    @mock.patch('requests.Session.request')
+    def test_upload_non_seekable_ok(self, req):
+        req.return_value.content = b'{"id": "id1"}'
+        payload = Mock()
+        payload.tell.side_effect = IOError
+        payload.read.side_effect = [b'\xff\xd8\xff\xe0', b'jpegdata', b'']
+        self.mstorage.upload(payload)
+        kwargs = req.call_args[1]
+        eq_(kwargs['headers']['Content-Type'], 'image/jpeg')
+        eq_(b''.join(kwargs['data']), b'\xff\xd8\xff\xe0jpegdata')
+
+    @mock.patch('requests.Session.request')
+    def test_upload_chunks_ok(self, req):
+        req.return_value.content = b'{"id": "id1"}'
+        self.mstorage.upload(iter([b'\x89PNG\r\n\x1a\n', b'pngdata']))
+        kwargs = req.call_args[1]
+        eq_(kwargs['headers']['Content-Type'], 'image/png')
+        eq_(b''.join(kwargs['data']), b'\x89PNG\r\n\x1a\npngdata')
+
+    @mock.patch('ricohapi.mstorage.client.MediaStorage.upload')
+    def test_upload_many_ok(self, upload):
+        def upload_one(path, content_type):
+            if path == 'bad.jpg':
+                raise IOError('bad file')
+            return {'id': 'id-' + path}
+        upload.side_effect = upload_one
+        ret = {result.key: result for result in self.mstorage.upload_many(['a.jpg', 'bad.jpg', 'b.jpg'], max_workers=2)}
+        eq_(ret['a.jpg'].value, 'id-a.jpg')
+        eq_(ret['b.jpg'].value, 'id-b.jpg')
+        eq_(isinstance(ret['bad.jpg'].error, IOError), True)
+
+    @mock.patch('requests.Session.request')
     def test_download_ok(self, req):
         req.return_value.content = b'data'
         ret = self.mstorage.download('id1')
@@ -52,39 +140,81 @@ class TestMethodOk(TestCase):
         req.assert_called_once_with('get', ENDPOINT+'/media/id1/content', headers=headers)
         eq_(ret, b'data')
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     @mock.patch('ricohapi.mstorage.client.open')
     def test_download_to_ok(self, opn, req):
         opn.side_effect = mock.mock_open()
         req.return_value.iter_content = Mock(return_value=['data'])
         ret = self.mstorage.download_to('id1', 'path.jpg')
-        req.return_value.iter_content.assert_called_once_with(chunk_size=1024)
+        req.return_value.iter_content.assert_called_once_with(chunk_size=1024*1024)
         opn.assert_called_once_with('path.jpg', 'wb')
         opn().write.assert_called_once_with('data')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media/id1/content', headers=headers, stream=True)
+        req.return_value.close.assert_called_once_with()
         eq_(ret, None)
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
+    @mock.patch('ricohapi.mstorage.client.open')
+    def test_download_to_chunk_size_ok(self, opn, req):
+        opn.side_effect = mock.mock_open()
+        req.return_value.iter_content = Mock(return_value=[b'data'])
+        self.mstorage.download_to('id1', 'path.jpg', chunk_size=65536)
+        req.return_value.iter_content.assert_called_once_with(chunk_size=65536)
+
+    @mock.patch('requests.Session.request')
+    def test_download_into_buffer_ok(self, req):
+        req.return_value.iter_content = Mock(return_value=[b'abc', b'de'])
+        buf = bytearray(8)
+        ret = self.mstorage.download_into('id1', buf)
+        eq_(ret, 5)
+        eq_(bytes(buf[:5]), b'abcde')
+        req.return_value.close.assert_called_once_with()
+
+    @mock.patch('requests.Session.request')
+    def test_download_into_memoryview_ok(self, req):
+        req.return_value.iter_content = Mock(return_value=[b'abc'])
+        buf = bytearray(8)
+        eq_(self.mstorage.download_into('id1', memoryview(buf)[4:]), 3)
+        eq_(bytes(buf[4:7]), b'abc')
+
+    @mock.patch('requests.Session.request')
+    def test_download_into_file_ok(self, req):
+        req.return_value.iter_content = Mock(return_value=[b'abc', b'de'])
+        ofile = Mock()
+        eq_(self.mstorage.download_into('id1', ofile), 5)
+        ofile.write.assert_has_calls([mock.call(b'abc'), mock.call(b'de')])
+
+    @mock.patch('requests.Session.request')
+    def test_iter_download_ok(self, req):
+        req.return_value.iter_content = Mock(return_value=[b'abc', b'de'])
+        ret = self.mstorage.iter_download('id1', chunk_size=4096)
+        headers = {'Authorization': 'Bearer atoken'}
+        req.assert_called_once_with('get', ENDPOINT+'/media/id1/content', headers=headers, stream=True)
+        eq_(list(ret), [b'abc', b'de'])
+        req.return_value.iter_content.assert_called_once_with(chunk_size=4096)
+        req.return_value.close.assert_called_once_with()
+
+    @mock.patch('requests.Session.request')
     def test_list_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.list()
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media', headers=headers)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_list_params_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         params = {'limit': 10}
         ret = self.mstorage.list(params)
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media', headers=headers, params=params)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_list_search_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         query = {'key': 'value'}
         params = {'filter': query}
         ret = self.mstorage.list(params)
@@ -104,9 +234,9 @@ class TestMethodOk(TestCase):
         eq_(json.loads(kwargs['data']), expected_data)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_list_search_paging_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         query = {'key': 'value'}
         params = {'filter': query, 'before': 'b', 'after': 'a', 'limit': 10}
         ret = self.mstorage.list(params)
@@ -131,54 +261,54 @@ class TestMethodOk(TestCase):
         eq_(json.loads(kwargs['data']), expected_data)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_delete_ok(self, req):
         ret = self.mstorage.delete('id1')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('delete', ENDPOINT+'/media/id1', headers=headers)
         eq_(ret, None)
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_info_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.info('id1')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media/id1', headers=headers)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_meta_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.meta('id1')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media/id1/meta', headers=headers)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_meta_gpano_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.meta('id1', 'gpano')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media/id1/meta/gpano', headers=headers)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_meta_exif_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.meta('id1', 'exif')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media/id1/meta/exif', headers=headers)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_meta_user_ok(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         ret = self.mstorage.meta('id1', 'user')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('get', ENDPOINT+'/media/id1/meta/user', headers=headers)
         eq_(ret, {'a': 'b'})
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_meta_user_scope_ok(self, req):
         req.return_value.text='value'
         ret = self.mstorage.meta('id1', 'user.key')
@@ -187,7 +317,7 @@ class TestMethodOk(TestCase):
         eq_(ret, 'value')
 
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_ok(self, req):
         meta = {
             'user._Key-0': b'Value0',
@@ -217,20 +347,471 @@ class TestMethodOk(TestCase):
             mock.call('put', ENDPOINT+'/media/id1/meta/user/_Key-9', headers=headers, data=b'Value\xEF\xBC\x99'),
         ], any_order=True)
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
+    def test_add_meta_error_ok(self, req):
+        req.side_effect = [mock.DEFAULT, RequestException()]
+        try:
+            self.mstorage.add_meta('id1', {'user.key1': 'value1', 'user.key2': 'value2'})
+        except RequestException:
+            pass
+        else:
+            raise AssertionError('RequestException was not raised')
+        eq_(req.call_count, 2)
+
+    @mock.patch('requests.Session.request')
+    def test_add_meta_many_ok(self, req):
+        def respond(method, url, **kwargs):
+            if url.startswith(ENDPOINT+'/media/id2/'):
+                raise RequestException()
+            return mock.DEFAULT
+        req.side_effect = respond
+        metas = {
+            'id1': {'user.key1': 'value1', 'user.key2': 'value2'},
+            'id2': {'user.key1': 'value1'},
+        }
+        ret = {result.key: result for result in self.mstorage.add_meta_many(metas, max_workers=2)}
+        eq_(req.call_count, 3)
+        eq_(ret['id1'].error, None)
+        eq_(isinstance(ret['id2'].error, RequestException), True)
+        headers = {'Authorization': 'Bearer atoken', 'Content-Type': 'text/plain'}
+        req.assert_any_call('put', ENDPOINT+'/media/id1/meta/user/key2', headers=headers, data=b'value2')
+
+    @mock.patch('requests.Session.request')
     def test_remove_meta_user_ok(self, req):
         ret = self.mstorage.remove_meta('id1', 'user')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('delete', ENDPOINT+'/media/id1/meta/user', headers=headers)
         eq_(ret, None)
 
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_remove_meta_user_scope_ok(self, req):
         ret = self.mstorage.remove_meta('id1', 'user.key')
         headers = {'Authorization': 'Bearer atoken'}
         req.assert_called_once_with('delete', ENDPOINT+'/media/id1/meta/user/key', headers=headers)
         eq_(ret, None)
 
+class TestAccessToken(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(side_effect=['atoken', 'btoken'])
+        self.mstorage = MediaStorage(self.aclient)
+
+    @mock.patch('requests.Session.request')
+    def test_token_cached(self, req):
+        req.return_value.content = b'{"a": "b"}'
+        self.mstorage.info('id1')
+        self.mstorage.add_meta('id1', {'user.key1': 'value1', 'user.key2': 'value2'})
+        eq_(self.aclient.get_access_token.call_count, 1)
+
+    @mock.patch('requests.Session.request')
+    def test_retry_on_401(self, req):
+        expired = Mock()
+        expired.status_code = 401
+        req.side_effect = [expired, mock.DEFAULT]
+        req.return_value.content = b'{"a": "b"}'
+        eq_(self.mstorage.info('id1'), {'a': 'b'})
+        req.assert_has_calls([
+            mock.call('get', ENDPOINT+'/media/id1', headers={'Authorization': 'Bearer atoken'}),
+            mock.call('get', ENDPOINT+'/media/id1', headers={'Authorization': 'Bearer btoken'}),
+        ])
+        expired.raise_for_status.assert_not_called()
+
+    @mock.patch('requests.Session.request')
+    def test_retry_on_401_rewinds_file(self, req):
+        expired = Mock()
+        expired.status_code = 401
+        req.side_effect = [expired, mock.DEFAULT]
+        req.return_value.content = b'{"id": "id1"}'
+        payload = Mock()
+        payload.tell.return_value = 0
+        payload.read.return_value = b''
+        with mock.patch('ricohapi.mstorage.client.open', mock.mock_open()) as opn:
+            opn.return_value = payload
+            payload.__enter__ = Mock(return_value=payload)
+            payload.__exit__ = Mock(return_value=False)
+            self.mstorage.upload('path.jpg')
+        payload.seek.assert_has_calls([mock.call(0), mock.call(0)])
+        eq_(req.call_count, 2)
+
+    @raises(RequestException)
+    @mock.patch('requests.Session.request')
+    def test_401_retried_once(self, req):
+        req.return_value.status_code = 401
+        req.return_value.raise_for_status.side_effect = RequestException
+        try:
+            self.mstorage.info('id1')
+        finally:
+            eq_(req.call_count, 2)
+
+    @mock.patch('requests.Session.request')
+    def test_401_opens_new_session(self, req):
+        class Client(object):
+            def __init__(self):
+                self.sessions = 0
+            def session(self, scope):
+                self.sessions += 1
+            def get_access_token(self):
+                return 'token{0}'.format(self.sessions)
+        aclient = Client()
+        mstorage = MediaStorage(aclient)
+        mstorage.connect()
+        expired = Mock()
+        expired.status_code = 401
+        req.side_effect = [expired, mock.DEFAULT]
+        req.return_value.content = b'{"a": "b"}'
+        eq_(mstorage.info('id1'), {'a': 'b'})
+        req.assert_has_calls([
+            mock.call('get', ENDPOINT+'/media/id1', headers={'Authorization': 'Bearer token1'}),
+            mock.call('get', ENDPOINT+'/media/id1', headers={'Authorization': 'Bearer token2'}),
+        ])
+        eq_(aclient.sessions, 2)
+
+    @mock.patch('requests.Session.request')
+    def test_generator_upload_asks_client(self, req):
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        req.return_value.content = b'{"id": "id1"}'
+        self.mstorage.info('id1')
+        self.mstorage.upload(iter([b'abc']))
+        self.mstorage.upload(iter([b'abc']))
+        eq_(self.aclient.get_access_token.call_count, 3)
+
+    def test_client_collected(self):
+        class Client(object):
+            def get_access_token(self):
+                return 'atoken'
+        aclient = Client()
+        ref = weakref.ref(aclient)
+        mstorage = MediaStorage(aclient)
+        del aclient, mstorage
+        gc.collect()
+        eq_(ref(), None)
+
+    @mock.patch('requests.Session.request')
+    def test_connect_resets_token(self, req):
+        req.return_value.content = b'{"a": "b"}'
+        self.mstorage.info('id1')
+        self.mstorage.connect()
+        self.mstorage.info('id1')
+        eq_(req.call_args[1]['headers'], {'Authorization': 'Bearer btoken'})
+
+class TestDownloadMany(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(self.aclient)
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    @staticmethod
+    def response(chunks, status=200, headers=None):
+        res = Mock()
+        res.status_code = status
+        res.headers = headers or {}
+        res.iter_content = Mock(return_value=chunks)
+        return res
+
+    def read(self, name):
+        with open(os.path.join(self.dest, name), 'rb') as ifile:
+            return ifile.read()
+
+    @mock.patch('requests.Session.request')
+    def test_download_many_ok(self, req):
+        req.side_effect = lambda method, url, **kwargs: self.response([url[-9:-8].encode('ascii')] * 3)
+        ret = {result.key: result for result in self.mstorage.download_many(['id1', 'id2'], self.dest)}
+        eq_(sorted(os.listdir(self.dest)), ['id1', 'id2'])
+        eq_(self.read('id1'), b'111')
+        eq_(ret['id2'].value.size, 3)
+        eq_(ret['id2'].value.resumed, False)
+        eq_(ret['id2'].error, None)
+
+    @mock.patch('requests.Session.request')
+    def test_download_many_resume(self, req):
+        with open(os.path.join(self.dest, 'id1.part'), 'wb') as ofile:
+            ofile.write(b'abc')
+        req.return_value = self.response([b'def'], 206, {'Content-Range': 'bytes 3-5/6'})
+        ret = list(self.mstorage.download_many(['id1'], self.dest))
+        headers = {'Authorization': 'Bearer atoken', 'Range': 'bytes=3-'}
+        req.assert_called_once_with('get', ENDPOINT+'/media/id1/content', headers=headers, stream=True)
+        eq_(self.read('id1'), b'abcdef')
+        eq_(ret[0].value.received, 3)
+        eq_(ret[0].value.resumed, True)
+
+    @mock.patch('requests.Session.request')
+    def test_download_many_range_ignored(self, req):
+        with open(os.path.join(self.dest, 'id1.part'), 'wb') as ofile:
+            ofile.write(b'abc')
+        req.return_value = self.response([b'abcdef'])
+        list(self.mstorage.download_many(['id1'], self.dest))
+        eq_(self.read('id1'), b'abcdef')
+
+    @mock.patch('requests.Session.request')
+    def test_download_many_retry(self, req):
+        def broken():
+            yield b'abc'
+            raise RequestsConnectionError()
+        req.side_effect = [
+            self.response(broken()),
+            self.response([b'def'], 206, {'Content-Range': 'bytes 3-5/6'}),
+        ]
+        ret = list(self.mstorage.download_many(['id1'], self.dest))
+        eq_(self.read('id1'), b'abcdef')
+        eq_(ret[0].value.resumed, True)
+        eq_(os.path.exists(os.path.join(self.dest, 'id1.part')), False)
+
+    @mock.patch('requests.Session.request')
+    def test_download_many_error(self, req):
+        req.side_effect = RequestException
+        ret = list(self.mstorage.download_many(['id1'], self.dest))
+        eq_(isinstance(ret[0].error, RequestException), True)
+        eq_(os.listdir(self.dest), [])
+
+class TestMediaPage(TestCase):
+    def test_page(self):
+        page = MediaPage(b'{"media": [{"id": "id1", "x": 1}, {"id": "id2"}], "paging": {"next": "n"}}')
+        eq_(page.ids, ('id1', 'id2'))
+        eq_((page.after, page.before), ('id2', 'id1'))
+        eq_(page.paging, {'next': 'n'})
+        eq_((len(page), list(page)), (2, ['id1', 'id2']))
+        eq_(hasattr(page, '__dict__'), False)
+
+    def test_parse_ids(self):
+        body = b'{"media": [{"id": "id1", "exif": {"Make": "RICOH"}}], "paging": {"next": "n"}}'
+        eq_(client._parse_ids(body), {'media': ['id1'], 'paging': {'next': 'n'}})
+
+    def test_empty_page(self):
+        page = MediaPage(b'{"media": []}')
+        eq_((page.ids, page.after, page.before, page.paging), ((), None, None, {}))
+
+    @raises(ValueError)
+    def test_invalid_page(self):
+        MediaPage(b'not json').ids
+
+    @mock.patch('requests.Session.request')
+    def test_list_lazy(self, req):
+        req.return_value.content = b'{"media": [{"id": "id1"}]}'
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        page = MediaStorage(aclient).list({'limit': 1}, lazy=True)
+        eq_(page.ids, ('id1',))
+
+    @mock.patch.object(client, '_json_impl', json)
+    def test_stdlib_fallback(self):
+        eq_(client._parse_json(b'{"a": "\xc3\xa9"}'), {'a': u'\xe9'})
+
+    @raises(ValueError)
+    @mock.patch.object(client, '_json_impl', json)
+    def test_stdlib_fallback_error(self):
+        client._parse_json(b'\xff not json')
+
+    @raises(ValueError)
+    def test_parse_type_error(self):
+        client._parse_json(None)
+
+class TestIterMedia(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(self.aclient)
+        self.mids = ['id{0:02d}'.format(num) for num in range(25)]
+
+    def respond(self, method, url, **kwargs):
+        if method == 'get':
+            paging = kwargs['params']
+        else:
+            paging = json.loads(kwargs['data'])['paging']
+        start = self.mids.index(paging['after']) + 1 if 'after' in paging else 0
+        page = self.mids[start:start + paging['limit']]
+        res = Mock()
+        res.content = json.dumps({'media': [{'id': mid} for mid in page]}).encode('utf-8')
+        return res
+
+    @mock.patch('requests.Session.request')
+    def test_iter_media_ok(self, req):
+        req.side_effect = self.respond
+        eq_(list(self.mstorage.iter_media(page_size=10)), self.mids)
+        eq_(req.call_count, 3)
+        eq_(req.call_args[1]['params'], {'limit': 10, 'after': 'id19'})
+
+    @mock.patch('requests.Session.request')
+    def test_iter_media_lazy(self, req):
+        req.side_effect = self.respond
+        ret = self.mstorage.iter_media(page_size=10)
+        eq_(req.call_count, 0)
+        eq_(next(ret), 'id00')
+        eq_(req.call_count, 1)
+        ret.close()
+
+    @mock.patch('requests.Session.request')
+    def test_iter_media_exact_pages(self, req):
+        req.side_effect = self.respond
+        self.mids = self.mids[:20]
+        eq_(list(self.mstorage.iter_media(page_size=10)), self.mids)
+        eq_(req.call_count, 3)
+
+    @mock.patch('requests.Session.request')
+    def test_iter_media_filter(self, req):
+        req.side_effect = self.respond
+        query = {'meta.user.key': 'value'}
+        eq_(list(self.mstorage.iter_media(query, page_size=10)), self.mids)
+        eq_(req.call_args[0], ('post', ENDPOINT+'/media/search'))
+        eq_(json.loads(req.call_args[1]['data'])['query'], query)
+
+    @mock.patch('requests.Session.request')
+    def test_iter_media_prefetch(self, req):
+        req.side_effect = self.respond
+        eq_(list(self.mstorage.iter_media(page_size=10, prefetch=True)), self.mids)
+        eq_(req.call_count, 3)
+
+    @raises(ValueError)
+    def test_iter_media_page_size_error(self):
+        next(self.mstorage.iter_media(page_size=0))
+
+class TestMetaCache(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(self.aclient, cache=MetaCache())
+
+    @mock.patch('requests.Session.request')
+    def test_meta_cached(self, req):
+        req.return_value.content = b'{"a": "b"}'
+        eq_(self.mstorage.meta('id1', 'exif'), {'a': 'b'})
+        eq_(self.mstorage.meta('id1', 'exif'), {'a': 'b'})
+        eq_(self.mstorage.info('id1'), {'a': 'b'})
+        eq_(self.mstorage.info('id1'), {'a': 'b'})
+        eq_(req.call_count, 2)
+        eq_(self.mstorage.cache.stats()['hits'], 2)
+
+    @mock.patch('requests.Session.request')
+    def test_add_meta_invalidates(self, req):
+        req.return_value.content = b'{"a": "b"}'
+        self.mstorage.meta('id1', 'user')
+        self.mstorage.add_meta('id1', {'user.key': 'value'})
+        self.mstorage.meta('id1', 'user')
+        eq_(req.call_count, 3)
+
+    @mock.patch('requests.Session.request')
+    def test_remove_meta_invalidates(self, req):
+        req.return_value.text = 'value'
+        self.mstorage.meta('id1', 'user.key')
+        self.mstorage.remove_meta('id1', 'user.key')
+        self.mstorage.meta('id1', 'user.key')
+        eq_(req.call_count, 3)
+
+    @mock.patch('requests.Session.request')
+    def test_invalidated_during_fetch(self, req):
+        def respond(*args, **kwargs):
+            self.mstorage.cache.invalidate('id1')
+            return mock.DEFAULT
+        req.side_effect = respond
+        req.return_value.content = b'{"a": "b"}'
+        self.mstorage.meta('id1', 'user')
+        eq_(self.mstorage.cache.get('id1', 'user'), None)
+
+    @mock.patch('requests.Session.request')
+    def test_delete_invalidates_on_error(self, req):
+        req.return_value.content = b'{"a": "b"}'
+        self.mstorage.meta('id1')
+        req.side_effect = RequestException
+        try:
+            self.mstorage.delete('id1')
+        except RequestException:
+            pass
+        eq_(self.mstorage.cache.get('id1', 'meta'), None)
+
+class TestMetaMany(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(self.aclient)
+
+    @staticmethod
+    def respond(method, url, **kwargs):
+        res = Mock()
+        parts = url[len(ENDPOINT):].split('/')
+        if parts[-1] == 'meta':
+            res.content = json.dumps({'exif': {'id': parts[2]}, 'gpano': {}, 'user': {}}).encode('utf-8')
+        else:
+            res.content = json.dumps({'scope': parts[-1], 'id': parts[2]}).encode('utf-8')
+        return res
+
+    @mock.patch('requests.Session.request')
+    def test_meta_many_whole(self, req):
+        req.side_effect = self.respond
+        ret = {result.key: result.value for result in self.mstorage.meta_many(['id1', 'id2', 'id1'])}
+        eq_(sorted(ret), ['id1', 'id2'])
+        eq_(ret['id2'], {'exif': {'id': 'id2'}, 'gpano': {}, 'user': {}})
+        eq_(req.call_count, 2)
+        req.assert_any_call('get', ENDPOINT+'/media/id1/meta', headers={'Authorization': 'Bearer atoken'})
+
+    @mock.patch('requests.Session.request')
+    def test_meta_many_scopes(self, req):
+        req.side_effect = self.respond
+        ret = list(self.mstorage.meta_many(iter(['id1']), scopes=['exif', 'user'], max_workers=1))
+        eq_(ret[0].value, {'exif': {'scope': 'exif', 'id': 'id1'}, 'user': {'scope': 'user', 'id': 'id1'}})
+        eq_(ret[0].error, None)
+        eq_(req.call_count, 2)
+
+    @mock.patch('requests.Session.request')
+    def test_meta_many_error(self, req):
+        req.side_effect = RequestException
+        ret = list(self.mstorage.meta_many(['id1']))
+        eq_(isinstance(ret[0].error, RequestException), True)
+
+    @raises(ValueError)
+    def test_meta_many_scope_error(self):
+        self.mstorage.meta_many(['id1'], scopes=['exif', 'user.key'])
+
+class TestBulkDelete(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(self.aclient)
+
+    @staticmethod
+    def respond(method, url, **kwargs):
+        res = Mock()
+        res.status_code = 204
+        if 'missing' in url:
+            res.status_code = 404
+            res.raise_for_status = Mock(side_effect=HTTPError(response=res))
+        elif 'broken' in url:
+            raise RequestException()
+        return res
+
+    @mock.patch('requests.Session.request')
+    def test_delete_many(self, req):
+        req.side_effect = self.respond
+        mids = (mid for mid in ['id1', 'missing', 'broken', 'id2'])
+        report = self.mstorage.delete_many(mids, max_workers=2)
+        eq_(sorted(report.succeeded), ['id1', 'id2'])
+        eq_(report.not_found, ['missing'])
+        eq_(list(report.failed), ['broken'])
+        eq_(isinstance(report.failed['broken'], RequestException), True)
+        eq_(req.call_count, 4)
+
+    @mock.patch('requests.Session.request')
+    def test_delete_many_from_iter_media(self, req):
+        req.side_effect = [Mock(content=b'{"media": [{"id": "id1"}, {"id": "id2"}]}')] + [Mock()] * 2
+        report = self.mstorage.delete_many(self.mstorage.iter_media({'meta.user.tag': 'old'}), max_workers=1)
+        eq_(report.succeeded, ['id1', 'id2'])
+        req.assert_called_with('delete', ENDPOINT+'/media/id2', headers={'Authorization': 'Bearer atoken'})
+
+    @mock.patch('requests.Session.request')
+    def test_remove_meta_many(self, req):
+        req.side_effect = self.respond
+        report = self.mstorage.remove_meta_many(['id1', 'missing'], 'user.key', rate=1000)
+        eq_((report.succeeded, report.not_found, report.failed), (['id1'], ['missing'], {}))
+        req.assert_any_call('delete', ENDPOINT+'/media/id1/meta/user/key', headers={'Authorization': 'Bearer atoken'})
+
+    @raises(ValueError)
+    @mock.patch('requests.Session.request')
+    def test_remove_meta_many_scope_error(self, req):
+        self.mstorage.remove_meta_many(['id1'], 'exif')
+        eq_(req.call_count, 0)
+
 class TestMethodError(TestCase):
     def setUp(self):
         self.aclient = Mock()
@@ -239,61 +820,90 @@ class TestMethodError(TestCase):
         self.mstorage.connect()
 
     @raises(RequestException)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_info_req_error(self, req):
         req.side_effect = RequestException
         self.mstorage.info('id1')
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_info_json_error(self, req):
-        req.return_value.text = 'not json'
+        req.return_value.content = b'not json'
         self.mstorage.info('id1')
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_meta_scope_error(self, req):
-        req.return_value.text='{"a": "b"}'
+        req.return_value.content = b'{"a": "b"}'
         self.mstorage.meta('id1', 'undefined_scope')
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_num_error(self, req):
         meta = {'user.'+str(num):str(num) for num in range(11)}
         self.mstorage.add_meta('id1', meta)
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_key_error(self, req):
         meta = {'invalid_key': 'value'}
         self.mstorage.add_meta('id1', meta)
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_value_empty_error(self, req):
         meta = {'user.key': ''}
         self.mstorage.add_meta('id1', meta)
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_value_over_error(self, req):
         value = b''.join([b'a' for dummy in range(1025)])
         meta = {'user.key': value}
         self.mstorage.add_meta('id1', meta)
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_value_type_error(self, req):
         meta = {'user.key': 5}
         self.mstorage.add_meta('id1', meta)
 
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_add_meta_value_encode_error(self, req):
         meta = {'user.key': b'\x82\xA0'}
         self.mstorage.add_meta('id1', meta)
 
+    @mock.patch('requests.Session.request')
+    def test_add_meta_validated_before_requests(self, req):
+        meta = {'user.key{0}'.format(num): 'value' for num in range(9)}
+        meta['invalid_key'] = 'value'
+        try:
+            self.mstorage.add_meta('id1', meta)
+        except ValueError:
+            pass
+        eq_(req.call_count, 0)
+
+    @raises(ValueError)
+    @mock.patch('requests.Session.request')
+    def test_add_meta_many_validation_error(self, req):
+        try:
+            self.mstorage.add_meta_many({'id1': {'user.key': 'value'}, 'id2': {'user.key': ''}})
+        finally:
+            eq_(req.call_count, 0)
+
+    @raises(ValueError)
+    @mock.patch('requests.Session.request')
+    def test_download_into_small_buffer_error(self, req):
+        req.return_value.iter_content = Mock(return_value=[b'abc', b'def'])
+        self.mstorage.download_into('id1', bytearray(4))
+
+    @raises(ValueError)
+    @mock.patch('requests.Session.request')
+    def test_download_into_readonly_error(self, req):
+        self.mstorage.download_into('id1', b'readonly')
+
     @raises(ValueError)
-    @mock.patch('requests.request')
+    @mock.patch('requests.Session.request')
     def test_remove_meta_scope_error(self, req):
         self.mstorage.remove_meta('id1', 'invalid_scope')
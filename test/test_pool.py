@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+from unittest import TestCase
+from nose.tools import eq_
+from mock import Mock
+from ricohapi.mstorage.pool import SessionPool
+
+class TestSessionPool(TestCase):
+    def test_adapter_config(self):
+        pool = SessionPool(pool_size=4, retries=2)
+        adapter = pool.session.get_adapter('https://mss.ricohapi.com/v1')
+        eq_(adapter._pool_maxsize, 4)
+        eq_(adapter.max_retries.total, 2)
+        eq_('POST' in SessionPool.IDEMPOTENT_METHODS, False)
+        eq_(503 in adapter.max_retries.status_forcelist, False)
+
+    def test_scheduler(self):
+        scheduler = Mock()
+        eq_(SessionPool(scheduler=scheduler).scheduler is scheduler, True)
+        eq_(SessionPool(pool_size=4).scheduler.limit, 4)
+
+    def test_session_reused(self):
+        pool = SessionPool()
+        eq_(pool.session is pool.session, True)
+
+    def test_for_client(self):
+        aclient = Mock()
+        eq_(SessionPool.for_client(aclient) is SessionPool.for_client(aclient), True)
+
+    def test_stats_empty(self):
+        pool = SessionPool()
+        eq_(pool.stats(), {'requests': 0, 'hits': 0, 'misses': 0})
+
+    def test_stats_counts(self):
+        pool = SessionPool()
+        manager = pool.session.get_adapter('https://mss.ricohapi.com').poolmanager
+        conn_pool = manager.connection_from_url('https://mss.ricohapi.com')
+        conn_pool.num_requests = 5
+        conn_pool.num_connections = 2
+        eq_(pool.stats(), {'requests': 5, 'hits': 3, 'misses': 2})
+
+    def test_close(self):
+        pool = SessionPool()
+        session = pool.session
+        executor = pool.executor
+        pool.close()
+        eq_(pool.session is session, False)
+        eq_(pool.executor is executor, False)
+
+    def test_executor_reused(self):
+        pool = SessionPool(pool_size=2)
+        eq_(pool.executor is pool.executor, True)
+        pool.close()
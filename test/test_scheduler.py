@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import time
+from unittest import TestCase
+from nose.tools import eq_, raises
+from mock import Mock
+from requests.exceptions import HTTPError
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+from ricohapi.mstorage.pool import SessionPool
+from ricohapi.mstorage.scheduler import Scheduler, _retry_after
+
+def response(status, headers=None):
+    res = Mock()
+    res.status_code = status
+    res.headers = headers or {}
+    return res
+
+class TestScheduler(TestCase):
+    def test_aimd(self):
+        scheduler = Scheduler(max_concurrency=8)
+        ticket = scheduler.acquire()
+        scheduler.release(ticket, 503)
+        eq_(scheduler.limit, 4)
+        # throttled requests sent before the decrease do not decrease it again
+        scheduler.release(ticket, 429)
+        eq_(scheduler.limit, 4)
+        for dummy in range(40):
+            scheduler.release(scheduler.acquire(), 200)
+        eq_(scheduler.limit, 8)
+        eq_(scheduler.stats()['decreases'], 1)
+        eq_(scheduler.stats()['throttled'], 2)
+
+    def test_min_concurrency(self):
+        scheduler = Scheduler(max_concurrency=2, min_concurrency=1)
+        for dummy in range(3):
+            scheduler.release(scheduler.acquire(), 429)
+        eq_(scheduler.limit, 1)
+
+    def test_retry_idempotent(self):
+        scheduler = Scheduler(backoff_factor=0.001, seed=0)
+        send = Mock(side_effect=[response(503), response(429), response(200)])
+        rewind = Mock()
+        eq_(scheduler.call('get', send, rewind).status_code, 200)
+        eq_(send.call_count, 3)
+        eq_(rewind.call_count, 2)
+        eq_(scheduler.stats()['retries'], 2)
+
+    def test_no_retry_post(self):
+        scheduler = Scheduler(backoff_factor=0.001)
+        send = Mock(return_value=response(503))
+        eq_(scheduler.call('post', send, Mock()).status_code, 503)
+        eq_(send.call_count, 1)
+
+    def test_retries_exhausted(self):
+        scheduler = Scheduler(retries=2, backoff_factor=0.001)
+        send = Mock(return_value=response(429))
+        eq_(scheduler.call('delete', send, Mock()).status_code, 429)
+        eq_(send.call_count, 3)
+
+    def test_retry_after(self):
+        scheduler = Scheduler()
+        send = Mock(side_effect=[response(429, {'Retry-After': '0.1'}), response(204)])
+        started = time.time()
+        eq_(scheduler.call('put', send, Mock()).status_code, 204)
+        eq_(time.time() - started >= 0.1, True)
+
+    def test_retry_after_too_long(self):
+        scheduler = Scheduler(max_backoff=1)
+        send = Mock(return_value=response(503, {'Retry-After': '120'}))
+        eq_(scheduler.call('get', send, Mock()).status_code, 503)
+        eq_(send.call_count, 1)
+
+    def test_send_error_releases(self):
+        scheduler = Scheduler()
+        try:
+            scheduler.call('get', Mock(side_effect=IOError), Mock())
+        except IOError:
+            pass
+        eq_(scheduler.stats()['in_flight'], 0)
+
+    def test_backoff_bounds(self):
+        scheduler = Scheduler(backoff_factor=1, max_backoff=5, seed=1)
+        delays = [scheduler.backoff(attempt) for attempt in range(10)]
+        eq_(all(0 <= delay <= 5 for delay in delays), True)
+        eq_(scheduler.backoff(0, retry_after=2) >= 2, True)
+
+    def test_parse_retry_after(self):
+        eq_(_retry_after({'Retry-After': '3'}), 3.0)
+        eq_(_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 0.0)
+        eq_(_retry_after({'Retry-After': 'soon'}), None)
+        eq_(_retry_after({}), None)
+
+    @raises(ValueError)
+    def test_concurrency_error(self):
+        Scheduler(max_concurrency=1, min_concurrency=2)
+
+class TestSchedulerServer(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer(error_status=429, retry_after=0, seed=0).start()
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        self.pool = SessionPool(scheduler=Scheduler(backoff_factor=0.001))
+        self.mstorage = MediaStorage(aclient, pool=self.pool, endpoint=self.server.endpoint)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_throttled_get_retried(self):
+        mid = self.server.add_media(b'abc')['id']
+        self.server.error_rate = 0.5
+        for dummy in range(10):
+            eq_(self.mstorage.download(mid), b'abc')
+        eq_(self.pool.scheduler.stats()['retries'] > 0, True)
+
+    @raises(HTTPError)
+    def test_throttled_post_raises(self):
+        self.server.error_rate = 1.0
+        self.mstorage.upload(b'abc')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from nose.tools import eq_
+import mock
+from mock import Mock
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+from ricohapi.mstorage.sync import DirectorySync, Manifest, MANIFEST_NAME
+from ricohapi.mstorage import cli
+
+class TestDirectorySync(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer().start()
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(aclient, endpoint=self.server.endpoint)
+        self.local = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.local, 'sub'))
+        self.write('a.jpg', b'aaa')
+        self.write('sub/b.jpg', b'bbb')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.local)
+
+    def write(self, relpath, data, mtime=None):
+        path = os.path.join(self.local, *relpath.split('/'))
+        with open(path, 'wb') as ofile:
+            ofile.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def remote(self):
+        return sorted(self.mstorage.download(mid) for mid in self.mstorage.iter_media())
+
+    def test_push_incremental(self):
+        syncer = DirectorySync(self.mstorage, self.local)
+        report = syncer.push()
+        eq_(sorted(report.transferred), ['a.jpg', 'sub/b.jpg'])
+        eq_(self.remote(), [b'aaa', b'bbb'])
+        requests = self.server.stats()['requests']
+        report = syncer.push()
+        eq_((report.transferred, report.unchanged), ([], 2))
+        eq_(self.server.stats()['requests'], requests)
+
+    def test_push_touched_not_uploaded(self):
+        syncer = DirectorySync(self.mstorage, self.local)
+        syncer.push()
+        self.write('a.jpg', b'aaa', mtime=1000000)
+        report = syncer.push()
+        eq_((report.transferred, report.unchanged), ([], 2))
+
+    def test_push_modified_and_deleted(self):
+        syncer = DirectorySync(self.mstorage, self.local)
+        syncer.push()
+        self.write('a.jpg', b'AAA', mtime=1000000)
+        os.remove(os.path.join(self.local, 'sub', 'b.jpg'))
+        report = syncer.push(delete=True)
+        eq_(report.transferred, ['a.jpg'])
+        eq_(len(report.deleted), 2)
+        eq_(self.remote(), [b'AAA'])
+
+    def test_pull(self):
+        mid = self.server.add_media(b'remote')['id']
+        syncer = DirectorySync(self.mstorage, self.local)
+        syncer.push()
+        report = syncer.pull()
+        eq_(report.transferred, [mid])
+        eq_(report.unchanged, 2)
+        with open(os.path.join(self.local, mid), 'rb') as ifile:
+            eq_(ifile.read(), b'remote')
+        eq_(syncer.pull().transferred, [])
+        self.server.delete_media(mid)
+        eq_(syncer.pull(delete=True).deleted, [mid])
+        eq_(os.path.exists(os.path.join(self.local, mid)), False)
+
+    def test_pulled_then_touched_not_uploaded(self):
+        self.server.add_media(b'remote')
+        syncer = DirectorySync(self.mstorage, self.local)
+        syncer.push()
+        mid = syncer.pull().transferred[0]
+        self.write(mid, b'remote', mtime=1000000)
+        report = syncer.push(delete=True)
+        eq_((report.transferred, report.deleted), ([], []))
+        eq_(self.remote(), [b'aaa', b'bbb', b'remote'])
+
+    def test_manifest_saved_per_upload(self):
+        upload = self.mstorage.upload
+        saved = []
+        def upload_and_check(body):
+            # what a crash right now would leave in the manifest
+            manifest = Manifest(os.path.join(self.local, MANIFEST_NAME))
+            saved.append(len(manifest.load()))
+            manifest.close()
+            return upload(body)
+        syncer = DirectorySync(self.mstorage, self.local, max_workers=1)
+        with mock.patch.object(self.mstorage, 'upload', side_effect=upload_and_check):
+            syncer.push()
+        eq_(saved, [0, 1])
+
+class TestCli(TestCase):
+    @mock.patch('ricohapi.mstorage.cli.DirectorySync')
+    @mock.patch('ricohapi.mstorage.cli.MediaStorage')
+    @mock.patch('ricohapi.mstorage.cli.AuthClient')
+    def test_push(self, auth, mstorage, syncer):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config = os.path.join(tmpdir, 'config.json')
+            with open(config, 'w') as ofile:
+                json.dump({'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret', 'USER': 'user', 'PASS': 'pass'}, ofile)
+            syncer.return_value.push.return_value.failed = {}
+            eq_(cli.main(['push', tmpdir, '--config', config, '--workers', '8', '--delete']), 0)
+            auth.assert_called_once_with('id', 'secret')
+            auth.return_value.set_resource_owner_creds.assert_called_once_with('user', 'pass')
+            mstorage.return_value.connect.assert_called_once_with()
+            syncer.assert_called_once_with(mstorage.return_value, tmpdir, None, 8)
+            syncer.return_value.push.assert_called_once_with(delete=True)
+        finally:
+            shutil.rmtree(tmpdir)
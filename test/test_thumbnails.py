@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, SkipTest
+from nose.tools import eq_, raises
+from mock import Mock
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+from ricohapi.mstorage.thumbnails import DiskCache, ThumbnailPipeline, Variant
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def upper(data):
+    return data.upper()
+
+def jpeg(size):
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 10, 10)).save(output, 'JPEG')
+    return output.getvalue()
+
+class TestDiskCache(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_set(self):
+        cache = DiskCache(self.tmpdir)
+        eq_(cache.get('id1', 'small'), None)
+        path = cache.set('id1', 'small', b'abc')
+        eq_(path, os.path.join(self.tmpdir, 'id1.small'))
+        eq_(cache.get('id1', 'small'), b'abc')
+        eq_(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1, 'bytes': 3})
+
+    def test_lru_eviction(self):
+        cache = DiskCache(self.tmpdir, max_bytes=6)
+        cache.set('id1', 'small', b'aaa')
+        cache.set('id2', 'small', b'bbb')
+        cache.get('id1', 'small')
+        cache.set('id3', 'small', b'ccc')
+        eq_(cache.get('id2', 'small'), None)
+        eq_(cache.get('id1', 'small'), b'aaa')
+        eq_(sorted(os.listdir(self.tmpdir)), ['id1.small', 'id3.small'])
+        eq_(cache.stats()['evictions'], 1)
+
+    def test_persistent(self):
+        cache = DiskCache(self.tmpdir)
+        cache.set('id1', 'small', b'aaa')
+        os.utime(os.path.join(self.tmpdir, 'id1.small'), (1000, 1000))
+        cache.set('id2', 'small', b'bbb')
+        cache = DiskCache(self.tmpdir, max_bytes=3)
+        eq_(cache.get('id1', 'small'), None)
+        eq_(cache.get('id2', 'small'), b'bbb')
+
+    def test_oversize_not_cached(self):
+        cache = DiskCache(self.tmpdir, max_bytes=2)
+        cache.set('id1', 'small', b'a')
+        eq_(cache.set('id1', 'small', b'abc'), None)
+        eq_(cache.get('id1', 'small'), None)
+        eq_(os.listdir(self.tmpdir), [])
+        eq_(cache.stats()['bytes'], 0)
+
+    def test_part_files_removed(self):
+        with open(os.path.join(self.tmpdir, 'id1.small.1234.part'), 'wb') as ofile:
+            ofile.write(b'abc')
+        cache = DiskCache(self.tmpdir)
+        eq_(os.listdir(self.tmpdir), [])
+        eq_(cache.stats()['size'], 0)
+
+    def test_discard(self):
+        cache = DiskCache(self.tmpdir)
+        cache.set('id1', 'small', b'a')
+        cache.set('id1', 'medium', b'b')
+        cache.set('id2', 'small', b'c')
+        cache.discard('id1')
+        eq_(os.listdir(self.tmpdir), ['id2.small'])
+        eq_(cache.stats()['bytes'], 1)
+
+    @raises(ValueError)
+    def test_invalid_key(self):
+        DiskCache(self.tmpdir).get('../id1', 'small')
+
+class TestThumbnailPipeline(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer().start()
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(aclient, endpoint=self.server.endpoint)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_without_request(self):
+        mid = self.server.add_media(b'abc')['id']
+        with ThumbnailPipeline(self.mstorage, self.tmpdir, {'upper': upper},
+                               executor=ThreadPoolExecutor(1)) as pipeline:
+            eq_(pipeline.get(mid, 'upper'), b'ABC')
+            requests = self.server.stats()['requests']
+            eq_(pipeline.get(mid, 'upper'), b'ABC')
+            eq_(self.server.stats()['requests'], requests)
+
+    def test_larger_than_cache(self):
+        mid = self.server.add_media(b'abc')['id']
+        with ThumbnailPipeline(self.mstorage, self.tmpdir, {'upper': upper}, max_bytes=2,
+                               executor=ThreadPoolExecutor(1)) as pipeline:
+            eq_(pipeline.get(mid, 'upper'), b'ABC')
+            eq_(pipeline.generate(mid), {'upper': None})
+        eq_(os.listdir(self.tmpdir), [])
+
+    def test_process_pool(self):
+        mids = [self.server.add_media(data)['id'] for data in (b'abc', b'def')]
+        with ThumbnailPipeline(self.mstorage, self.tmpdir, {'upper': upper, 'same': bytes}) as pipeline:
+            ret = {result.key: result.value for result in pipeline.generate_many(mids)}
+        with open(ret[mids[1]]['upper'], 'rb') as ifile:
+            eq_(ifile.read(), b'DEF')
+        eq_(sorted(ret[mids[0]]), ['same', 'upper'])
+        # a single download per media for all its variants
+        eq_(self.server.stats()['requests'], 2)
+
+    def test_resize(self):
+        if Image is None:
+            raise SkipTest('Pillow is not installed')
+        mid = self.server.add_media(jpeg((1600, 1200)))['id']
+        variants = {'small': Variant((160, 160)), 'png': Variant((64, 64), 'PNG')}
+        with ThumbnailPipeline(self.mstorage, self.tmpdir, variants,
+                               executor=ThreadPoolExecutor(2)) as pipeline:
+            small = Image.open(io.BytesIO(pipeline.get(mid, 'small')))
+            eq_((small.format, small.size), ('JPEG', (160, 120)))
+            png = Image.open(io.BytesIO(pipeline.get(mid, 'png')))
+            eq_((png.format, png.size), ('PNG', (64, 48)))
+
+    @raises(ValueError)
+    def test_unknown_variant(self):
+        ThumbnailPipeline(self.mstorage, self.tmpdir, {}, executor=Mock()).get('id1', 'small')
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import gc
+import threading
+import weakref
+import time
+from unittest import TestCase
+from nose.tools import eq_
+import mock
+from mock import Mock
+from ricohapi.mstorage.token import TokenCache
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        self.aclient = Mock()
+        self.aclient.get_access_token = Mock(side_effect=['token1', 'token2', 'token3'])
+
+    def test_cached(self):
+        tokens = TokenCache(self.aclient)
+        eq_(tokens.get(), 'token1')
+        eq_(tokens.get(), 'token1')
+        eq_(self.aclient.get_access_token.call_count, 1)
+
+    @mock.patch('ricohapi.mstorage.token.time.time')
+    def test_refresh_before_expiry(self, now):
+        now.return_value = 1000.0
+        tokens = TokenCache(self.aclient, lifetime=100, margin=10)
+        eq_(tokens.get(), 'token1')
+        now.return_value = 1089.0
+        eq_(tokens.get(), 'token1')
+        now.return_value = 1090.0
+        eq_(tokens.get(), 'token2')
+
+    def test_renew_stale_token(self):
+        tokens = TokenCache(self.aclient)
+        eq_(tokens.get(), 'token1')
+        eq_(tokens.renew('token1', 'scope'), 'token2')
+        eq_(tokens.renew('token1', 'scope'), 'token2')
+        eq_(self.aclient.session.call_count, 1)
+
+    def test_single_flight(self):
+        def slow_token():
+            time.sleep(0.05)
+            return 'token'
+        self.aclient.get_access_token = Mock(side_effect=slow_token)
+        tokens = TokenCache(self.aclient)
+        threads = [threading.Thread(target=tokens.get) for dummy in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(self.aclient.get_access_token.call_count, 1)
+
+    @mock.patch('ricohapi.mstorage.token.time.time')
+    def test_same_token_not_extended(self, now):
+        now.return_value = 1000.0
+        self.aclient.get_access_token = Mock(return_value='token1')
+        tokens = TokenCache(self.aclient, lifetime=100, margin=10)
+        eq_(tokens.get(), 'token1')
+        now.return_value = 1090.0
+        eq_(tokens.get(), 'token1')
+        eq_(tokens.get(), 'token1')
+        eq_(self.aclient.get_access_token.call_count, 3)
+
+    @mock.patch('ricohapi.mstorage.token.time.time')
+    def test_connect_sets_issue_time(self, now):
+        now.return_value = 1000.0
+        tokens = TokenCache(self.aclient, lifetime=100, margin=10)
+        tokens.connect('scope')
+        self.aclient.session.assert_called_once_with('scope')
+        now.return_value = 1089.0
+        eq_(tokens.get(), 'token1')
+        eq_(self.aclient.get_access_token.call_count, 1)
+
+    def test_fresh(self):
+        tokens = TokenCache(self.aclient)
+        eq_(tokens.get(), 'token1')
+        eq_(tokens.get(fresh=True), 'token2')
+        eq_(tokens.get(), 'token2')
+
+    def test_renew_single_flight(self):
+        def slow_session(scope):
+            time.sleep(0.05)
+        self.aclient.session = Mock(side_effect=slow_session)
+        tokens = TokenCache(self.aclient)
+        eq_(tokens.get(), 'token1')
+        renewed = []
+        threads = [threading.Thread(target=lambda: renewed.append(tokens.renew('token1', 'scope')))
+                   for dummy in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(renewed, ['token2'] * 8)
+        eq_(self.aclient.session.call_count, 1)
+
+    def test_for_client(self):
+        eq_(TokenCache.for_client(self.aclient) is TokenCache.for_client(self.aclient), True)
+
+    def test_for_client_does_not_keep_client_alive(self):
+        class Client(object):
+            def get_access_token(self):
+                return 'token'
+        aclient = Client()
+        ref = weakref.ref(aclient)
+        eq_(TokenCache.for_client(aclient).get(), 'token')
+        del aclient
+        gc.collect()
+        eq_(ref(), None)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Ricoh Co., Ltd. All Rights Reserved.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest import TestCase
+from nose.tools import eq_, raises
+from mock import Mock
+from requests.exceptions import HTTPError
+from ricohapi.mstorage.client import MediaStorage
+from ricohapi.mstorage.mockserver import MockMediaStorageServer
+from ricohapi.mstorage.upload_queue import UploadQueue, DONE, FAILED
+
+class TestUploadQueue(TestCase):
+    def setUp(self):
+        self.server = MockMediaStorageServer().start()
+        aclient = Mock()
+        aclient.get_access_token = Mock(return_value='atoken')
+        self.mstorage = MediaStorage(aclient, endpoint=self.server.endpoint)
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmpdir, 'journal.db')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as ofile:
+            ofile.write(data)
+        return path
+
+    def test_enqueue(self):
+        path = self.write('a.jpg', b'aaa')
+        with UploadQueue(self.mstorage, self.journal, max_workers=2) as uploads:
+            future = uploads.enqueue(path, {'user.tag': 'rig1'})
+            mid = future.result(timeout=5)
+            eq_(uploads.status(future.job_id), (DONE, mid, None, 0))
+            eq_(uploads.future(future.job_id).result(), mid)
+            eq_(uploads.pending(), 0)
+        media = self.server.get_media(mid)
+        eq_((media['content'], media['user']), (b'aaa', {'user.tag': 'rig1'}))
+
+    def test_enqueue_is_fast(self):
+        self.server.latency = 0.2
+        path = self.write('a.jpg', b'aaa')
+        with UploadQueue(self.mstorage, self.journal) as uploads:
+            started = time.time()
+            futures = [uploads.enqueue(path) for dummy in range(10)]
+            eq_(time.time() - started < 0.1, True)
+            eq_(uploads.join(timeout=5), True)
+        eq_(len(set(future.result() for future in futures)), 10)
+
+    def test_resume_after_restart(self):
+        path = self.write('a.jpg', b'aaa')
+        uploaded = self.server.add_media(b'bbb')['id']
+        uploads = UploadQueue(self.mstorage, self.journal, max_workers=1)
+        uploads.close()
+        conn = sqlite3.connect(self.journal)
+        with conn:
+            conn.execute("INSERT INTO jobs (path, meta, state, created_at) VALUES (?, NULL, 'pending', 0)",
+                         (path,))
+            conn.execute("INSERT INTO jobs (path, meta, state, mid, created_at) "
+                         "VALUES ('gone.jpg', ?, 'uploaded', ?, 0)", ('{"user.k": "v"}', uploaded))
+        conn.close()
+        with UploadQueue(self.mstorage, self.journal) as uploads:
+            eq_(uploads.join(timeout=5), True)
+            eq_(uploads.future(1).result(), uploads.status(1).mid)
+            eq_(uploads.future(2).result(), uploaded)
+        # the interrupted job only redid its meta step
+        eq_(self.server.get_media(uploaded)['user'], {'user.k': 'v'})
+        eq_(len(list(self.mstorage.iter_media())), 2)
+
+    def test_retry(self):
+        path = self.write('a.jpg', b'aaa')
+        self.server.error_rate = 1.0
+        self.server.error_status = 500
+        with UploadQueue(self.mstorage, self.journal, max_attempts=3, retry_delay=0.01) as uploads:
+            future = uploads.enqueue(path)
+            time.sleep(0.02)
+            self.server.error_rate = 0.0
+            eq_(len(future.result(timeout=5)), 32)
+            eq_(uploads.status(future.job_id).attempts >= 1, True)
+
+    def test_failed(self):
+        with UploadQueue(self.mstorage, self.journal) as uploads:
+            future = uploads.enqueue(os.path.join(self.tmpdir, 'missing.jpg'))
+            eq_(isinstance(future.exception(timeout=5), (IOError, OSError)), True)
+            eq_(uploads.status(future.job_id).state, FAILED)
+
+    def test_unexpected_error(self):
+        mstorage = Mock()
+        mstorage.upload = Mock(side_effect=[{}, {'id': 'id1'}])
+        path = self.write('a.jpg', b'aaa')
+        with UploadQueue(mstorage, self.journal, max_workers=1) as uploads:
+            future = uploads.enqueue(path)
+            eq_(isinstance(future.exception(timeout=5), KeyError), True)
+            eq_(uploads.status(future.job_id).state, FAILED)
+            # the worker survived
+            eq_(uploads.enqueue(path).result(timeout=5), 'id1')
+            eq_(uploads.join(timeout=5), True)
+
+    def test_client_error_not_retried(self):
+        path = self.write('a.jpg', b'aaa')
+        self.server.error_rate = 1.0
+        self.server.error_status = 400
+        with UploadQueue(self.mstorage, self.journal, retry_delay=10) as uploads:
+            future = uploads.enqueue(path)
+            eq_(isinstance(future.exception(timeout=5), HTTPError), True)
+            eq_(uploads.status(future.job_id).attempts, 1)
+
+    def test_close_without_wait_keeps_jobs(self):
+        self.server.latency = 0.2
+        path = self.write('a.jpg', b'aaa')
+        uploads = UploadQueue(self.mstorage, self.journal, max_workers=1)
+        futures = [uploads.enqueue(path) for dummy in range(3)]
+        uploads.close(wait=False)
+        eq_(all(future.done() for future in futures), True)
+        eq_(futures[-1].cancelled(), True)
+        self.server.latency = 0
+        with UploadQueue(self.mstorage, self.journal) as uploads:
+            eq_(uploads.join(timeout=5), True)
+            eq_([uploads.status(future.job_id).state for future in futures], [DONE] * 3)
+        eq_(len(list(self.mstorage.iter_media())), 3)
+
+    def test_close_without_wait_cancels_retries(self):
+        path = self.write('a.jpg', b'aaa')
+        self.mstorage.upload = Mock(side_effect=HTTPError('boom'))
+        uploads = UploadQueue(self.mstorage, self.journal, retry_delay=10)
+        future = uploads.enqueue(path)
+        time.sleep(0.1)
+        uploads.close(wait=False)
+        eq_(future.cancelled(), True)
+        eq_(uploads.pending(), 0)
+
+    @raises(ValueError)
+    def test_invalid_meta(self):
+        with UploadQueue(self.mstorage, self.journal) as uploads:
+            uploads.enqueue(self.write('a.jpg', b'aaa'), {'invalid': 'value'})